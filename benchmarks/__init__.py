@@ -0,0 +1,11 @@
+"""
+Reproducible benchmarks of the hot paths of every probably structure.
+
+    python -m benchmarks run --output baseline.json
+    python -m benchmarks run --quick --only bloom,cms --output new.json
+    python -m benchmarks compare baseline.json new.json
+
+Every case (structure x capacity x error rate x key length) runs in its own
+process so that its peak RSS is its own. Results are saved as JSON, along with
+the machine and library versions, and compared by (structure, operation, params).
+"""
@@ -0,0 +1,93 @@
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import itertools
+import sys
+
+from probably.hashfunctions import CHAINED, HASH_SCHEMES
+
+from .cases import CASES
+from .harness import compare, environment, load, run_case, save
+
+
+def csv(convert):
+    return lambda value: [convert(item) for item in value.split(',')]
+
+
+def extra_columns(result):
+    columns = ''
+    if 'bits_per_key' in result:
+        columns += '  %.1f bits/key' % result['bits_per_key']
+    if 'measured_error_rate' in result:
+        columns += '  fpr %.2g' % result['measured_error_rate']
+    return columns
+
+
+def run(args):
+    if args.quick:
+        args.capacity, args.error_rate, args.key_length, args.nbr_ops = [10000], [0.01], [16], 10000
+    structures = args.only or sorted(CASES)
+    report = {'environment': environment(), 'results': []}
+    print("%-15s %-18s %9s %7s %4s %8s %14s %10s %10s %9s" % (
+        'structure', 'operation', 'capacity', 'error', 'key', 'scheme', 'ops/sec', 'p50 us', 'p99 us', 'rss MB'))
+    for structure in structures:
+        for capacity, error_rate, key_length, hash_scheme in itertools.product(
+                args.capacity, args.error_rate, args.key_length, args.hash_scheme):
+            params = {'capacity': capacity, 'error_rate': error_rate, 'key_length': key_length,
+                      'hash_scheme': hash_scheme}
+            case_params = dict(params, nbr_ops=args.nbr_ops)
+            for result in run_case(CASES[structure], case_params):
+                result.update(structure=structure, params=params)
+                report['results'].append(result)
+                print("%-15s %-18s %9d %7g %4d %8s %14.0f %10.2f %10.2f %9.1f" % (
+                    structure, result['operation'], capacity, error_rate, key_length, hash_scheme,
+                    result['ops_per_sec'], result['latency_us']['p50'], result['latency_us']['p99'],
+                    result['peak_rss_mb'] or 0) + extra_columns(result))
+                sys.stdout.flush()
+    if args.output:
+        save(report, args.output)
+    return 0
+
+
+def run_compare(args):
+    rows, regression = compare(load(args.baseline), load(args.current), args.threshold)
+    for key, before, after, ratio, regressed in rows:
+        print("%-60s %14.0f %14.0f %7.2fx%s" % (' '.join(str(part) for part in key), before, after, ratio,
+                                                 '  REGRESSION' if regressed else ''))
+    return 1 if regression else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    runner = commands.add_parser('run', help='run the benchmarks')
+    runner.add_argument('--only', type=csv(str), help='structures to run, among %s' % ','.join(sorted(CASES)))
+    runner.add_argument('--capacity', type=csv(int), default=[100000, 1000000])
+    runner.add_argument('--error-rate', type=csv(float), default=[0.01, 0.001])
+    runner.add_argument('--key-length', type=csv(int), default=[16, 64])
+    runner.add_argument('--hash-scheme', type=csv(str), default=[CHAINED],
+                        help='among %s' % ','.join(HASH_SCHEMES))
+    runner.add_argument('--nbr-ops', type=int, default=100000, help='keys per single-key operation')
+    runner.add_argument('--quick', action='store_true', help='a single small configuration')
+    runner.add_argument('--output', help='JSON file to save the results in')
+    runner.set_defaults(func=run)
+
+    comparer = commands.add_parser('compare', help='compare two JSON results')
+    comparer.add_argument('baseline')
+    comparer.add_argument('current')
+    comparer.add_argument('--threshold', type=float, default=0.1,
+                          help='report a regression below (1 - threshold) times the baseline ops/sec')
+    comparer.set_defaults(func=run_compare)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'only', None):
+        unknown = set(args.only) - set(CASES)
+        if unknown:
+            parser.error("unknown structures: %s" % ', '.join(sorted(unknown)))
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
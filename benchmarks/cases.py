@@ -0,0 +1,249 @@
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import copy
+import datetime as dt
+import shutil
+import tempfile
+
+import numpy as np
+
+from probably import (BlockedBloomFilter, BloomFilter, CountdownBloomFilter, CountingBloomFilter,
+                      CountMinSketch, CuckooFilter, DailyTemporalBloomFilter, HyperLogLog, IngestionPipeline)
+from probably.hashfunctions import DOUBLE
+from probably.temporal_daily import SNAPSHOT_PICKLE, SNAPSHOT_RAW
+
+from .harness import Operation
+
+BATCH_SIZE = 10000
+
+
+def make_keys(count, key_length, seed=0):
+    """ count distinct-ish random hexadecimal keys of key_length characters """
+    rng = np.random.RandomState(seed)
+    digits = rng.randint(0, 256, size=count * ((key_length + 1) // 2), dtype=np.uint8).tobytes().hex()
+    return [digits[i:i + key_length] for i in range(0, count * key_length, key_length)]
+
+
+def batches(keys):
+    return [keys[i:i + BATCH_SIZE] for i in range(0, len(keys), BATCH_SIZE)]
+
+
+def workload(capacity, key_length, nbr_ops):
+    """ Keys to insert and absent keys to query, nbr_ops each at most """
+    count = min(capacity, nbr_ops)
+    return make_keys(count, key_length, seed=0), make_keys(count, key_length, seed=1)
+
+
+def membership(single, bulk, keys, others, nbytes=None):
+    """ add/contains on single and their bulk versions on bulk.
+
+        contains_many also reports the measured error rate and, given the
+        memory of the structure, its bits per key, to compare filters at equal
+        error rates.
+    """
+    key_batches, other_batches = batches(keys), batches(others)
+
+    def footprint():
+        extra = {'measured_error_rate': float(bulk.contains_many(others).mean())}
+        if nbytes is not None:
+            extra['bits_per_key'] = nbytes * 8.0 / bulk.capacity
+        return extra
+    return [
+        Operation('add', lambda i: single.add(keys[i]), len(keys)),
+        Operation('contains', lambda i: others[i] in single, len(others)),
+        Operation('add_many', lambda i: bulk.add_many(key_batches[i]), len(key_batches), BATCH_SIZE),
+        Operation('contains_many', lambda i: bulk.contains_many(other_batches[i]), len(other_batches),
+                  BATCH_SIZE, extra=footprint),
+    ]
+
+
+def bloom(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    keys, others = workload(capacity, key_length, nbr_ops)
+    bulk = BloomFilter(capacity, error_rate, hash_scheme)
+    return membership(BloomFilter(capacity, error_rate, hash_scheme), bulk, keys, others,
+                      (bulk.nbr_bits + 7) // 8)
+
+
+def blocked_bloom(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    keys, others = workload(capacity, key_length, nbr_ops)
+    bulk = BlockedBloomFilter(capacity, error_rate)
+    return membership(BlockedBloomFilter(capacity, error_rate), bulk, keys, others, bulk.words.nbytes)
+
+
+def matched_cuckoo_error_rate(capacity, error_rate, keys, others, hash_scheme):
+    """ Error rate to build a CuckooFilter with so that its measured false
+        positive rate is the closest to the one of a BloomFilter built for
+        error_rate: fingerprints take whole bits, so only powers of two are tried.
+    """
+    bloom = BloomFilter(capacity, error_rate, hash_scheme)
+    bloom.add_many(keys)
+    target = max(bloom.contains_many(others).mean(), 1.0 / len(others))
+    bucket_size = CuckooFilter(1, error_rate).bucket_size
+    bits = int(np.ceil(np.log2(2.0 * bucket_size / error_rate)))
+    candidates = []
+    for fingerprint_bits in range(max(bits - 2, 1), min(bits + 3, 33)):
+        rate = 2.0 * bucket_size / (1 << fingerprint_bits)
+        cf = CuckooFilter(capacity, rate)
+        cf.add_many(keys)
+        measured = max(cf.contains_many(others).mean(), 1.0 / len(others))
+        candidates.append((abs(np.log(measured / target)), rate))
+    return min(candidates)[1]
+
+
+def cuckoo(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    """ Sized to match the measured false positive rate of a BloomFilter built
+        for error_rate, so that their bits per key can be compared.
+    """
+    keys, others = workload(capacity, key_length, nbr_ops)
+    rate = matched_cuckoo_error_rate(capacity, error_rate, keys, others, hash_scheme)
+    single = CuckooFilter(capacity, rate)
+    bulk = CuckooFilter(capacity, rate)
+    key_batches = batches(keys)
+    return membership(single, bulk, keys, others, bulk.table.nbytes) + [
+        Operation('remove', lambda i: single.remove(keys[i]), len(keys)),
+        Operation('remove_many', lambda i: bulk.remove_many(key_batches[i]), len(key_batches), BATCH_SIZE),
+    ]
+
+
+def counting_bloom(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    keys, others = workload(capacity, key_length, nbr_ops)
+    single = CountingBloomFilter(capacity, error_rate, hash_scheme)
+    bulk = CountingBloomFilter(capacity, error_rate, hash_scheme)
+    key_batches = batches(keys)
+    return membership(single, bulk, keys, others, bulk.cellarray.nbytes) + [
+        Operation('remove', lambda i: single.remove(keys[i]), len(keys)),
+        Operation('remove_many', lambda i: bulk.remove_many(key_batches[i]), len(key_batches), BATCH_SIZE),
+    ]
+
+
+def cdbf(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    keys, others = workload(capacity, key_length, nbr_ops)
+
+    def factory():
+        return CountdownBloomFilter(capacity, error_rate, 60, disable_hard_capacity=True,
+                                    hash_scheme=hash_scheme)
+    operations = membership(factory(), factory(), keys, others)
+    maintained = factory()
+    maintained.add_many(keys)
+    chunk = max(maintained.nbr_bits // 10, 1)
+    operations += [
+        # One lap over the cells in 10 chunks, then whole laps at once
+        Operation('maintenance', lambda i: maintained.run_maintenance(chunk), 10, chunk),
+        Operation('maintenance_laps', lambda i: maintained.run_maintenance(3 * maintained.nbr_bits), 5,
+                  3 * maintained.nbr_bits),
+    ]
+    return operations
+
+
+def cms(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    """ A Zipf stream of nbr_ops updates over up to capacity distinct keys """
+    distinct = make_keys(min(capacity, nbr_ops), key_length)
+    rng = np.random.RandomState(2)
+    stream = [distinct[i] for i in (rng.zipf(1.2, nbr_ops) - 1) % len(distinct)]
+    stream_batches = batches(stream)
+    single = CountMinSketch(1e-3, error_rate, 100, hash_scheme)
+    bulk = CountMinSketch(1e-3, error_rate, 100, hash_scheme)
+    other = CountMinSketch(1e-3, error_rate, 100, hash_scheme)
+    other.update_many(stream[:BATCH_SIZE])
+    return [
+        Operation('update', lambda i: single.update(stream[i], 1), len(stream)),
+        Operation('get', lambda i: single.get(distinct[i % len(distinct)]), len(stream)),
+        Operation('update_many', lambda i: bulk.update_many(stream_batches[i]), len(stream_batches),
+                  BATCH_SIZE),
+        Operation('merge', lambda i: bulk.merge(other), 20),
+    ]
+
+
+def hll(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    keys = make_keys(min(capacity, nbr_ops), key_length)
+    key_batches = batches(keys)
+    single = HyperLogLog(error_rate)
+    bulk = HyperLogLog(error_rate)
+    others = [HyperLogLog(error_rate) for i in range(10)]
+    for i, other in enumerate(others):
+        other.add_many(keys[i::10])
+    return [
+        Operation('add', lambda i: single.add(keys[i]), len(keys)),
+        Operation('add_many', lambda i: bulk.add_many(key_batches[i]), len(key_batches), BATCH_SIZE),
+        Operation('estimate', lambda i: bulk.estimate(), 1000),
+        Operation('merge', lambda i: copy.deepcopy(bulk).merge(*others), 100, len(others)),
+    ]
+
+
+def ingestion(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    """ Dedup + unique count + trends of a Zipf stream: the three structures
+        updated one after the other with hash_scheme, against IngestionPipeline
+        (always DOUBLE hashing, the only scheme it supports).
+    """
+    distinct = make_keys(min(capacity, nbr_ops), key_length)
+    rng = np.random.RandomState(3)
+    stream_batches = batches([distinct[i] for i in (rng.zipf(1.2, nbr_ops) - 1) % len(distinct)])
+
+    def structures(scheme):
+        return (CountdownBloomFilter(capacity, error_rate, 60, disable_hard_capacity=True, hash_scheme=scheme),
+                HyperLogLog(0.01), CountMinSketch(1e-3, error_rate, 100, scheme))
+    pipeline = IngestionPipeline(*structures(DOUBLE))
+    cdbf, hll, cms = structures(hash_scheme)
+
+    def separate(batch):
+        unseen = ~cdbf.add_many(batch)
+        new_keys = [key for key, new in zip(batch, unseen) if new]
+        hll.add_many(new_keys)
+        cms.update_many(new_keys)
+    return [
+        Operation('separate', lambda i: separate(stream_batches[i]), len(stream_batches), BATCH_SIZE),
+        Operation('pipeline', lambda i: pipeline.ingest(stream_batches[i]), len(stream_batches), BATCH_SIZE),
+    ]
+
+
+@contextlib.contextmanager
+def daily_temporal(capacity, error_rate, key_length, hash_scheme, nbr_ops):
+    """ The snapshots live in a temporary directory, removed once the operations ran """
+    keys, others = workload(capacity, key_length, nbr_ops)
+    snapshot_path = tempfile.mkdtemp()
+    try:
+        today = dt.datetime.now()
+
+        def factory(name, snapshot_format=SNAPSHOT_PICKLE, ring=False):
+            return DailyTemporalBloomFilter(capacity, error_rate, 7, name, snapshot_path, hash_scheme,
+                                            snapshot_format, ring)
+        bf = factory('bench')
+        # A week of snapshots in both formats for restore_from_disk
+        for snapshot_format in (SNAPSHOT_PICKLE, SNAPSHOT_RAW):
+            for day in range(7):
+                day_bf = factory(snapshot_format, snapshot_format)
+                day_bf.initialize_period(today - dt.timedelta(days=day))
+                for key in keys[day::7]:
+                    day_bf.add(key)
+                day_bf.save_snaphot()
+        ring = factory(SNAPSHOT_RAW, SNAPSHOT_RAW, ring=True)
+        ring.restore_from_disk()
+
+        def restore(snapshot_format):
+            restored = factory(snapshot_format, snapshot_format)
+            restored.restore_from_disk()
+
+        yield [
+            Operation('add', lambda i: bf.add(keys[i]), len(keys)),
+            Operation('contains', lambda i: others[i] in bf, len(others)),
+            Operation('save_snapshot', lambda i: bf.save_snaphot(), 5),
+            Operation('restore_pickle', lambda i: restore(SNAPSHOT_PICKLE), 5),
+            Operation('restore_raw', lambda i: restore(SNAPSHOT_RAW), 5),
+            Operation('ring_maintenance', lambda i: ring.maintenance(), 5),
+        ]
+    finally:
+        shutil.rmtree(snapshot_path)
+
+
+CASES = {
+    'bloom': bloom,
+    'blocked_bloom': blocked_bloom,
+    'cdbf': cdbf,
+    'cms': cms,
+    'counting_bloom': counting_bloom,
+    'cuckoo': cuckoo,
+    'hll': hll,
+    'ingestion': ingestion,
+    'daily_temporal': daily_temporal,
+}
@@ -0,0 +1,171 @@
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import datetime as dt
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Operation(object):
+    """ A benchmarked operation: call(i) runs the i-th of calls calls, each one
+        doing ops_per_call operations (keys, cells...). extra(), if given, returns
+        more figures to report (memory, measured error rate...) once the calls ran.
+    """
+
+    def __init__(self, name, call, calls, ops_per_call=1, warmup=None, extra=None):
+        self.name = name
+        self.call = call
+        self.calls = calls
+        self.ops_per_call = ops_per_call
+        self.warmup = warmup
+        self.extra = extra
+
+    def run(self):
+        if self.warmup is not None:
+            self.warmup()
+        latencies = np.empty(self.calls, dtype=np.float64)
+        clock = time.perf_counter
+        call = self.call
+        start = clock()
+        for i in range(self.calls):
+            t0 = clock()
+            call(i)
+            latencies[i] = clock() - t0
+        total = clock() - start
+        result = {
+            'operation': self.name,
+            'calls': self.calls,
+            'ops_per_call': self.ops_per_call,
+            'ops_per_sec': self.calls * self.ops_per_call / total,
+            'latency_us': _latency_summary(latencies),
+        }
+        if self.extra is not None:
+            result.update(self.extra())
+        return result
+
+
+def _latency_summary(latencies):
+    summary = dict(('p%d' % q, float(np.percentile(latencies, q)) * 1e6) for q in (50, 90, 99))
+    summary['max'] = float(latencies.max()) * 1e6
+    return summary
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process, in MB (None where unsupported) """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def case_operations(case, params):
+    """ A case returns its list of operations, or a context manager giving it
+        when the case has to clean up after them (temporary files...).
+        Returns a context manager in both cases.
+    """
+    operations = case(**params)
+    if hasattr(operations, '__enter__'):
+        return operations
+    return _given(operations)
+
+
+@contextlib.contextmanager
+def _given(operations):
+    yield operations
+
+
+def _run_case(case, params, queue):
+    try:
+        results = []
+        with case_operations(case, params) as operations:
+            for operation in operations:
+                result = operation.run()
+                result['peak_rss_mb'] = peak_rss_mb()
+                results.append(result)
+        queue.put((True, results))
+    except Exception as e:
+        queue.put((False, '%s: %s' % (type(e).__name__, e)))
+
+
+def run_case(case, params):
+    """ Run the operations of case(**params) in a child process. Returns their results. """
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(case, params, queue))
+    process.start()
+    ok, results = queue.get()
+    process.join()
+    if not ok:
+        raise RuntimeError("%s%r failed: %s" % (case.__name__, params, results))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    import bitarray
+    import mmh3
+    return {
+        'timestamp': dt.datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'numpy': np.__version__,
+        'bitarray': bitarray.__version__,
+        'mmh3': getattr(mmh3, '__version__', None),
+    }
+
+
+def save(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def result_key(result):
+    params = result['params']
+    return (result['structure'], result['operation'], params['capacity'], params['error_rate'],
+            params['key_length'], params['hash_scheme'])
+
+
+def compare(baseline, current, threshold=0.1):
+    """ Ratios of ops/sec between two reports, matched by (structure, operation, params).
+        Returns the rows and whether any ratio is below 1 - threshold.
+    """
+    previous = dict((result_key(result), result) for result in baseline['results'])
+    rows = []
+    regression = False
+    for result in current['results']:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        ratio = result['ops_per_sec'] / before['ops_per_sec']
+        regressed = ratio < 1 - threshold
+        regression = regression or regressed
+        rows.append((result_key(result), before['ops_per_sec'], result['ops_per_sec'], ratio, regressed))
+    return rows, regression
@@ -3,5 +3,10 @@ from __future__ import absolute_import
 from .bloomfilter import *
 from .cdbf import *
 from .countmin import *
+from .counting import *
+from .cuckoo import *
 from .hll import *
+from .pipeline import *
+from .scheduler import *
+from .sharded import *
 from .temporal_daily import *
@@ -0,0 +1,1038 @@
+'''
+Cython module for bulk hashing and bulk cell updates
+'''
+
+import cython
+import numpy as np
+from libc.stdint cimport int64_t, uint8_t, uint32_t, uint64_t
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from six import text_type
+
+
+cdef extern from *:
+    """
+    #if defined(_MSC_VER)
+    #include <intrin.h>
+    static int probably_ctz64(unsigned long long x) {
+        unsigned long i;
+        _BitScanForward64(&i, x);
+        return (int) i;
+    }
+    #else
+    static int probably_ctz64(unsigned long long x) { return __builtin_ctzll(x); }
+    #endif
+
+    /* Maps a 64-bit hash to [0, n) with a multiplication instead of a modulo */
+    #if defined(_MSC_VER) && defined(_M_X64)
+    #define probably_fastrange64(x, n) __umulh((x), (n))
+    #elif defined(__SIZEOF_INT128__)
+    #define probably_fastrange64(x, n) ((unsigned long long) (((unsigned __int128) (x) * (n)) >> 64))
+    #else
+    #define probably_fastrange64(x, n) ((x) % (n))
+    #endif
+
+    #if defined(__GNUC__) || defined(__clang__)
+    #define probably_prefetch(p) __builtin_prefetch((p))
+    #else
+    #define probably_prefetch(p) ((void) 0)
+    #endif
+
+    /* Unaligned little-endian 64-bit accesses, for bit-packed tables */
+    #include <string.h>
+    static inline unsigned long long probably_load64(const unsigned char *p) {
+        unsigned long long v;
+        memcpy(&v, p, 8);
+    #if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+        v = __builtin_bswap64(v);
+    #endif
+        return v;
+    }
+    static inline void probably_store64(unsigned char *p, unsigned long long v) {
+    #if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+        v = __builtin_bswap64(v);
+    #endif
+        memcpy(p, &v, 8);
+    }
+
+    /* Atomic updates, for storage shared between processes (see sharedmem) */
+    #if defined(_MSC_VER)
+    #define probably_atomic_or8(p, v) ((unsigned char) _InterlockedOr8((char *) (p), (char) (v)))
+    #define probably_atomic_add64(p, v) (_InterlockedExchangeAdd64((p), (v)) + (v))
+    #else
+    #define probably_atomic_or8(p, v) __atomic_fetch_or((p), (v), __ATOMIC_RELAXED)
+    #define probably_atomic_add64(p, v) __atomic_add_fetch((p), (v), __ATOMIC_SEQ_CST)
+    #endif
+    """
+    int probably_ctz64(unsigned long long x) nogil
+    unsigned long long probably_fastrange64(unsigned long long x, unsigned long long n) nogil
+    void probably_prefetch(const void *p) nogil
+    uint64_t probably_load64(const uint8_t *p) nogil
+    void probably_store64(uint8_t *p, uint64_t v) nogil
+    uint8_t probably_atomic_or8(uint8_t *p, uint8_t v) nogil
+    int64_t probably_atomic_add64(int64_t *p, int64_t v) nogil
+
+
+cdef uint64_t C1 = 0x87c37b91114253d5ULL
+cdef uint64_t C2 = 0x4cf5ad432745937fULL
+
+
+cdef inline uint64_t rotl64(uint64_t x, int r) noexcept nogil:
+    return (x << r) | (x >> (64 - r))
+
+
+cdef inline uint64_t fmix64(uint64_t k) noexcept nogil:
+    k ^= k >> 33
+    k *= 0xff51afd7ed558ccdULL
+    k ^= k >> 33
+    k *= 0xc4ceb9fe1a85ec53ULL
+    k ^= k >> 33
+    return k
+
+
+cdef inline uint64_t bswap64(uint64_t x) noexcept nogil:
+    return (((x & 0x00000000000000ffULL) << 56) |
+            ((x & 0x000000000000ff00ULL) << 40) |
+            ((x & 0x0000000000ff0000ULL) << 24) |
+            ((x & 0x00000000ff000000ULL) << 8) |
+            ((x & 0x000000ff00000000ULL) >> 8) |
+            ((x & 0x0000ff0000000000ULL) >> 24) |
+            ((x & 0x00ff000000000000ULL) >> 40) |
+            ((x & 0xff00000000000000ULL) >> 56))
+
+
+@cython.cdivision(True)
+cdef void murmur3_x64_128(const uint8_t *data, Py_ssize_t length, uint32_t seed,
+                          uint64_t *out) noexcept nogil:
+    '''
+    MurmurHash3_x64_128, bit-for-bit identical to mmh3.hash64/hash128
+    '''
+    cdef Py_ssize_t nblocks = length // 16
+    cdef Py_ssize_t i
+    cdef uint64_t h1 = seed
+    cdef uint64_t h2 = seed
+    cdef uint64_t k1, k2
+    cdef const uint8_t *tail
+
+    for i in range(nblocks):
+        memcpy(&k1, data + i * 16, 8)
+        memcpy(&k2, data + i * 16 + 8, 8)
+
+        k1 *= C1
+        k1 = rotl64(k1, 31)
+        k1 *= C2
+        h1 ^= k1
+        h1 = rotl64(h1, 27)
+        h1 += h2
+        h1 = h1 * 5 + 0x52dce729
+
+        k2 *= C2
+        k2 = rotl64(k2, 33)
+        k2 *= C1
+        h2 ^= k2
+        h2 = rotl64(h2, 31)
+        h2 += h1
+        h2 = h2 * 5 + 0x38495ab5
+
+    tail = data + nblocks * 16
+    k1 = 0
+    k2 = 0
+    i = length & 15
+    if i > 8:
+        while i > 8:
+            k2 ^= (<uint64_t> tail[i - 1]) << ((i - 9) * 8)
+            i -= 1
+        k2 *= C2
+        k2 = rotl64(k2, 33)
+        k2 *= C1
+        h2 ^= k2
+    if i > 0:
+        while i > 0:
+            k1 ^= (<uint64_t> tail[i - 1]) << ((i - 1) * 8)
+            i -= 1
+        k1 *= C1
+        k1 = rotl64(k1, 31)
+        k1 *= C2
+        h1 ^= k1
+
+    h1 ^= <uint64_t> length
+    h2 ^= <uint64_t> length
+    h1 += h2
+    h2 += h1
+    h1 = fmix64(h1)
+    h2 = fmix64(h2)
+    h1 += h2
+    h2 += h1
+    out[0] = h1
+    out[1] = h2
+
+
+cdef inline uint64_t hash64_c(const uint8_t *data, Py_ssize_t length, uint64_t seed) noexcept nogil:
+    ''' Same as hashfunctions.hash64: first half of the 128-bit hash, byte-swapped '''
+    cdef uint64_t out[2]
+    murmur3_x64_128(data, length, <uint32_t> seed, out)
+    return bswap64(out[0])
+
+
+cdef inline bytes encode_key(key):
+    '''
+    Bytes to hash for a key: bytes-like keys as they are, text as UTF-8 and
+    anything else as the UTF-8 of its str()
+    '''
+    if type(key) is bytes:
+        return key
+    if isinstance(key, text_type):
+        return key.encode('utf-8')
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return bytes(key)
+    return str(key).encode('utf-8')
+
+
+cdef list encode_keys(keys):
+    ''' Apply the same key normalization as hashfunctions.generate_hashfunctions '''
+    return [encode_key(key) for key in keys]
+
+
+cdef class EncodedKeys:
+    '''
+    Normalized keys along with C pointers to their bytes, usable without the GIL
+    '''
+    cdef list keys
+    cdef Py_ssize_t n
+    cdef const uint8_t **data
+    cdef Py_ssize_t *lengths
+
+    def __cinit__(self, keys):
+        cdef Py_ssize_t i
+        cdef bytes key
+        self.keys = encode_keys(keys)
+        self.n = len(self.keys)
+        self.data = <const uint8_t **> malloc(max(self.n, 1) * sizeof(uint8_t *))
+        self.lengths = <Py_ssize_t *> malloc(max(self.n, 1) * sizeof(Py_ssize_t))
+        if self.data == NULL or self.lengths == NULL:
+            raise MemoryError()
+        for i in range(self.n):
+            key = self.keys[i]
+            self.data[i] = <const uint8_t *> (<char *> key)
+            self.lengths[i] = len(key)
+
+    def __dealloc__(self):
+        free(self.data)
+        free(self.lengths)
+
+
+@cython.cdivision(True)
+def hash_one(key, uint64_t nbr_bits, Py_ssize_t nbr_slices, bint double=False):
+    '''
+    Hash a single key, returning the same list as generate_hashfunctions(...)(key)
+    '''
+    cdef bytes encoded = encode_key(key)
+    cdef const uint8_t *data = <const uint8_t *> (<char *> encoded)
+    cdef Py_ssize_t length = len(encoded)
+    cdef Py_ssize_t j
+    cdef uint64_t current_hash = 0
+    cdef uint64_t h[2]
+    cdef list rval = []
+    if double:
+        murmur3_x64_128(data, length, 0, h)
+        for j in range(nbr_slices):
+            rval.append((h[0] + <uint64_t> j * h[1]) % nbr_bits)
+    else:
+        for j in range(nbr_slices):
+            current_hash = hash64_c(data, length, current_hash)
+            rval.append(current_hash % nbr_bits)
+    return rval
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def hash_many(keys, uint64_t nbr_bits, Py_ssize_t nbr_slices, bint double=False):
+    '''
+    Hash a sequence of keys, returning a (len(keys), nbr_slices) uint64 array.
+    Row i holds the same values as generate_hashfunctions(...)(keys[i]), using
+    the chained scheme, or the double hashing scheme when double is set.
+    '''
+    cdef EncodedKeys encoded = EncodedKeys(keys)
+    cdef Py_ssize_t i, j
+    cdef uint64_t current_hash
+    cdef uint64_t h[2]
+    result = np.empty((encoded.n, nbr_slices), dtype=np.uint64)
+    cdef uint64_t[:, ::1] out = result
+    with nogil:
+        for i in range(encoded.n):
+            if double:
+                murmur3_x64_128(encoded.data[i], encoded.lengths[i], 0, h)
+                for j in range(nbr_slices):
+                    out[i, j] = (h[0] + <uint64_t> j * h[1]) % nbr_bits
+            else:
+                current_hash = 0
+                for j in range(nbr_slices):
+                    current_hash = hash64_c(encoded.data[i], encoded.lengths[i], current_hash)
+                    out[i, j] = current_hash % nbr_bits
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+def digest_indexes(const uint64_t[:, ::1] digests, uint64_t nbr_bits, Py_ssize_t nbr_slices):
+    '''
+    Indexes of pre-hashed keys, a (len(digests), nbr_slices) uint64 array: the
+    double hashing scheme applied to 128-bit digests (see hash128_many), so
+    rows match hash_many(keys, ..., double=True) for the digests of keys.
+    '''
+    cdef Py_ssize_t i, j
+    result = np.empty((digests.shape[0], nbr_slices), dtype=np.uint64)
+    cdef uint64_t[:, ::1] out = result
+    with nogil:
+        for i in range(digests.shape[0]):
+            for j in range(nbr_slices):
+                out[i, j] = (digests[i, 0] + <uint64_t> j * digests[i, 1]) % nbr_bits
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def expand_digests64(const uint64_t[::1] digests):
+    '''
+    128-bit digests from 64-bit ones, as a (len(digests), 2) uint64 array.
+    Both halves are remixed with fmix64: the indexes are taken from the high
+    bits (fastrange) and 64-bit digests may well be weak or even sequential.
+    '''
+    cdef Py_ssize_t i
+    cdef uint64_t h1
+    result = np.empty((digests.shape[0], 2), dtype=np.uint64)
+    cdef uint64_t[:, ::1] out = result
+    with nogil:
+        for i in range(digests.shape[0]):
+            h1 = fmix64(digests[i])
+            out[i, 0] = h1
+            out[i, 1] = fmix64(h1 + 0x9e3779b97f4a7c15ULL)
+    return result
+
+
+cdef inline bint test_bit(uint8_t *bits, uint64_t index) noexcept nogil:
+    ''' Bits are packed like a big-endian bitarray.bitarray '''
+    return (bits[index >> 3] >> (7 - (index & 7))) & 1
+
+
+cdef inline bint set_bit(uint8_t *bits, uint64_t index) noexcept nogil:
+    '''
+    Atomic fetch-or, so that processes sharing the bits (see sharedmem) cannot
+    drop each other's bits of the same byte. Returns whether the bit was set.
+    '''
+    cdef uint8_t mask = <uint8_t> (1 << (7 - (index & 7)))
+    return (probably_atomic_or8(&bits[index >> 3], mask) & mask) != 0
+
+
+def atomic_add(int64_t[::1] counter, int64_t delta):
+    '''
+    Atomically add delta to counter[0] (e.g. a count in shared memory).
+    Returns the new value.
+    '''
+    return probably_atomic_add64(&counter[0], delta)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def bloom_contains(uint8_t[::1] bits, const uint64_t[:, ::1] hashes,
+                   uint64_t bits_per_slice):
+    '''
+    Membership test of every row of hashes against a packed bit buffer
+    '''
+    cdef Py_ssize_t n = hashes.shape[0]
+    cdef Py_ssize_t nbr_slices = hashes.shape[1]
+    cdef Py_ssize_t i, j
+    result = np.ones(n, dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    with nogil:
+        for i in range(n):
+            for j in range(nbr_slices):
+                if not test_bit(&bits[0], j * bits_per_slice + hashes[i, j]):
+                    found[i] = 0
+                    break
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def bloom_add(uint8_t[::1] bits, const uint64_t[:, ::1] hashes,
+              uint64_t bits_per_slice):
+    '''
+    Set the bits of every row of hashes in a packed bit buffer.
+    Returns, for each row, whether it was already present before being added.
+    Rows are processed in order so duplicates inside a batch are reported.
+    '''
+    cdef Py_ssize_t n = hashes.shape[0]
+    cdef Py_ssize_t nbr_slices = hashes.shape[1]
+    cdef Py_ssize_t i, j
+    cdef uint64_t index
+    result = np.ones(n, dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    with nogil:
+        for i in range(n):
+            for j in range(nbr_slices):
+                index = j * bits_per_slice + hashes[i, j]
+                if not test_bit(&bits[0], index) and not set_bit(&bits[0], index):
+                    found[i] = 0
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def bloom_add_key(uint8_t[::1] bits, list hashes, uint64_t bits_per_slice):
+    '''
+    Set the bits of a single key's hashes. Returns whether the key was already present.
+    '''
+    cdef Py_ssize_t j
+    cdef uint64_t index
+    cdef bint present = True
+    for j in range(len(hashes)):
+        index = j * bits_per_slice + <uint64_t> hashes[j]
+        if not test_bit(&bits[0], index) and not set_bit(&bits[0], index):
+            present = False
+    return present
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def countdown_check(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice):
+    '''
+    Membership test of a single key's hashes against countdown cells
+    '''
+    cdef Py_ssize_t j
+    for j in range(len(hashes)):
+        if cells[j * bits_per_slice + <uint64_t> hashes[j]] == 0:
+            return False
+    return True
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def countdown_set(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice, uint8_t value):
+    '''
+    Set the cells of a single key's hashes to value
+    '''
+    cdef Py_ssize_t j
+    for j in range(len(hashes)):
+        cells[j * bits_per_slice + <uint64_t> hashes[j]] = value
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def countdown_touch(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice, uint8_t value):
+    '''
+    Reset the cells of a single key's hashes to value if the key is present.
+    Returns whether the key was present; cells are left untouched otherwise.
+    '''
+    cdef Py_ssize_t j
+    cdef Py_ssize_t nbr_slices = len(hashes)
+    cdef uint64_t index[64]
+    if nbr_slices > 64:
+        if not countdown_check(cells, hashes, bits_per_slice):
+            return False
+        countdown_set(cells, hashes, bits_per_slice, value)
+        return True
+    for j in range(nbr_slices):
+        index[j] = j * bits_per_slice + <uint64_t> hashes[j]
+        if cells[index[j]] == 0:
+            return False
+    for j in range(nbr_slices):
+        cells[index[j]] = value
+    return True
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def countdown_contains(uint8_t[::1] cells, const uint64_t[:, ::1] hashes,
+                       uint64_t bits_per_slice):
+    '''
+    Membership test of every row of hashes against countdown cells
+    '''
+    cdef Py_ssize_t n = hashes.shape[0]
+    cdef Py_ssize_t nbr_slices = hashes.shape[1]
+    cdef Py_ssize_t i, j
+    result = np.ones(n, dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    with nogil:
+        for i in range(n):
+            for j in range(nbr_slices):
+                if cells[j * bits_per_slice + hashes[i, j]] == 0:
+                    found[i] = 0
+                    break
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def countdown_add(uint8_t[::1] cells, const uint64_t[:, ::1] hashes,
+                  uint64_t bits_per_slice, uint8_t value, bint skip_check,
+                  long long room):
+    '''
+    Insert or touch every row of hashes, in order, setting their cells to value.
+
+    room is the number of new keys that can be inserted before the filter is
+    at capacity (-1 for no limit). Processing stops at the first new key that
+    does not fit. Returns the per-row "already present" flags of the rows that
+    were processed and the number of newly inserted keys.
+    '''
+    cdef Py_ssize_t n = hashes.shape[0]
+    cdef Py_ssize_t nbr_slices = hashes.shape[1]
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t processed = n
+    cdef long long inserted = 0
+    cdef bint present
+    result = np.zeros(n, dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    with nogil:
+        for i in range(n):
+            present = False
+            if not skip_check:
+                present = True
+                for j in range(nbr_slices):
+                    if cells[j * bits_per_slice + hashes[i, j]] == 0:
+                        present = False
+                        break
+            if not present:
+                if room >= 0 and inserted >= room:
+                    processed = i
+                    break
+                inserted += 1
+            found[i] = present
+            for j in range(nbr_slices):
+                cells[j * bits_per_slice + hashes[i, j]] = value
+    return result[:processed], inserted
+
+
+# Counting Bloom filters: 4-bit counters, two per byte, the even counter in the
+# high nibble. Counters saturate at 15 and then stick: their true value is lost.
+cdef uint8_t COUNTER_MAX = 15
+
+
+cdef inline uint8_t get_counter(uint8_t *cells, uint64_t index) noexcept nogil:
+    return (cells[index >> 1] >> (4 - 4 * (index & 1))) & 0xf
+
+
+cdef inline void add_counter(uint8_t *cells, uint64_t index, int delta) noexcept nogil:
+    cdef uint8_t counter = get_counter(cells, index)
+    if counter == COUNTER_MAX:
+        return
+    cells[index >> 1] += <uint8_t> (delta << (4 - 4 * (index & 1)))
+
+
+cdef inline bint counting_probe(uint8_t *cells, const uint64_t *hashes, Py_ssize_t nbr_slices,
+                                uint64_t bits_per_slice, int delta) noexcept nogil:
+    '''
+    Check the counters of a key, then add delta (1, -1 or 0) to them. A
+    removal (-1) only happens if the key is present. Returns whether the key
+    was present.
+    '''
+    cdef Py_ssize_t j
+    cdef bint present = True
+    for j in range(nbr_slices):
+        if get_counter(cells, j * bits_per_slice + hashes[j]) == 0:
+            present = False
+            break
+    if delta > 0 or (delta < 0 and present):
+        for j in range(nbr_slices):
+            add_counter(cells, j * bits_per_slice + hashes[j], delta)
+    return present
+
+
+cdef bint counting_key(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice, int delta) except -1:
+    cdef Py_ssize_t j
+    cdef Py_ssize_t nbr_slices = len(hashes)
+    cdef uint64_t values[64]
+    if nbr_slices > 64:
+        raise ValueError("at most 64 hash functions")
+    for j in range(nbr_slices):
+        values[j] = hashes[j]
+    return counting_probe(&cells[0], values, nbr_slices, bits_per_slice, delta)
+
+
+def counting_check(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice):
+    '''
+    Membership test of a single key's hashes against 4-bit counters
+    '''
+    return counting_key(cells, hashes, bits_per_slice, 0)
+
+
+def counting_increment(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice):
+    '''
+    Increment the counters of a single key, returning whether it was already present
+    '''
+    return counting_key(cells, hashes, bits_per_slice, 1)
+
+
+def counting_decrement(uint8_t[::1] cells, list hashes, uint64_t bits_per_slice):
+    '''
+    Decrement the counters of a single key if it is present, returning whether it was
+    '''
+    return counting_key(cells, hashes, bits_per_slice, -1)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def counting_update(uint8_t[::1] cells, const uint64_t[:, ::1] hashes,
+                    uint64_t bits_per_slice, int delta):
+    '''
+    Check, then add delta (1, -1 or 0) to the counters of every row of hashes,
+    in order. Rows are only removed (-1) if present. Returns, for each row,
+    whether it was present before being updated.
+    '''
+    cdef Py_ssize_t i
+    cdef Py_ssize_t nbr_slices = hashes.shape[1]
+    result = np.empty(hashes.shape[0], dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    if hashes.shape[0] == 0:
+        return result
+    with nogil:
+        for i in range(hashes.shape[0]):
+            found[i] = counting_probe(&cells[0], &hashes[i, 0], nbr_slices, bits_per_slice, delta)
+    return result
+
+
+# Cuckoo filters: buckets of fingerprints (0 marks an empty slot), partial-key
+# cuckoo hashing: the alternate bucket of a fingerprint f in bucket i is
+# (hash(f) - i) mod nbr_buckets, so either bucket can be computed from the
+# other, whatever the number of buckets. Fingerprints of bits bits are packed
+# back to back, slot s of bucket i at bit (i * bucket_size + s) * bits of the
+# table, which has 7 bytes of padding for the unaligned 64-bit accesses.
+cdef struct CuckooTable:
+    uint8_t *slots
+    uint64_t nbr_buckets
+    Py_ssize_t bucket_size
+    int bits
+    uint64_t mask
+
+
+cdef inline CuckooTable cuckoo_table(uint8_t[::1] table, uint64_t nbr_buckets, Py_ssize_t bucket_size, int bits):
+    cdef CuckooTable t
+    if bits < 1 or bits > 57 or <uint64_t> table.shape[0] * 8 < nbr_buckets * bucket_size * bits + 56:
+        raise ValueError("cuckoo table too small for its geometry")
+    t.slots = &table[0]
+    t.nbr_buckets = nbr_buckets
+    t.bucket_size = bucket_size
+    t.bits = bits
+    t.mask = (1ULL << bits) - 1
+    return t
+
+
+cdef inline uint64_t slot_get(CuckooTable *t, uint64_t slot) noexcept nogil:
+    cdef uint64_t position = slot * t.bits
+    return (probably_load64(t.slots + (position >> 3)) >> (position & 7)) & t.mask
+
+
+cdef inline void slot_set(CuckooTable *t, uint64_t slot, uint64_t fingerprint) noexcept nogil:
+    cdef uint64_t position = slot * t.bits
+    cdef uint8_t *p = t.slots + (position >> 3)
+    cdef int shift = position & 7
+    probably_store64(p, (probably_load64(p) & ~(t.mask << shift)) | (fingerprint << shift))
+
+
+cdef inline void cuckoo_locate(CuckooTable *t, uint64_t h1, uint64_t h2,
+                               uint64_t *bucket, uint64_t *fingerprint) noexcept nogil:
+    bucket[0] = probably_fastrange64(h1, t.nbr_buckets)
+    fingerprint[0] = h2 & t.mask
+    if fingerprint[0] == 0:
+        fingerprint[0] = 1
+
+
+cdef inline uint64_t cuckoo_alternate(uint64_t bucket, uint64_t fingerprint, uint64_t nbr_buckets) noexcept nogil:
+    cdef uint64_t offset = probably_fastrange64(fmix64(fingerprint), nbr_buckets)
+    return offset - bucket if offset >= bucket else offset + nbr_buckets - bucket
+
+
+cdef inline Py_ssize_t cuckoo_find(CuckooTable *t, uint64_t bucket, uint64_t fingerprint) noexcept nogil:
+    ''' Slot of fingerprint in bucket, -1 if absent '''
+    cdef Py_ssize_t j
+    for j in range(t.bucket_size):
+        if slot_get(t, bucket * t.bucket_size + j) == fingerprint:
+            return bucket * t.bucket_size + j
+    return -1
+
+
+cdef inline bint cuckoo_put(CuckooTable *t, uint64_t bucket, uint64_t fingerprint) noexcept nogil:
+    cdef Py_ssize_t slot = cuckoo_find(t, bucket, 0)
+    if slot < 0:
+        return False
+    slot_set(t, slot, fingerprint)
+    return True
+
+
+cdef int cuckoo_probe(CuckooTable *t, uint64_t h1, uint64_t h2, int action,
+                      Py_ssize_t max_kicks, bint duplicates, Py_ssize_t *path) noexcept nogil:
+    '''
+    action 0 tests membership, 1 inserts the key's fingerprint, -1 removes one
+    copy of it. Returns 1 if the key was present (before being inserted), 0
+    otherwise, and -1 when an insertion failed after max_kicks relocations
+    (the relocations are then undone, leaving the filter as it was).
+    Fingerprints already present are only inserted again with duplicates:
+    another key may share them, and removing it must leave a copy for this
+    one. path must have room for max_kicks slot positions.
+    '''
+    cdef uint64_t bucket, fingerprint, alternate, evicted
+    cdef Py_ssize_t kick, slot
+    cdef uint64_t state
+    cdef int present
+    cuckoo_locate(t, h1, h2, &bucket, &fingerprint)
+    alternate = cuckoo_alternate(bucket, fingerprint, t.nbr_buckets)
+    slot = cuckoo_find(t, bucket, fingerprint)
+    if slot < 0:
+        slot = cuckoo_find(t, alternate, fingerprint)
+    if action == -1:
+        if slot < 0:
+            return 0
+        slot_set(t, slot, 0)
+        return 1
+    present = slot >= 0
+    if action == 0 or (present and not duplicates):
+        return present
+    if cuckoo_put(t, bucket, fingerprint) or cuckoo_put(t, alternate, fingerprint):
+        return present
+    # Both buckets are full: kick a random fingerprint of one of them to its
+    # alternate bucket, and so on. The victims are picked by a xorshift seeded
+    # by the key hash, so that insertions are deterministic.
+    state = h2 | 1
+    if h2 & (1ULL << 63):
+        bucket = alternate
+    for kick in range(max_kicks):
+        state ^= state << 13
+        state ^= state >> 7
+        state ^= state << 17
+        slot = bucket * t.bucket_size + <Py_ssize_t> (state % <uint64_t> t.bucket_size)
+        path[kick] = slot
+        evicted = slot_get(t, slot)
+        slot_set(t, slot, fingerprint)
+        fingerprint = evicted
+        bucket = cuckoo_alternate(bucket, fingerprint, t.nbr_buckets)
+        if cuckoo_put(t, bucket, fingerprint):
+            return present
+    # Undo the relocations, the last victim going back to its slot
+    for kick in range(max_kicks - 1, -1, -1):
+        slot = path[kick]
+        evicted = slot_get(t, slot)
+        slot_set(t, slot, fingerprint)
+        fingerprint = evicted
+    return -1
+
+
+cdef void cuckoo_key_hash(key, uint64_t *h):
+    cdef bytes encoded = encode_key(key)
+    murmur3_x64_128(<const uint8_t *> (<char *> encoded), len(encoded), 0, h)
+
+
+def cuckoo_key(uint8_t[::1] table, uint64_t nbr_buckets, Py_ssize_t bucket_size, int bits,
+               key, int action, Py_ssize_t max_kicks, bint duplicates=False):
+    '''
+    Test (action 0), insert (1) or remove (-1) a single key, see cuckoo_probe
+    '''
+    cdef CuckooTable t = cuckoo_table(table, nbr_buckets, bucket_size, bits)
+    cdef uint64_t h[2]
+    cdef Py_ssize_t *path = NULL
+    cdef int result
+    cuckoo_key_hash(key, h)
+    if action == 1:
+        path = <Py_ssize_t *> malloc(max(max_kicks, 1) * sizeof(Py_ssize_t))
+        if path == NULL:
+            raise MemoryError()
+    result = cuckoo_probe(&t, h[0], h[1], action, max_kicks, duplicates, path)
+    free(path)
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def cuckoo_update(uint8_t[::1] table, uint64_t nbr_buckets, Py_ssize_t bucket_size, int bits,
+                  const uint64_t[:, ::1] hashes, int action, Py_ssize_t max_kicks, bint duplicates=False):
+    '''
+    Test (action 0), insert (1) or remove (-1) every row of hashes (see
+    hash128_many), in order. Returns, for each processed row, whether the key
+    was present, and whether processing stopped at a row that could not be
+    inserted (the rows after it are not processed).
+    '''
+    cdef CuckooTable t = cuckoo_table(table, nbr_buckets, bucket_size, bits)
+    cdef Py_ssize_t n = hashes.shape[0]
+    cdef Py_ssize_t i
+    cdef Py_ssize_t processed = n
+    cdef int result
+    cdef Py_ssize_t *path = <Py_ssize_t *> malloc(max(max_kicks, 1) * sizeof(Py_ssize_t))
+    if path == NULL:
+        raise MemoryError()
+    found = np.zeros(n, dtype=np.bool_)
+    cdef uint8_t[::1] found_view = found.view(np.uint8)
+    try:
+        with nogil:
+            for i in range(n):
+                result = cuckoo_probe(&t, hashes[i, 0], hashes[i, 1], action, max_kicks, duplicates, path)
+                if result < 0:
+                    processed = i
+                    break
+                found_view[i] = result
+    finally:
+        free(path)
+    return found[:processed], processed < n
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def cuckoo_fingerprints(uint8_t[::1] table, uint64_t nbr_buckets, Py_ssize_t bucket_size, int bits):
+    '''
+    Unpacked fingerprints of a cuckoo table, as a (nbr_buckets, bucket_size) uint64 array
+    '''
+    cdef CuckooTable t = cuckoo_table(table, nbr_buckets, bucket_size, bits)
+    cdef uint64_t slot
+    result = np.empty((nbr_buckets, bucket_size), dtype=np.uint64)
+    cdef uint64_t[:, ::1] out = result
+    with nogil:
+        for slot in range(nbr_buckets * bucket_size):
+            out[slot // bucket_size, slot % bucket_size] = slot_get(&t, slot)
+    return result
+
+
+
+cdef inline uint8_t hll_rho(uint64_t w, int b) noexcept nogil:
+    ''' Position of the least significant set bit of w (1-based), w having 64 - b bits '''
+    if w == 0:
+        return 64 - b + 1
+    return probably_ctz64(w) + 1
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def hll_add(uint8_t[::1] registers, key, int b):
+    '''
+    Add a single key to HyperLogLog registers
+    '''
+    cdef bytes encoded = encode_key(key)
+    cdef uint64_t x = hash64_c(<const uint8_t *> (<char *> encoded), len(encoded), 0)
+    cdef uint64_t j = x & ((1ULL << b) - 1)
+    cdef uint8_t rho = hll_rho(x >> b, b)
+    if registers[j] < rho:
+        registers[j] = rho
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def hll_hash_many(keys, int b):
+    '''
+    Hash a sequence of keys for a HyperLogLog with 2 ** b registers.
+    Returns the register indexes (intp) and their rho values (uint8).
+    '''
+    cdef EncodedKeys encoded = EncodedKeys(keys)
+    cdef Py_ssize_t i
+    cdef uint64_t x
+    indexes = np.empty(encoded.n, dtype=np.intp)
+    rhos = np.empty(encoded.n, dtype=np.uint8)
+    cdef Py_ssize_t[::1] index_view = indexes
+    cdef uint8_t[::1] rho_view = rhos
+    with nogil:
+        for i in range(encoded.n):
+            x = hash64_c(encoded.data[i], encoded.lengths[i], 0)
+            index_view[i] = <Py_ssize_t> (x & ((1ULL << b) - 1))
+            rho_view[i] = hll_rho(x >> b, b)
+    return indexes, rhos
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def hll_hash_digests(const uint64_t[:, ::1] digests, int b):
+    '''
+    hll_hash_many for pre-hashed keys (128-bit digests, see hash128_many)
+    '''
+    cdef Py_ssize_t i
+    cdef uint64_t x
+    indexes = np.empty(digests.shape[0], dtype=np.intp)
+    rhos = np.empty(digests.shape[0], dtype=np.uint8)
+    cdef Py_ssize_t[::1] index_view = indexes
+    cdef uint8_t[::1] rho_view = rhos
+    with nogil:
+        for i in range(digests.shape[0]):
+            # Same as hash64_c: the first half of the 128-bit hash, byte-swapped
+            x = bswap64(digests[i, 0])
+            index_view[i] = <Py_ssize_t> (x & ((1ULL << b) - 1))
+            rho_view[i] = hll_rho(x >> b, b)
+    return indexes, rhos
+
+
+def hll_hash(key, int b):
+    '''
+    Hash a single key for a HyperLogLog with 2 ** b registers.
+    Returns its register index and rho value.
+    '''
+    cdef bytes encoded = encode_key(key)
+    cdef uint64_t x = hash64_c(<const uint8_t *> (<char *> encoded), len(encoded), 0)
+    return <Py_ssize_t> (x & ((1ULL << b) - 1)), hll_rho(x >> b, b)
+
+
+# Seed of the routing hash used by sharded structures, distinct from the seeds
+# of the structure hashes so that the shard of a key says nothing about its indexes.
+cdef uint64_t SHARD_SEED = 0x9747b28c
+
+
+cdef inline Py_ssize_t digest_shard(uint64_t h2, uint64_t nbr_shards) noexcept nogil:
+    '''
+    Shards are taken from the digest, so that keys and their digests are routed
+    alike. h2 is remixed: the structures derive their indexes from both halves.
+    '''
+    return <Py_ssize_t> probably_fastrange64(fmix64(h2 ^ SHARD_SEED), nbr_shards)
+
+
+def shard_one(key, uint64_t nbr_shards):
+    '''
+    Shard of a single key among nbr_shards
+    '''
+    cdef bytes encoded = encode_key(key)
+    cdef uint64_t h[2]
+    murmur3_x64_128(<const uint8_t *> (<char *> encoded), len(encoded), 0, h)
+    return digest_shard(h[1], nbr_shards)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def shard_many(keys, uint64_t nbr_shards):
+    '''
+    Shards of a sequence of keys among nbr_shards, as an intp array
+    '''
+    cdef EncodedKeys encoded = EncodedKeys(keys)
+    cdef Py_ssize_t i
+    cdef uint64_t h[2]
+    result = np.empty(encoded.n, dtype=np.intp)
+    cdef Py_ssize_t[::1] out = result
+    with nogil:
+        for i in range(encoded.n):
+            murmur3_x64_128(encoded.data[i], encoded.lengths[i], 0, h)
+            out[i] = digest_shard(h[1], nbr_shards)
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def shard_digests(const uint64_t[:, ::1] digests, uint64_t nbr_shards):
+    '''
+    Shards of (n, 2) digests among nbr_shards, as an intp array: the same as
+    shard_many() of the keys they were computed from
+    '''
+    cdef Py_ssize_t i
+    result = np.empty(digests.shape[0], dtype=np.intp)
+    cdef Py_ssize_t[::1] out = result
+    with nogil:
+        for i in range(digests.shape[0]):
+            out[i] = digest_shard(digests[i, 1], nbr_shards)
+    return result
+
+
+# Blocked Bloom filters: 512-bit blocks (64 bytes, one cache line) of 8 words
+cdef uint64_t BLOCK_BITS = 512
+# Bulk probes prefetch the block of the key that many rows ahead
+cdef Py_ssize_t PREFETCH_DISTANCE = 8
+
+
+cdef inline uint64_t *blocked_block(uint64_t *words, uint64_t h1, uint64_t nbr_blocks) noexcept nogil:
+    return words + probably_fastrange64(h1, nbr_blocks) * 8
+
+
+cdef inline bint blocked_probe(uint64_t *words, uint64_t h1, uint64_t h2,
+                               uint64_t nbr_blocks, int nbr_hashes, bint insert) noexcept nogil:
+    '''
+    Test (and set, when insert is set) the bits of a key in its block: h1
+    picks the block and h2 the bits in it.
+    Returns whether all the bits were already set.
+    '''
+    cdef uint64_t *block = blocked_block(words, h1, nbr_blocks)
+    cdef uint64_t bits = h2
+    cdef uint64_t position, mask
+    cdef bint present = True
+    cdef int j
+    for j in range(nbr_hashes):
+        # 9 bits per position, 7 positions per 64-bit word: refill the word
+        # from h2 by remixing it when exhausted. Double hashing inside such a
+        # small block correlates the keys and doubles the error rate.
+        if j and j % 7 == 0:
+            bits = fmix64(h2 + <uint64_t> j * 0x9e3779b97f4a7c15ULL)
+        position = bits & (BLOCK_BITS - 1)
+        bits >>= 9
+        mask = 1ULL << (position & 63)
+        if not block[position >> 6] & mask:
+            present = False
+            if not insert:
+                return False
+            block[position >> 6] |= mask
+    return present
+
+
+cdef inline void blocked_key_hash(key, uint64_t *h):
+    cdef bytes encoded = encode_key(key)
+    murmur3_x64_128(<const uint8_t *> (<char *> encoded), len(encoded), 0, h)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def hash128_many(keys):
+    '''
+    128-bit murmur3 hashes (seed 0) of a sequence of keys, as a (len(keys), 2) uint64 array
+    '''
+    cdef EncodedKeys encoded = EncodedKeys(keys)
+    cdef Py_ssize_t i
+    result = np.empty((encoded.n, 2), dtype=np.uint64)
+    cdef uint64_t[:, ::1] out = result
+    with nogil:
+        for i in range(encoded.n):
+            murmur3_x64_128(encoded.data[i], encoded.lengths[i], 0, &out[i, 0])
+    return result
+
+
+def blocked_contains_key(uint64_t[::1] words, key, uint64_t nbr_blocks, int nbr_hashes):
+    '''
+    Membership test of a single key in a blocked Bloom filter
+    '''
+    cdef uint64_t h[2]
+    blocked_key_hash(key, h)
+    return blocked_probe(&words[0], h[0], h[1], nbr_blocks, nbr_hashes, False)
+
+
+def blocked_add_key(uint64_t[::1] words, key, uint64_t nbr_blocks, int nbr_hashes):
+    '''
+    Add a single key to a blocked Bloom filter, returning whether it was already present
+    '''
+    cdef uint64_t h[2]
+    blocked_key_hash(key, h)
+    return blocked_probe(&words[0], h[0], h[1], nbr_blocks, nbr_hashes, True)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def blocked_contains(uint64_t[::1] words, const uint64_t[:, ::1] hashes,
+                     uint64_t nbr_blocks, int nbr_hashes):
+    '''
+    Membership test of every row of hashes (see hash128_many) in a blocked Bloom filter
+    '''
+    cdef Py_ssize_t i
+    result = np.empty(hashes.shape[0], dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    with nogil:
+        for i in range(hashes.shape[0]):
+            if i + PREFETCH_DISTANCE < hashes.shape[0]:
+                probably_prefetch(blocked_block(&words[0], hashes[i + PREFETCH_DISTANCE, 0], nbr_blocks))
+            found[i] = blocked_probe(&words[0], hashes[i, 0], hashes[i, 1], nbr_blocks, nbr_hashes, False)
+    return result
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def blocked_add(uint64_t[::1] words, const uint64_t[:, ::1] hashes,
+                uint64_t nbr_blocks, int nbr_hashes):
+    '''
+    Add every row of hashes (see hash128_many) to a blocked Bloom filter, in order.
+    Returns, for each row, whether it was already present before being added.
+    '''
+    cdef Py_ssize_t i
+    result = np.empty(hashes.shape[0], dtype=np.bool_)
+    cdef uint8_t[::1] found = result.view(np.uint8)
+    with nogil:
+        for i in range(hashes.shape[0]):
+            if i + PREFETCH_DISTANCE < hashes.shape[0]:
+                probably_prefetch(blocked_block(&words[0], hashes[i + PREFETCH_DISTANCE, 0], nbr_blocks))
+            found[i] = blocked_probe(&words[0], hashes[i, 0], hashes[i, 1], nbr_blocks, nbr_hashes, True)
+    return result
@@ -1,9 +1,18 @@
 from __future__ import absolute_import, division, print_function
 
+import struct
+
 import numpy as np
 
-from .hashfunctions import generate_hashfunctions
+from .bulk import atomic_add, countdown_add, countdown_check, countdown_contains, countdown_set, countdown_touch
+from .hashfunctions import (CHAINED, HASH_SCHEMES, check_hash_scheme, generate_bulk_hashfunctions,
+                            generate_digest_hashfunctions, generate_hashfunctions)
 from .maintenance import maintenance
+from .serialization import COUNTDOWN_BLOOM_FILTER, array_from, pack, unpack
+
+# capacity, error_rate, expiration, nbr_bits, count, refresh_head, estimate_z, z,
+# disable_hard_capacity, hash scheme, counter_init
+COUNTDOWN_BLOOM_FILTER_PARAMS = struct.Struct('<dddQqQdd?BB5x')
 
 
 class CountdownBloomFilter(object):
@@ -15,7 +24,13 @@ class CountdownBloomFilter(object):
         http://www-mobile.ecs.soton.ac.uk/home/conference/ICC2012/symposia/papers/a_lightweight_algorithm_for_traffic_filtering_over_sliding__.pdf
     """
 
-    def __init__(self, capacity, error_rate=0.001, expiration=60, disable_hard_capacity=False):
+    def __init__(self, capacity, error_rate=0.001, expiration=60, disable_hard_capacity=False,
+                 hash_scheme=CHAINED):
+        self._configure(capacity, error_rate, expiration, disable_hard_capacity, hash_scheme)
+        self.cellarray = np.zeros(self.nbr_bits, dtype=np.uint8)
+
+    def _configure(self, capacity, error_rate, expiration, disable_hard_capacity, hash_scheme):
+        """ Everything but the cells """
         self.error_rate = error_rate
         self.capacity = capacity
         self.expiration = expiration
@@ -23,10 +38,12 @@ class CountdownBloomFilter(object):
         self.bits_per_slice = int(np.ceil((capacity * abs(np.log(error_rate))) / (self.nbr_slices * (np.log(2) ** 2))))
         self.nbr_bits = self.nbr_slices * self.bits_per_slice
         self.count = 0
-        self.cellarray = np.zeros(self.nbr_bits, dtype=np.uint8)
         self.counter_init = 255
         self.refresh_head = 0
-        self.make_hashes = generate_hashfunctions(self.bits_per_slice, self.nbr_slices)
+        self.hash_scheme = check_hash_scheme(hash_scheme)
+        self.make_hashes = generate_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
+        self.make_bulk_hashes = generate_bulk_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
+        self.make_digest_hashes = generate_digest_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
         # This is the unset ratio ... and we keep it constant at 0.5
         # since the BF will operate most of the time at his optimal
         # set ratio (50 %) and the overall effect of this parameter
@@ -34,6 +51,36 @@ class CountdownBloomFilter(object):
         self.z = 0.5
         self.estimate_z = 0
         self.disable_hard_capacity = disable_hard_capacity
+        # Set by sharedmem when the cells live in a buffer shared between processes:
+        # shared_count and shared_state hold the count and estimate_z of the
+        # filter for every process.
+        self.shared_memory = None
+        self.shared_count = None
+        self.shared_state = None
+
+    def _storage(self):
+        return self.cellarray
+
+    def _bind_storage(self, buffer):
+        """ Use buffer (e.g. shared memory, see sharedmem) as the cellarray storage """
+        self.cellarray = np.frombuffer(buffer, dtype=np.uint8)
+
+    def _pull_shared_state(self):
+        if self.shared_state is not None:
+            self.count = int(self.shared_count[0])
+            self.estimate_z = float(self.shared_state[0])
+
+    def _push_shared_state(self):
+        """ Publish the count re-estimated by the maintenance, and estimate_z """
+        if self.shared_state is not None:
+            self.shared_count[0] = self.count
+            self.shared_state[0] = self.estimate_z
+
+    def _add_count(self, delta):
+        if self.shared_count is None:
+            self.count += delta
+        else:
+            self.count = atomic_add(self.shared_count, delta)
 
     def _compute_z(self):
         """ Compute the unset ratio (exact) """
@@ -65,12 +112,28 @@ class CountdownBloomFilter(object):
             Cython version
         """
         num_iterations = self.num_batched_maintenance(elapsed_time)
+        self.run_maintenance(num_iterations)
+        processed_interval = num_iterations * self.compute_refresh_time()
+        return processed_interval
+
+    def run_maintenance(self, num_iterations):
+        """ Run num_iterations expiration_maintenance() steps at once """
+        self.update_estimate(self.decrement(num_iterations), num_iterations)
+
+    def decrement(self, num_iterations):
+        """ The decrements of run_maintenance() alone, leaving the count as is.
+            Returns the number of nonzero cells met, to pass on to
+            update_estimate() once enough steps are run (see MaintenanceScheduler).
+        """
         self.refresh_head, nonzero = maintenance(self.cellarray, self.nbr_bits, num_iterations, self.refresh_head)
+        return nonzero
+
+    def update_estimate(self, nonzero, num_iterations):
+        """ Re-estimate the count from nonzero cells met in num_iterations steps """
         if num_iterations != 0:
             self.estimate_z = float(nonzero) / float(num_iterations)
             self._estimate_count()
-        processed_interval = num_iterations * self.compute_refresh_time()
-        return processed_interval
+            self._push_shared_state()
 
     def compute_refresh_time(self):
         """ Compute the refresh period for the given expiration delay """
@@ -93,30 +156,100 @@ class CountdownBloomFilter(object):
             hashes = self.make_hashes(key)
         else:
             hashes = key
-        offset = 0
-        for k in hashes:
-            if self.cellarray[offset + k] == 0:
-                return False
-            offset += self.bits_per_slice
-        return True
+        return countdown_check(self.cellarray, hashes, self.bits_per_slice)
 
     def __len__(self):
         """ Return the number of keys stored by this bloom filter. """
+        self._pull_shared_state()
         return self.count
 
     def add(self, key, skip_check=False):
         hashes = self.make_hashes(key)
-        if not skip_check and hashes in self:
-            offset = 0
-            for k in hashes:
-                self.cellarray[offset + k] = self.counter_init
-                offset += self.bits_per_slice
+        if not skip_check and countdown_touch(self.cellarray, hashes, self.bits_per_slice, self.counter_init):
             return True
+        self._pull_shared_state()
         if (self.count > self.capacity or self.estimate_z > 0.5) and not self.disable_hard_capacity:
             raise IndexError("BloomFilter is at capacity")
-        offset = 0
-        for k in hashes:
-            self.cellarray[offset + k] = self.counter_init
-            offset += self.bits_per_slice
-        self.count += 1
+        countdown_set(self.cellarray, hashes, self.bits_per_slice, self.counter_init)
+        self._add_count(1)
         return False
+
+    def contains_many(self, keys):
+        """ Check the membership of a sequence of keys.
+
+            Returns a NumPy boolean array, True where the key is (probably) in the set.
+        """
+        return countdown_contains(self.cellarray, self.make_bulk_hashes(keys), self.bits_per_slice)
+
+    def contains_digests(self, digests):
+        """ contains_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+        """
+        return countdown_contains(self.cellarray, self.make_digest_hashes(digests), self.bits_per_slice)
+
+    def _room(self):
+        """ Number of new keys that can be inserted before reaching capacity (-1 if unlimited) """
+        if self.disable_hard_capacity:
+            return -1
+        if self.estimate_z > 0.5:
+            return 0
+        return max(self.capacity - self.count + 1, 0)
+
+    def add_many(self, keys, skip_check=False, stop_at_capacity=False, processed=None):
+        """ Add (or touch) a sequence of keys, in order.
+
+            Returns a NumPy boolean array with the same meaning as the return value
+            of add(): True where the key was already present. Like add(), raises
+            IndexError at the first new key that does not fit; the keys before it
+            are kept. With stop_at_capacity, stops there instead and returns the
+            array for the keys before it only. processed, a boolean array of one
+            item per key, is set to True for the keys added or touched.
+        """
+        return self._add_rows(self.make_bulk_hashes(keys), skip_check, stop_at_capacity, processed)
+
+    def add_digests(self, digests, skip_check=False, stop_at_capacity=False, processed=None):
+        """ add_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+        """
+        return self._add_rows(self.make_digest_hashes(digests), skip_check, stop_at_capacity, processed)
+
+    def _add_rows(self, hashes, skip_check, stop_at_capacity, processed):
+        self._pull_shared_state()
+        found, inserted = countdown_add(self.cellarray, hashes, self.bits_per_slice,
+                                        self.counter_init, skip_check, self._room())
+        self._add_count(inserted)
+        if processed is not None:
+            processed[:found.shape[0]] = True
+        if found.shape[0] < hashes.shape[0] and not stop_at_capacity:
+            raise IndexError("BloomFilter is at capacity")
+        return found
+
+    def to_bytes(self, compress=False):
+        """ Serialize to a versioned binary format: parameters and maintenance state
+            (refresh_head, estimate_z...) header, then the raw cells.
+        """
+        self._pull_shared_state()
+        params = (self.capacity, self.error_rate, self.expiration, self.nbr_bits, self.count,
+                  self.refresh_head, self.estimate_z, self.z, self.disable_hard_capacity,
+                  HASH_SCHEMES.index(self.hash_scheme), self.counter_init)
+        return pack(COUNTDOWN_BLOOM_FILTER, COUNTDOWN_BLOOM_FILTER_PARAMS, params, [self.cellarray], compress)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Load what to_bytes() wrote. The cells share the memory of data when it
+            is writable (bytearray, mmap...) and not compressed.
+        """
+        params, payload = unpack(data, COUNTDOWN_BLOOM_FILTER, COUNTDOWN_BLOOM_FILTER_PARAMS)
+        (capacity, error_rate, expiration, nbr_bits, count, refresh_head, estimate_z, z,
+         disable_hard_capacity, scheme, counter_init) = params
+        cdbf = cls.__new__(cls)
+        cdbf._configure(capacity, error_rate, expiration, disable_hard_capacity, HASH_SCHEMES[scheme])
+        if cdbf.nbr_bits != nbr_bits:
+            raise ValueError("Serialized CountdownBloomFilter geometry does not match its parameters")
+        cdbf.cellarray = array_from(payload, np.uint8, nbr_bits)
+        cdbf.count = count
+        cdbf.refresh_head = refresh_head
+        cdbf.estimate_z = estimate_z
+        cdbf.z = z
+        cdbf.counter_init = counter_init
+        return cdbf
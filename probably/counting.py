@@ -0,0 +1,111 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from .bulk import counting_check, counting_decrement, counting_increment, counting_update
+from .hashfunctions import (CHAINED, check_hash_scheme, generate_bulk_hashfunctions,
+                            generate_digest_hashfunctions, generate_hashfunctions)
+
+
+class CountingBloomFilter(object):
+    """ Bloom Filter supporting removals, with 4-bit counters instead of bits.
+
+        Same slices and hash functions as BloomFilter. The counters are packed
+        two per byte (half the memory of CountdownBloomFilter cells) and
+        saturate at 15: a saturated counter is never decremented again, so
+        removals can not cause false negatives, as long as only added keys are
+        removed. Removing a key that was not added (but shows as a false
+        positive) does cause false negatives.
+
+        Fan, Li, et al. "Summary cache: a scalable wide-area web cache sharing protocol."
+        IEEE/ACM Transactions on Networking 8.3 (2000).
+    """
+
+    def __init__(self, capacity, error_rate, hash_scheme=CHAINED):
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.nbr_slices = int(np.ceil(np.log2(1.0 / error_rate)))
+        self.bits_per_slice = int(np.ceil((capacity * abs(np.log(error_rate))) / (self.nbr_slices * (np.log(2) ** 2))))
+        self.nbr_bits = self.nbr_slices * self.bits_per_slice
+        self.cellarray = np.zeros((self.nbr_bits + 1) // 2, dtype=np.uint8)
+        self.count = 0
+        self.hash_scheme = check_hash_scheme(hash_scheme)
+        self.make_hashes = generate_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
+        self.make_bulk_hashes = generate_bulk_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
+        self.make_digest_hashes = generate_digest_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
+
+    def counters(self):
+        """ The nbr_bits counters, unpacked in a new uint8 array """
+        counters = np.empty(self.cellarray.size * 2, dtype=np.uint8)
+        counters[0::2] = self.cellarray >> 4
+        counters[1::2] = self.cellarray & 0xf
+        return counters[:self.nbr_bits]
+
+    def __contains__(self, key):
+        return counting_check(self.cellarray, self.make_hashes(key), self.bits_per_slice)
+
+    def __len__(self):
+        """ Return the number of keys stored by this bloom filter. """
+        return self.count
+
+    def add(self, key):
+        """ Add one occurrence of key. Returns whether it was already present. """
+        self.count += 1
+        return counting_increment(self.cellarray, self.make_hashes(key), self.bits_per_slice)
+
+    def remove(self, key):
+        """ Remove one occurrence of key. Returns whether it was present (and removed). """
+        if counting_decrement(self.cellarray, self.make_hashes(key), self.bits_per_slice):
+            self.count -= 1
+            return True
+        return False
+
+    def contains_many(self, keys):
+        """ Check the membership of a sequence of keys.
+
+            Returns a NumPy boolean array, True where the key is (probably) in the set.
+        """
+        return counting_update(self.cellarray, self.make_bulk_hashes(keys), self.bits_per_slice, 0)
+
+    def contains_digests(self, digests):
+        """ contains_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+        """
+        return counting_update(self.cellarray, self.make_digest_hashes(digests), self.bits_per_slice, 0)
+
+    def add_many(self, keys):
+        """ Add a sequence of keys, in order.
+
+            Returns a NumPy boolean array with the same meaning as the return value
+            of add(): True where the key was already present.
+        """
+        return self._add_rows(self.make_bulk_hashes(keys))
+
+    def add_digests(self, digests):
+        """ add_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+        """
+        return self._add_rows(self.make_digest_hashes(digests))
+
+    def _add_rows(self, hashes):
+        found = counting_update(self.cellarray, hashes, self.bits_per_slice, 1)
+        self.count += found.size
+        return found
+
+    def remove_many(self, keys):
+        """ Remove a sequence of keys, in order.
+
+            Returns a NumPy boolean array, True where the key was present (and removed).
+        """
+        return self._remove_rows(self.make_bulk_hashes(keys))
+
+    def remove_digests(self, digests):
+        """ remove_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+        """
+        return self._remove_rows(self.make_digest_hashes(digests))
+
+    def _remove_rows(self, hashes):
+        removed = counting_update(self.cellarray, hashes, self.bits_per_slice, -1)
+        self.count -= int(np.count_nonzero(removed))
+        return removed
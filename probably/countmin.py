@@ -1,59 +1,454 @@
 from __future__ import absolute_import, division, print_function
 
-import heapq
+import base64
+import copy
+import json
 import sys
 import random
+import struct
 
 import numpy as np
 
-from .hashfunctions import generate_hashfunctions
+from .hashfunctions import (CHAINED, HASH_SCHEMES, check_hash_scheme, digests_array,
+                            generate_bulk_hashfunctions, generate_digest_hashfunctions, generate_hashfunctions)
+from .serialization import COUNT_MIN_SKETCH, WINDOWED_COUNT_MIN_SKETCH, array_from, pack, unpack
+
+# delta, epsilon, k, nbr_slices, nbr_bits, size of the top-k JSON, counter itemsize,
+# hash scheme, conservative
+COUNT_MIN_SKETCH_PARAMS = struct.Struct('<ddQQQQBB?5x')
+# Same fields, then window, nbr_panes, head
+WINDOWED_COUNT_MIN_SKETCH_PARAMS = struct.Struct('<ddQQQQBB?5xdQQ')
+
+
+def _encode_key(key):
+    """ JSON value of a top-k key: str, int and float as is, bytes tagged in an object """
+    if isinstance(key, bytes):
+        return {'bytes': base64.b64encode(key).decode('ascii')}
+    if isinstance(key, (str, int, float)):
+        return key
+    raise TypeError("Cannot serialize a top-k key of type %s (str, bytes, int or float expected)"
+                    % type(key).__name__)
+
+
+def _decode_key(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['bytes'])
+    return value
 
 
 class CountMinSketch(object):
-    """ Basic Count-Min Sketch """
+    """ Basic Count-Min Sketch
+
+        The top-k keys are tracked in a min-heap (self.heap) of [estimate, key]
+        pairs, indexed by key through self.top_k and self.heap_positions so that
+        the estimate of a tracked key can be changed in O(log k).
+
+        With conservative=True, an update only raises the counters of the key
+        that are below its new estimate (min + increment), which lowers the
+        overestimation for skewed streams. Increments must then be non-negative.
+
+        Estan, Cristian, and George Varghese. "New directions in traffic measurement and accounting."
+        ACM SIGCOMM Computer Communication Review 32.4 (2002).
+    """
 
-    def __init__(self, delta, epsilon, k):
+    def __init__(self, delta, epsilon, k, hash_scheme=CHAINED, conservative=False):
+        self._configure(delta, epsilon, k, hash_scheme, conservative)
+        self.count = np.zeros((self.nbr_slices, self.nbr_bits), dtype=np.int32)
+
+    def _configure(self, delta, epsilon, k, hash_scheme, conservative):
+        """ Everything but the counters """
         self.nbr_bits = int(np.ceil(np.exp(1) / epsilon))
         self.nbr_slices = int(np.ceil(np.log(1 / delta)))
+        self.delta = delta
+        self.epsilon = epsilon
         self.k = k
-        self.count = np.zeros((self.nbr_slices, self.nbr_bits), dtype=np.int32)
+        self.conservative = conservative
         self.heap = []
         self.top_k = {}
-        self.make_hashes = generate_hashfunctions(self.nbr_bits, self.nbr_slices)
+        self.heap_positions = {}
+        self.rows = np.arange(self.nbr_slices)
+        self.hash_scheme = check_hash_scheme(hash_scheme)
+        self.make_hashes = generate_hashfunctions(self.nbr_bits, self.nbr_slices, hash_scheme)
+        self.make_bulk_hashes = generate_bulk_hashfunctions(self.nbr_bits, self.nbr_slices, hash_scheme)
+        self.make_digest_hashes = generate_digest_hashfunctions(self.nbr_bits, self.nbr_slices, hash_scheme)
 
     def update(self, key, increment):
-        for row, column in enumerate(self.make_hashes(key)):
-            self.count[int(row), int(column)] += increment
-        return self.update_heap(key)
+        columns = self.make_hashes(key)
+        if self.conservative:
+            if increment < 0:
+                raise ValueError("conservative update requires non-negative increments")
+            values = self.count[self.rows, columns]
+            estimate = values.min() + increment
+            self.count[self.rows, columns] = np.maximum(values, estimate)
+            return self._update_heap(key, estimate)
+        self._add_counts(columns, increment)
+        return self._update_heap(key, self.count[self.rows, columns].min())
+
+    def _add_counts(self, columns, increments):
+        """ Add increments (one per row of columns, or a scalar) to the counters """
+        np.add.at(self.count, (self.rows, columns), np.asarray(increments)[..., None].astype(self.count.dtype))
+
+    def update_many(self, keys, increments=1):
+        """ Update a batch of keys.
+
+            increments is either a scalar applied to every key or a sequence with
+            one increment per key. Repeated keys are aggregated, every distinct
+            key is hashed once and the counters are updated with np.add.at.
+            Returns the list of keys evicted from the top-k.
+
+            In conservative mode the whole batch is applied at once: every
+            counter of a key is raised to at least its pre-batch estimate plus
+            its total increment (np.maximum.at), so estimates never undercount.
+        """
+        keys = list(keys)
+        index = {}
+        inverse = np.fromiter((index.setdefault(key, len(index)) for key in keys),
+                              dtype=np.intp, count=len(keys))
+        unique_keys = list(index)
+        columns = self.make_bulk_hashes(unique_keys).astype(np.intp)
+        return self._update_columns(unique_keys, columns, self._totals(inverse, len(unique_keys), increments))
+
+    def update_digests(self, digests, increments=1, keys=None):
+        """ update_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+
+            The top-k needs the keys themselves: pass them along (one per
+            digest, else raises ValueError) to track it, otherwise only the
+            counters are updated.
+        """
+        digests = digests_array(digests)
+        if keys is None:
+            unique_keys = None
+            first, inverse = np.unique(digests.view('V16').ravel(), return_index=True, return_inverse=True)[1:]
+        else:
+            keys = list(keys)
+            if len(keys) != len(digests):
+                raise ValueError("update_digests got %d keys for %d digests" % (len(keys), len(digests)))
+            index = {}
+            inverse = np.fromiter((index.setdefault(key, len(index)) for key in keys),
+                                  dtype=np.intp, count=len(digests))
+            unique_keys = list(index)
+            first = np.unique(inverse, return_index=True)[1]
+        columns = self.make_digest_hashes(digests[first]).astype(np.intp)
+        return self._update_columns(unique_keys, columns, self._totals(inverse.ravel(), len(first), increments))
+
+    def _totals(self, inverse, nbr_unique, increments):
+        """ Sum of the increments of every distinct key """
+        increments = np.broadcast_to(np.asarray(increments), inverse.shape)
+        totals = np.zeros(nbr_unique, dtype=np.result_type(increments, self.count))
+        np.add.at(totals, inverse, increments)
+        return totals
+
+    def _update_columns(self, unique_keys, columns, totals):
+        """ Add totals to the counters of columns (one row per distinct key),
+            then track unique_keys (if not None) in the top-k.
+        """
+        if self.conservative:
+            if (totals < 0).any():
+                raise ValueError("conservative update requires non-negative increments")
+            targets = self.count[self.rows, columns].min(axis=1) + totals
+            np.maximum.at(self.count, (self.rows, columns), targets[:, None].astype(self.count.dtype))
+        else:
+            self._add_counts(columns, totals)
+        if unique_keys is None:
+            return []
+        estimates = self.count[self.rows, columns].min(axis=1)
+
+        candidates = range(len(unique_keys))
+        if len(self.heap) >= self.k and self.heap and (totals >= 0).all():
+            # Estimates can only have grown, so the heap minimum can only grow
+            # as well: keys below it now would be rejected anyway.
+            candidates = np.flatnonzero(estimates >= self.heap[0][0])
+        evicted = []
+        for i in candidates:
+            key = unique_keys[i]
+            poped = self._update_heap(key, estimates[i])
+            if poped is not None and poped != key:
+                evicted.append(poped)
+        return evicted
 
     def update_heap(self, key):
-        estimate = self.get(key)
-        poped = key
+        return self._update_heap(key, self.get(key))
+
+    def _update_heap(self, key, estimate):
         if key in self.top_k:
-            old_pair = self.top_k.get(key)
-            old_pair[0] = estimate
-            heapq.heapify(self.heap)
-            poped = None
-        else:
-            if len(self.top_k) < self.k:
-                heapq.heappush(self.heap, [estimate, key])
-                self.top_k[key] = [estimate, key]
-                poped = None
-            else:
-                new_pair = [estimate, key]
-                old_pair = heapq.heappushpop(self.heap, new_pair)
-                poped = old_pair[1]
-                if old_pair[1] in self.top_k:
-                    del self.top_k[old_pair[1]]
-                    self.top_k[key] = new_pair
-        return poped
+            pair = self.top_k[key]
+            old_estimate = pair[0]
+            pair[0] = estimate
+            if estimate > old_estimate:
+                self._sift_down(self.heap_positions[key])
+            elif estimate < old_estimate:
+                self._sift_up(self.heap_positions[key])
+            return None
+        new_pair = [estimate, key]
+        if len(self.top_k) < self.k:
+            self.heap.append(new_pair)
+            self.top_k[key] = new_pair
+            self.heap_positions[key] = len(self.heap) - 1
+            self._sift_up(len(self.heap) - 1)
+            return None
+        if not (self.heap and self.heap[0] < new_pair):
+            return key
+        old_pair = self.heap[0]
+        del self.top_k[old_pair[1]]
+        del self.heap_positions[old_pair[1]]
+        self.heap[0] = new_pair
+        self.top_k[key] = new_pair
+        self.heap_positions[key] = 0
+        self._sift_down(0)
+        return old_pair[1]
+
+    def _sift_up(self, pos):
+        heap = self.heap
+        pair = heap[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if not pair < heap[parent]:
+                break
+            heap[pos] = heap[parent]
+            self.heap_positions[heap[pos][1]] = pos
+            pos = parent
+        heap[pos] = pair
+        self.heap_positions[pair[1]] = pos
+
+    def _sift_down(self, pos):
+        heap = self.heap
+        size = len(heap)
+        pair = heap[pos]
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if not heap[child] < pair:
+                break
+            heap[pos] = heap[child]
+            self.heap_positions[heap[pos][1]] = pos
+            pos = child
+        heap[pos] = pair
+        self.heap_positions[pair[1]] = pos
 
     def get(self, key):
-        value = float('inf')
-        for row, column in enumerate(self.make_hashes(key)):
-            value = min(self.count[row, column], value)
-        return value
+        return self.count[self.rows, self.make_hashes(key)].min()
+
+    def get_many(self, keys):
+        """ Estimates of a sequence of keys, as a NumPy array """
+        return self.count[self.rows, self.make_bulk_hashes(keys).astype(np.intp)].min(axis=1)
+
+    def get_digests(self, digests):
+        """ get_many() for pre-hashed keys (see hashfunctions.digests_array).
+            Needs the DOUBLE hash scheme.
+        """
+        return self.count[self.rows, self.make_digest_hashes(digests).astype(np.intp)].min(axis=1)
+
+    def _check_compatible(self, other):
+        if (other.nbr_slices, other.nbr_bits) != (self.nbr_slices, self.nbr_bits):
+            raise ValueError("Cannot merge CountMinSketches of %dx%d and %dx%d counters" % (
+                self.nbr_slices, self.nbr_bits, other.nbr_slices, other.nbr_bits))
+        if other.hash_scheme != self.hash_scheme:
+            raise ValueError("Cannot merge CountMinSketches hashed with %s and %s" % (
+                self.hash_scheme, other.hash_scheme))
+        if other.conservative != self.conservative:
+            raise ValueError("Cannot merge a conservative update CountMinSketch with a standard one")
+
+    def merge(self, other, widen=False):
+        """ Add the counters of another sketch into this one, in place.
+
+            The top-k is rebuilt from the union of both tracked keys, estimated
+            on the merged counters. Raises OverflowError if the sum may not fit
+            the counters dtype, unless widen is set: counters are then widened
+            to int64 first. Both sketches must have the same geometry, hash
+            scheme and update mode (conservative or not), else raises ValueError.
+            A WindowedCountMinSketch merged into a plain sketch adds its running
+            sum.
+        """
+        return self._merge([other], widen)
+
+    @classmethod
+    def merge_many(cls, sketches, widen=False):
+        """ Returns a new sketch, the sum of all the given sketches """
+        sketches = list(sketches)
+        if not sketches:
+            raise ValueError("merge_many needs at least one CountMinSketch")
+        merged = copy.deepcopy(sketches[0])
+        return merged._merge(sketches[1:], widen)
+
+    def _merge(self, others, widen):
+        for other in others:
+            self._check_compatible(other)
+        if widen and self.count.dtype.itemsize < 8:
+            self.count = self.count.astype(np.int64)
+        info = np.iinfo(self.count.dtype)
+        sketches = [self] + others
+        if (sum(int(sketch.count.max()) for sketch in sketches) > info.max
+                or sum(int(sketch.count.min()) for sketch in sketches) < info.min):
+            raise OverflowError("Merged counters may overflow %s, use widen=True" % self.count.dtype)
+        for other in others:
+            np.add(self.count, other.count, out=self.count, casting='unsafe')
+
+        candidates = list(self.top_k)
+        for other in others:
+            candidates.extend(key for key in other.top_k if key not in self.top_k)
+        self._rebuild_heap(list(dict.fromkeys(candidates)))
+        return self
+
+    def _rebuild_heap(self, candidates):
+        """ Rebuild the top-k from candidates, estimated on the current counters """
+        self.heap = []
+        self.top_k = {}
+        self.heap_positions = {}
+        if candidates:
+            columns = self.make_bulk_hashes(candidates).astype(np.intp)
+            estimates = self.count[self.rows, columns].min(axis=1)
+            for key, estimate in zip(candidates, estimates):
+                self._update_heap(key, estimate)
+
+    def to_bytes(self, compress=False):
+        """ Serialize to a versioned binary format: parameters header, the raw
+            counters, then the top-k heap as JSON (so keys must be str, bytes, int or float).
+        """
+        heap = self._heap_json()
+        return pack(COUNT_MIN_SKETCH, COUNT_MIN_SKETCH_PARAMS, self._params(heap), [self.count, heap], compress)
+
+    def _heap_json(self):
+        return json.dumps([[int(estimate), _encode_key(key)] for estimate, key in self.heap]).encode('utf-8')
+
+    def _params(self, heap):
+        return (self.delta, self.epsilon, self.k, self.nbr_slices, self.nbr_bits, len(heap),
+                self.count.dtype.itemsize, HASH_SCHEMES.index(self.hash_scheme), self.conservative)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Load what to_bytes() wrote. The counters share the memory of data when
+            it is writable (bytearray, mmap...) and not compressed.
+        """
+        params, payload = unpack(data, COUNT_MIN_SKETCH, COUNT_MIN_SKETCH_PARAMS)
+        delta, epsilon, k, nbr_slices, nbr_bits, heap_size, itemsize, scheme, conservative = params
+        cms = cls.__new__(cls)
+        cms._configure(delta, epsilon, k, HASH_SCHEMES[scheme], conservative)
+        cms._load(payload, nbr_slices, nbr_bits, heap_size, itemsize)
+        return cms
+
+    def _load(self, payload, nbr_slices, nbr_bits, heap_size, itemsize, nbr_panes=0):
+        """ Counters, then the nbr_panes panes if any, then the top-k heap of a payload """
+        if (self.nbr_slices, self.nbr_bits) != (nbr_slices, nbr_bits):
+            raise ValueError("Serialized CountMinSketch geometry does not match its parameters")
+        dtype = np.dtype('<i%d' % itemsize)
+        self.count = array_from(payload, dtype, nbr_slices * nbr_bits).reshape(nbr_slices, nbr_bits)
+        offset = self.count.nbytes
+        if nbr_panes:
+            self.panes = array_from(payload, dtype, nbr_panes * nbr_slices * nbr_bits,
+                                    offset).reshape(nbr_panes, nbr_slices, nbr_bits)
+            offset += self.panes.nbytes
+        heap = payload[offset:offset + heap_size]
+        self.heap = [[dtype.type(estimate), _decode_key(key)]
+                     for estimate, key in json.loads(bytes(heap).decode('utf-8'))]
+        self.top_k = dict((pair[1], pair) for pair in self.heap)
+        self.heap_positions = dict((pair[1], position) for position, pair in enumerate(self.heap))
+
+
+class WindowedCountMinSketch(CountMinSketch):
+    """ Count-Min Sketch over a sliding time window
+
+        The window is split in nbr_panes panes, each one with its own counters
+        (self.panes, a ring indexed by self.head). Updates go to the current
+        pane and to self.count, the running sum of all the panes, so estimates
+        cost the same as with a plain CountMinSketch. The oldest panes expire
+        in batches through batched_expiration_maintenance(): their counters are
+        subtracted from the running sum at once, then reset.
+
+        The sketch therefore covers between window - window / nbr_panes and
+        window seconds of updates. Conservative updates are not supported: the
+        running sum of conservative panes would not be conservative.
+    """
+
+    def __init__(self, delta, epsilon, k, window, nbr_panes=8, hash_scheme=CHAINED):
+        if nbr_panes < 1:
+            raise ValueError("nbr_panes must be at least 1")
+        super(WindowedCountMinSketch, self).__init__(delta, epsilon, k, hash_scheme)
+        self._configure_window(window, nbr_panes)
+        self.panes = np.zeros((nbr_panes, self.nbr_slices, self.nbr_bits), dtype=self.count.dtype)
+
+    def _configure_window(self, window, nbr_panes):
+        self.window = window
+        self.nbr_panes = nbr_panes
+        self.pane_duration = window / nbr_panes
+        self.head = 0
+
+    def _add_counts(self, columns, increments):
+        super(WindowedCountMinSketch, self)._add_counts(columns, increments)
+        np.add.at(self.panes[self.head], (self.rows, columns),
+                  np.asarray(increments)[..., None].astype(self.panes.dtype))
+
+    def _check_compatible(self, other):
+        super(WindowedCountMinSketch, self)._check_compatible(other)
+        if isinstance(other, WindowedCountMinSketch) and \
+                (other.window, other.nbr_panes) != (self.window, self.nbr_panes):
+            raise ValueError("Cannot merge WindowedCountMinSketches of %d panes over %ss and %d panes over %ss" % (
+                self.nbr_panes, self.window, other.nbr_panes, other.window))
+
+    def _merge(self, others, widen):
+        """ Windowed sketches (with the same window and nbr_panes) are merged pane
+            by pane, aligned on their heads, so that their counts expire on the
+            same schedule. Plain sketches all land in the current pane.
+        """
+        super(WindowedCountMinSketch, self)._merge(others, widen)
+        self.panes = self.panes.astype(self.count.dtype, copy=False)
+        for other in others:
+            if isinstance(other, WindowedCountMinSketch):
+                np.add(self.panes, np.roll(other.panes, self.head - other.head, axis=0), out=self.panes,
+                       casting='unsafe')
+            else:
+                np.add(self.panes[self.head], other.count, out=self.panes[self.head], casting='unsafe')
+        return self
+
+    def num_batched_maintenance(self, elapsed_time):
+        return int(np.floor(elapsed_time / self.pane_duration))
+
+    def batched_expiration_maintenance(self, elapsed_time):
+        """ Expire the panes that elapsed_time went past, all at once.
+
+            Like CountdownBloomFilter.batched_expiration_maintenance(), returns
+            the processed interval: the caller carries the remainder over to
+            the next call. Tracked top-k estimates are refreshed afterwards.
+        """
+        num_panes = self.num_batched_maintenance(elapsed_time)
+        if num_panes == 0:
+            return 0.0
+        if num_panes >= self.nbr_panes:
+            self.panes[...] = 0
+            self.count[...] = 0
+        else:
+            expired = (self.head + 1 + np.arange(num_panes)) % self.nbr_panes
+            self.count -= self.panes[expired].sum(axis=0, dtype=self.count.dtype)
+            self.panes[expired] = 0
+        self.head = (self.head + num_panes) % self.nbr_panes
+        self._rebuild_heap(list(self.top_k))
+        return num_panes * self.pane_duration
+
+    def to_bytes(self, compress=False):
+        """ Like CountMinSketch.to_bytes(), with the window geometry and head in
+            the header and the panes after the running sum.
+        """
+        heap = self._heap_json()
+        params = self._params(heap) + (self.window, self.nbr_panes, self.head)
+        return pack(WINDOWED_COUNT_MIN_SKETCH, WINDOWED_COUNT_MIN_SKETCH_PARAMS, params,
+                    [self.count, self.panes, heap], compress)
 
+    @classmethod
+    def from_bytes(cls, data):
+        """ Load what to_bytes() wrote. Like CountMinSketch.from_bytes(), the
+            counters and panes share the memory of data when possible.
+        """
+        params, payload = unpack(data, WINDOWED_COUNT_MIN_SKETCH, WINDOWED_COUNT_MIN_SKETCH_PARAMS)
+        delta, epsilon, k, nbr_slices, nbr_bits, heap_size, itemsize, scheme, _, window, nbr_panes, head = params
+        cms = cls.__new__(cls)
+        cms._configure(delta, epsilon, k, HASH_SCHEMES[scheme], False)
+        cms._configure_window(window, nbr_panes)
+        cms._load(payload, nbr_slices, nbr_bits, heap_size, itemsize, nbr_panes)
+        cms.head = head
+        return cms
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function
+
+import struct
+
+import numpy as np
+
+from .bulk import cuckoo_fingerprints, cuckoo_key, cuckoo_update, hash128_many
+from .hashfunctions import digests_array
+from .serialization import CUCKOO_FILTER, array_from, pack, unpack
+
+# capacity, error_rate, nbr_buckets, count, max_kicks, bucket_size, fingerprint bits, allow_duplicates
+CUCKOO_FILTER_PARAMS = struct.Struct('<ddQQIBB?x')
+
+# Fraction of the slots that can be filled before insertions start failing
+# (about 95% with buckets of 4 fingerprints)
+LOAD_FACTOR = 0.95
+
+
+class CuckooFilter(object):
+    """ Cuckoo Filter: set membership with removals, from two bucket probes.
+
+        Every key is stored as a fingerprint in one of its two candidate
+        buckets of bucket_size slots, 0 marking empty slots. A lookup reads
+        those two buckets only, whatever the error rate. Fingerprints take
+        fingerprint_bits = ceil(log2(2 * bucket_size / error_rate)) bits and
+        are packed back to back in self.table, a uint8 array (fingerprints()
+        unpacks them).
+
+        Like BloomFilter.add(), add() leaves the filter unchanged when the key
+        is already (probably) present, and len() counts the distinct keys. A
+        key whose fingerprint is shared with another key of its buckets is
+        then not stored, and removing either key drops both. With
+        allow_duplicates, add() inserts a copy of the fingerprint every time
+        instead, so removing one of those keys keeps the other: a key added
+        twice must then be removed twice, can be added at most 2 * bucket_size
+        times, and len() counts the insertions. Only remove keys that were
+        added: removing a false positive drops the fingerprint of another key.
+        Once relocating fingerprints (up to max_kicks times) can not make
+        room, add() raises IndexError and leaves the filter unchanged.
+
+        Fan, Bin, et al. "Cuckoo filter: Practically better than bloom."
+        Proceedings of the 10th ACM International on Conference on emerging
+        Networking Experiments and Technologies (2014).
+    """
+
+    def __init__(self, capacity, error_rate, bucket_size=4, max_kicks=500, allow_duplicates=False):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bucket_size = bucket_size
+        self.max_kicks = max_kicks
+        self.allow_duplicates = allow_duplicates
+        self.fingerprint_bits = max(int(np.ceil(np.log2(2.0 * bucket_size / error_rate))), 1)
+        if self.fingerprint_bits > 32:
+            raise ValueError("error_rate too low for 32-bit fingerprints")
+        self.nbr_buckets = max(int(np.ceil(capacity / (bucket_size * LOAD_FACTOR))), 1)
+        # 7 bytes of padding for the unaligned 64-bit accesses of the compiled code
+        self.table = np.zeros((self.nbr_buckets * bucket_size * self.fingerprint_bits + 7) // 8 + 7,
+                              dtype=np.uint8)
+        self.count = 0
+
+    @property
+    def estimated_error_rate(self):
+        """ Upper bound of the false positive rate when full: 2 buckets of fingerprints to match """
+        return 2.0 * self.bucket_size / (1 << self.fingerprint_bits)
+
+    def bits_per_key(self):
+        return self.table.nbytes * 8 / max(self.count, 1)
+
+    def fingerprints(self):
+        """ The fingerprints, unpacked into a (nbr_buckets, bucket_size) uint64 array """
+        return cuckoo_fingerprints(self.table, self.nbr_buckets, self.bucket_size, self.fingerprint_bits)
+
+    def _key(self, key, action):
+        return cuckoo_key(self.table, self.nbr_buckets, self.bucket_size, self.fingerprint_bits, key, action,
+                          self.max_kicks, self.allow_duplicates)
+
+    def _update(self, digests, action):
+        return cuckoo_update(self.table, self.nbr_buckets, self.bucket_size, self.fingerprint_bits,
+                             digests_array(digests), action, self.max_kicks, self.allow_duplicates)
+
+    def __contains__(self, key):
+        return self._key(key, 0) == 1
+
+    def __len__(self):
+        """ Return the number of keys stored by this filter (insertions with allow_duplicates). """
+        return self.count
+
+    def add(self, key):
+        """ Insert key. Returns whether it was already (probably) present. """
+        result = self._key(key, 1)
+        if result < 0:
+            raise IndexError("CuckooFilter is at capacity")
+        if self.allow_duplicates or result == 0:
+            self.count += 1
+        return result == 1
+
+    def remove(self, key):
+        """ Remove key. Returns whether it was present (and removed). """
+        if self._key(key, -1) == 1:
+            self.count -= 1
+            return True
+        return False
+
+    def contains_many(self, keys):
+        """ Check the membership of a sequence of keys.
+
+            Returns a NumPy boolean array, True where the key is (probably) in the set.
+        """
+        return self.contains_digests(hash128_many(keys))
+
+    def contains_digests(self, digests):
+        """ contains_many() for pre-hashed keys (see hashfunctions.digests_array) """
+        return self._update(digests, 0)[0]
+
+    def add_many(self, keys):
+        """ Add a sequence of keys, in order.
+
+            Returns a NumPy boolean array with the same meaning as the return value
+            of add(): True where the key was already present. Like add(), raises
+            IndexError at the first key that does not fit; the keys before it
+            are kept.
+        """
+        return self.add_digests(hash128_many(keys))
+
+    def add_digests(self, digests):
+        """ add_many() for pre-hashed keys (see hashfunctions.digests_array) """
+        found, full = self._update(digests, 1)
+        self.count += found.size if self.allow_duplicates else int(found.size - np.count_nonzero(found))
+        if full:
+            raise IndexError("CuckooFilter is at capacity")
+        return found
+
+    def remove_many(self, keys):
+        """ Remove a sequence of keys, in order.
+
+            Returns a NumPy boolean array, True where the key was present (and removed).
+        """
+        return self.remove_digests(hash128_many(keys))
+
+    def remove_digests(self, digests):
+        """ remove_many() for pre-hashed keys (see hashfunctions.digests_array) """
+        removed = self._update(digests, -1)[0]
+        self.count -= int(np.count_nonzero(removed))
+        return removed
+
+    def to_bytes(self, compress=False):
+        """ Serialize to a versioned binary format: parameters header then the packed table """
+        params = (self.capacity, self.error_rate, self.nbr_buckets, self.count, self.max_kicks,
+                  self.bucket_size, self.fingerprint_bits, self.allow_duplicates)
+        return pack(CUCKOO_FILTER, CUCKOO_FILTER_PARAMS, params, [self.table], compress)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Load what to_bytes() wrote. The table shares the memory of data when
+            it is writable (bytearray, mmap...) and not compressed.
+        """
+        params, payload = unpack(data, CUCKOO_FILTER, CUCKOO_FILTER_PARAMS)
+        capacity, error_rate, nbr_buckets, count, max_kicks, bucket_size, fingerprint_bits, allow_duplicates = params
+        cf = cls(capacity, error_rate, bucket_size, max_kicks, allow_duplicates)
+        if (cf.nbr_buckets, cf.fingerprint_bits) != (nbr_buckets, fingerprint_bits):
+            raise ValueError("Serialized CuckooFilter geometry does not match its parameters")
+        cf.table = array_from(payload, np.uint8, cf.table.size)
+        cf.count = count
+        return cf
@@ -1,8 +1,19 @@
 import struct
 
 import mmh3
-from six import text_type
-from six.moves import range
+import numpy as np
+from six import integer_types, text_type
+
+from .bulk import digest_indexes, expand_digests64, hash128_many, hash_many, hash_one
+
+# Hash schemes used to derive the nbr_slices indexes of a key.
+# CHAINED runs nbr_slices murmur3 passes, each seeded with the previous hash.
+# DOUBLE derives every index from one 128-bit murmur3 pass (Kirsch-Mitzenmacher).
+CHAINED = 'chained'
+DOUBLE = 'double'
+HASH_SCHEMES = (CHAINED, DOUBLE)
+
+MASK64 = (1 << 64) - 1
 
 
 def hash64(key, seed):
@@ -13,26 +24,142 @@ def hash64(key, seed):
     returned values as big-endian unsigned long, like smhasher used to
     do.
     """
-    hash_val = mmh3.hash64(key, seed)[0]
+    hash_val = mmh3.hash64(key, seed & 0xFFFFFFFF)[0]
     return struct.unpack('>Q', struct.pack('q', hash_val))[0]
 
 
-def generate_hashfunctions(nbr_bits, nbr_slices):
+def hash128(key):
+    """
+    Wrapper around mmh3.hash64 to get the two halves of the 128-bit
+    murmur3 hash as unsigned 64-bit values.
+    """
+    h1, h2 = mmh3.hash64(key, 0)
+    return h1 & MASK64, h2 & MASK64
+
+
+def normalize_key(key):
+    """
+    Bytes hashed for a key: bytes-like keys as they are, text as UTF-8 and
+    anything else as the UTF-8 of its str(). Same as the compiled hashing.
+    """
+    if isinstance(key, text_type):
+        return key.encode('utf-8')
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return bytes(key)
+    return str(key).encode('utf-8')
+
+
+def digest(key):
+    """
+    128-bit digest of a key (murmur3, seed 0) as two unsigned 64-bit values.
+
+    Compute it once and pass it to the *_digests methods of every structure
+    instead of the key: BlockedBloomFilter, CuckooFilter, HyperLogLog and the
+    structures using the DOUBLE hash scheme derive their indexes from it
+    exactly as they would from the key.
+    """
+    return hash128(normalize_key(key))
+
+
+def digest_many(keys):
+    """
+    Digests of a sequence of keys, as a (len(keys), 2) uint64 NumPy array
+    """
+    return hash128_many(keys)
+
+
+def digests_array(digests):
+    """
+    Normalize pre-hashed keys to a C-contiguous (n, 2) uint64 array.
+
+    digests is a (n, 2) array of 128-bit digests (see digest_many), or a
+    (h1, h2) tuple for a single one. 64-bit digests from another hash function
+    must go through digests64() first: a 1-D array is rejected rather than
+    guessed at.
+    """
+    if isinstance(digests, tuple):
+        if len(digests) != 2:
+            raise ValueError("a 128-bit digest is a (h1, h2) tuple")
+        digests = [digests]
+    digests = np.asarray(digests)
+    if digests.ndim != 2 or digests.shape[1] != 2:
+        raise ValueError("digests should be a (n, 2) array, got shape %r "
+                         "(see digests64 for 64-bit digests)" % (digests.shape,))
+    if digests.dtype.kind == 'i':
+        return np.ascontiguousarray(digests.astype(np.uint64))
+    if digests.dtype == object:
+        digests = [[value & MASK64 for value in row] for row in digests.tolist()]
+    return np.ascontiguousarray(digests, dtype=np.uint64)
+
+
+def digests64(digests):
+    """
+    128-bit digests, as a (n, 2) uint64 array, from a 1-D array (or an int)
+    of 64-bit digests computed by another hash function.
+
+    Both halves are remixed (bulk.expand_digests64): they give different
+    indexes than the keys themselves would, so a structure should then be fed
+    64-bit digests only.
+    """
+    if isinstance(digests, integer_types):
+        digests = [digests & MASK64]
+    digests = np.asarray(digests)
+    if digests.ndim != 1:
+        raise ValueError("64-bit digests should be a (n,) array, got shape %r" % (digests.shape,))
+    if digests.dtype.kind == 'i':
+        digests = digests.astype(np.uint64)
+    return expand_digests64(np.ascontiguousarray(digests, dtype=np.uint64))
+
+
+def check_hash_scheme(scheme):
+    if scheme not in HASH_SCHEMES:
+        raise ValueError("hash scheme %r should be one of %r" % (scheme, HASH_SCHEMES))
+    return scheme
+
+
+def generate_hashfunctions(nbr_bits, nbr_slices, scheme=CHAINED):
     """Generate a set of hash functions.
 
     The core method is a 64-bit murmur3 hash which has a good distribution.
-    Multiple hashes can be generate using the previous hash value as a seed.
+    With the CHAINED scheme, multiple hashes are generated using the previous
+    hash value as a seed. With the DOUBLE scheme, a single 128-bit hash gives
+    h1 and h2 and the i-th hash is h1 + i * h2 (mod 2 ** 64).
+
+    The hashing itself runs in compiled code (bulk.hash_one), which computes
+    exactly what hash64/hash128 would.
     """
+    double = check_hash_scheme(scheme) == DOUBLE
+
     def _make_hashfuncs(key):
-        if isinstance(key, text_type):
-            key = key.encode('utf-8')
-        else:
-            key = str(key)
-        rval = []
-        current_hash = 0
-        for i in range(nbr_slices):
-            seed = current_hash
-            current_hash = hash64(key, seed)
-            rval.append(current_hash % nbr_bits)
-        return rval
+        return hash_one(key, nbr_bits, nbr_slices, double)
     return _make_hashfuncs
+
+
+def generate_bulk_hashfunctions(nbr_bits, nbr_slices, scheme=CHAINED):
+    """Bulk counterpart of generate_hashfunctions.
+
+    The returned function takes a sequence of keys and returns a
+    (len(keys), nbr_slices) uint64 NumPy array whose rows are the values the
+    single-key hash function would return. Hashing is done in compiled code.
+    """
+    double = check_hash_scheme(scheme) == DOUBLE
+
+    def _make_bulk_hashfuncs(keys):
+        return hash_many(keys, nbr_bits, nbr_slices, double)
+    return _make_bulk_hashfuncs
+
+
+def generate_digest_hashfunctions(nbr_bits, nbr_slices, scheme=CHAINED):
+    """Pre-hashed counterpart of generate_bulk_hashfunctions.
+
+    The returned function takes digests (see digests_array) and returns the
+    (len(digests), nbr_slices) uint64 array of their indexes. Only the DOUBLE
+    scheme can be derived from a digest: with CHAINED, it raises ValueError.
+    """
+    double = check_hash_scheme(scheme) == DOUBLE
+
+    def _make_digest_hashfuncs(digests):
+        if not double:
+            raise ValueError("pre-hashed keys need the %r hash scheme" % DOUBLE)
+        return digest_indexes(digests_array(digests), nbr_bits, nbr_slices)
+    return _make_digest_hashfuncs
@@ -1,27 +1,71 @@
 from __future__ import absolute_import, division, print_function
 
+import copy
+import struct
+
 import numpy as np
 from six import PY3
 from six.moves import range
 
-from .hashfunctions import hash64
+from .bulk import hll_add, hll_hash, hll_hash_digests, hll_hash_many
+from .hashfunctions import digests_array
+from .serialization import HYPERLOGLOG, array_from, pack, unpack
 
 
 if PY3:
     long = int
 
 
+CLASSIC = 'classic'
+ERTL = 'ertl'
+ESTIMATORS = (CLASSIC, ERTL)
+
+# Bits of a sparse entry holding rho; the register index is stored above them.
+SPARSE_RHO_BITS = 6
+SPARSE_RHO_MASK = (1 << SPARSE_RHO_BITS) - 1
+# Entries added to a sparse HLL are buffered, and merged into the compressed
+# list once the buffer is full.
+SPARSE_BUFFER_SIZE = 32
+
+# error_rate, sparse_threshold, size of the sparse data in bytes, b, estimator, sparse
+HYPERLOGLOG_PARAMS = struct.Struct('<dQQBB?5x')
+
+
 class HyperLogLog(object):
-    """ Basic Hyperloglog """
+    """ Basic Hyperloglog
+
+        With sparse=True the registers start in a sparse representation (as in
+        HyperLogLog++): the sorted (index << 6 | rho) entries of the non-zero
+        registers, delta and varint encoded into a uint8 array, fed by a small
+        fixed-size uint32 buffer. It switches to the dense uint8 register array
+        once the encoded entries take more than sparse_threshold bytes (m // 4
+        by default).
 
-    def __init__(self, error_rate):
+        estimator selects the cardinality estimator: CLASSIC (Flajolet et al.
+        with the small and large range corrections) or ERTL, the improved
+        estimator from Ertl, Otmar. "New cardinality estimation algorithms for
+        HyperLogLog sketches." arXiv:1702.01284 (2017), which has no bias
+        across the whole cardinality range.
+    """
+
+    def __init__(self, error_rate, sparse=False, estimator=CLASSIC, sparse_threshold=None):
         b = int(np.ceil(np.log2((1.04 / error_rate) ** 2)))
+        self.error_rate = error_rate
         self.precision = 64
         self.alpha = self._get_alpha(b)
         self.b = b
         self.m = 1 << b
-        self.M = np.zeros(self.m, dtype=np.uint8)
-        self.bitcount_arr = [long(1) << i for i in range(self.precision - b + 1)]
+        if estimator not in ESTIMATORS:
+            raise ValueError("estimator %r should be one of %r" % (estimator, ESTIMATORS))
+        self.estimator = estimator
+        self.sparse_threshold = self.m // 4 if sparse_threshold is None else sparse_threshold
+        if sparse:
+            self.M = None
+            self.sparse_data = np.zeros(0, dtype=np.uint8)
+            self.sparse_buffer = np.zeros(SPARSE_BUFFER_SIZE, dtype=np.uint32)
+            self.sparse_buffered = 0
+        else:
+            self.M = np.zeros(self.m, dtype=np.uint8)
 
     @staticmethod
     def _get_alpha(b):
@@ -35,52 +79,313 @@ class HyperLogLog(object):
             return 0.709
         return 0.7213 / (1.0 + 1.079 / (1 << b))
 
-    def _get_rho(self, w, arr):
-        """ Return the least signifiant bit
-            O(N) in the worst case
-        """
-        lsb = 0
-        while not (w & arr[lsb]):
-            lsb += 1
-        return lsb + 1
+    @property
+    def is_sparse(self):
+        return self.M is None
 
     def add(self, uuid):
-        """ Adds a key to the HyperLogLog """
+        """ Adds a key to the HyperLogLog
+
+            The key is hashed with hash64 (seed 0): the first b bits give the
+            register, rho is the position of the lowest set bit of the remaining
+            ones. Done in compiled code (bulk.hll_add) with a count-trailing-zeros.
+        """
         if uuid:
-            # Computing the hash
-            try:
-                x = hash64(uuid)
-            except UnicodeEncodeError:
-                x = hash64(uuid.encode('ascii', 'ignore'))
-            # Finding the register to update by using the first b bits as an index
-            j = x & ((1 << self.b) - 1)
-            # Remove those b bits
-            w = x >> self.b
-            # Find the first 0 in the remaining bit pattern
-            self.M[j] = max(self.M[j], self._get_rho(w, self.bitcount_arr))
+            if self.M is not None:
+                hll_add(self.M, uuid, self.b)
+                return
+            j, rho = hll_hash(uuid, self.b)
+            self.sparse_buffer[self.sparse_buffered] = (j << SPARSE_RHO_BITS) | rho
+            self.sparse_buffered += 1
+            if self.sparse_buffered == SPARSE_BUFFER_SIZE:
+                self._merge_sparse()
+
+    def add_many(self, uuids):
+        """ Adds a sequence of keys to the HyperLogLog
+
+            Keys are hashed in bulk and the registers updated with np.maximum.at.
+            Like add(), empty keys are ignored.
+        """
+        self._add_hashed(*hll_hash_many([uuid for uuid in uuids if uuid], self.b))
+
+    def add_digests(self, digests, keys=None):
+        """ add_many() for pre-hashed keys (see hashfunctions.digests_array).
+
+            A digest does not tell whether its key was empty: pass the keys
+            along (one per digest) to ignore empty ones like add() does.
+        """
+        digests = digests_array(digests)
+        if keys is not None:
+            digests = digests[np.fromiter((bool(key) for key in keys), dtype=np.bool_, count=len(digests))]
+        self._add_hashed(*hll_hash_digests(np.ascontiguousarray(digests), self.b))
+
+    def _add_hashed(self, indexes, rhos):
+        if self.M is not None:
+            np.maximum.at(self.M, indexes, rhos)
+            return
+        entries = (indexes.astype(np.uint32) << SPARSE_RHO_BITS) | rhos
+        self._merge_sparse(entries)
+
+    def sparse_entries(self, entries=None):
+        """ Returns the sorted (index << 6 | rho) entries of a sparse HLL, with
+            the buffered ones (and entries) folded in, keeping the largest rho
+            per register. The HLL itself is left untouched.
+        """
+        merged = np.sort(np.concatenate([_decode_sparse(self.sparse_data),
+                                         self.sparse_buffer[:self.sparse_buffered],
+                                         np.zeros(0, dtype=np.uint32) if entries is None else entries]))
+        if merged.size:
+            indexes = merged >> SPARSE_RHO_BITS
+            # Entries are sorted by (index, rho), so the last one of each index has the largest rho
+            merged = merged[np.append(indexes[1:] != indexes[:-1], True)]
+        return merged
+
+    def _merge_sparse(self, entries=None):
+        """ Fold the buffer (and entries) into the compressed sparse list, and
+            switch to dense when it gets too big.
+        """
+        merged = self.sparse_entries(entries)
+        self.sparse_buffered = 0
+        data = _encode_sparse(merged)
+        if data.nbytes > self.sparse_threshold:
+            self._set_dense(merged)
+        else:
+            self.sparse_data = data
+
+    def _set_dense(self, entries):
+        self.M = np.zeros(self.m, dtype=np.uint8)
+        self.M[entries >> SPARSE_RHO_BITS] = entries & SPARSE_RHO_MASK
+        self.sparse_data = None
+        self.sparse_buffer = None
+        self.sparse_buffered = 0
+
+    def to_dense(self):
+        """ Switch to the dense register representation (no-op if already dense) """
+        if self.M is None:
+            self._set_dense(self.sparse_entries())
+
+    def registers(self):
+        """ Returns the registers as a dense uint8 array (the array itself when dense) """
+        if self.M is not None:
+            return self.M
+        entries = self.sparse_entries()
+        registers = np.zeros(self.m, dtype=np.uint8)
+        registers[entries >> SPARSE_RHO_BITS] = entries & SPARSE_RHO_MASK
+        return registers
+
+    def _histogram(self):
+        """ Returns the number of registers having each value 0 .. precision - b + 1 """
+        q = self.precision - self.b
+        if self.M is not None:
+            return np.bincount(self.M, minlength=q + 2)
+        entries = self.sparse_entries()
+        histogram = np.bincount(entries & SPARSE_RHO_MASK, minlength=q + 2)
+        histogram[0] += self.m - entries.size
+        return histogram
+
+    def to_bytes(self, compress=False):
+        """ Serialize to a versioned binary format: parameters header, then the
+            raw registers (dense) or the compressed sparse entries.
+        """
+        if self.M is None:
+            payload = _encode_sparse(self.sparse_entries())
+            sparse_size = payload.nbytes
+        else:
+            payload, sparse_size = self.M, 0
+        params = (self.error_rate, self.sparse_threshold, sparse_size, self.b,
+                  ESTIMATORS.index(self.estimator), self.M is None)
+        return pack(HYPERLOGLOG, HYPERLOGLOG_PARAMS, params, [payload], compress)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Load what to_bytes() wrote. Dense registers share the memory of data
+            when it is writable (bytearray, mmap...) and not compressed.
+        """
+        params, payload = unpack(data, HYPERLOGLOG, HYPERLOGLOG_PARAMS)
+        error_rate, sparse_threshold, sparse_size, b, estimator, sparse = params
+        hll = cls(error_rate, sparse, ESTIMATORS[estimator], sparse_threshold)
+        if hll.b != b:
+            raise ValueError("Serialized HyperLogLog precision does not match its parameters")
+        if sparse:
+            hll.sparse_data = array_from(payload, np.uint8, sparse_size)
+        else:
+            hll.M = array_from(payload, np.uint8, hll.m)
+        return hll
 
     def __len__(self, M=None):
         """ Returns the estimate of the cardinality """
         return self.estimate()
 
     def __or__(self, other_hll):
-        """  Perform a union with another HLL object. """
-        self.M = reduce(lambda x, y: np.maximum(x, y),
-                        [self.M, other_hll.M]).astype(np.int16)
+        """  Perform a union with another HLL object (in place, like merge). """
+        return self.merge(other_hll)
+
+    def _check_compatible(self, other_hll):
+        if other_hll.b != self.b or other_hll.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs with b=%d and b=%d" % (self.b, other_hll.b))
+
+    def merge(self, *others):
+        """ Union other HLLs into this one, in place.
+
+            Registers stay uint8: each union is an np.maximum written back into
+            self.M. Sparse HLLs stay sparse while they are all sparse. The other
+            HLLs are only read, sparse ones are not flushed nor densified.
+        """
+        for other_hll in others:
+            self._check_compatible(other_hll)
+        for other_hll in others:
+            if self.M is None and other_hll.M is None:
+                self._merge_sparse(other_hll.sparse_entries())
+            else:
+                self.to_dense()
+                np.maximum(self.M, other_hll.registers(), out=self.M)
         return self
 
+    @classmethod
+    def union_many(cls, hlls):
+        """ Returns a new HLL, the union of all the given HLLs """
+        hlls = list(hlls)
+        if not hlls:
+            raise ValueError("union_many needs at least one HyperLogLog")
+        union = copy.deepcopy(hlls[0])
+        return union.merge(*hlls[1:])
+
+    @staticmethod
+    def stack(hlls):
+        """ Returns the dense registers of HLLs as a 2-D (len(hlls), m) uint8 array.
+
+            Stacked registers can be unioned along an axis with np.maximum.reduce
+            and estimated all at once with estimate_registers().
+        """
+        hlls = list(hlls)
+        if not hlls:
+            raise ValueError("stack needs at least one HyperLogLog")
+        stacked = np.empty((len(hlls), hlls[0].m), dtype=np.uint8)
+        for row, hll in enumerate(hlls):
+            hlls[0]._check_compatible(hll)
+            stacked[row] = hll.registers()
+        return stacked
+
+    @classmethod
+    def estimate_many(cls, hlls):
+        """ Returns the cardinality estimates of many HLLs as an int64 array """
+        hlls = list(hlls)
+        if not hlls:
+            return np.zeros(0, dtype=np.int64)
+        return hlls[0].estimate_registers(cls.stack(hlls))
+
+    def estimate_registers(self, registers):
+        """ Vectorized estimate of every row of a 2-D array of registers
+            sharing this HLL's parameters (b and estimator).
+        """
+        registers = np.asarray(registers, dtype=np.uint8)
+        width = self.precision - self.b + 2
+        offsets = registers + (np.arange(registers.shape[0]) * width)[:, None]
+        histograms = np.bincount(offsets.ravel(), minlength=registers.shape[0] * width)
+        return self._estimate_histograms(histograms.reshape(registers.shape[0], width))
+
     def estimate(self):
         """ Returns the estimate of the cardinality """
-        E = self.alpha * float(self.m ** 2) / np.power(2.0, - self.M).sum()
-        if E <= 2.5 * self.m:             # Small range correction
-            V = self.m - np.count_nonzero(self.M)
-            return int(self.m * np.log(self.m / float(V))) if V > 0 else int(E)
-        # intermidiate range correction -> No correction
-        elif E <= float(long(1) << self.precision) / 30.0:
-            return int(E)
-        else:
-            return int(-(long(1) << self.precision) *
-                       np.log(1.0 - E / (long(1) << self.precision)))
+        return int(self._estimate_histograms(self._histogram()[None, :])[0])
+
+    def _estimate_histograms(self, histograms):
+        if self.estimator == ERTL:
+            return self._ertl_estimate(histograms)
+        return self._classic_estimate(histograms)
+
+    def _classic_estimate(self, histograms):
+        m = float(self.m)
+        E = self.alpha * m ** 2 / np.ldexp(histograms, -np.arange(histograms.shape[1])).sum(axis=1)
+        V = histograms[:, 0]
+        two_power = float(long(1) << self.precision)
+        with np.errstate(divide='ignore'):
+            small = np.where(V > 0, m * np.log(m / np.maximum(V, 1)), E)
+            large = -two_power * np.log(1.0 - E / two_power)
+        # Small range correction, then intermidiate range -> No correction
+        estimates = np.where(E <= 2.5 * m, small, np.where(E <= two_power / 30.0, E, large))
+        return estimates.astype(np.int64)
+
+    def _ertl_estimate(self, histograms):
+        """ Ertl's improved estimator, computed from register histograms """
+        m = float(self.m)
+        q = self.precision - self.b
+        z = m * _tau(1.0 - histograms[:, q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histograms[:, k])
+        z += m * _sigma(histograms[:, 0] / m)
+        with np.errstate(divide='ignore'):
+            return np.round(m * m / (2.0 * np.log(2.0) * z)).astype(np.int64)
+
+
+def _encode_sparse(entries):
+    """ Delta + varint (7 bits per byte, high bit set on all bytes but the
+        last) encoding of sorted uint32 sparse entries, as a uint8 array.
+    """
+    deltas = np.diff(entries, prepend=np.uint32(0)).astype(np.uint32)
+    lengths = np.ones(deltas.size, dtype=np.intp)
+    for shift in (7, 14, 21, 28):
+        lengths += deltas >= (1 << shift)
+    starts = np.cumsum(lengths) - lengths
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(5):
+        selected = lengths > k
+        more = (lengths[selected] > k + 1).astype(np.uint32) << 7
+        data[starts[selected] + k] = ((deltas[selected] >> (7 * k)) & 0x7f) | more
+    return data
+
+
+def _decode_sparse(data):
+    """ Sorted uint32 sparse entries from what _encode_sparse() wrote """
+    ends = np.flatnonzero(data < 0x80)
+    if not ends.size:
+        return np.zeros(0, dtype=np.uint32)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.intp)
+    deltas = np.zeros(ends.size, dtype=np.uint32)
+    for k in range(5):
+        positions = starts + k
+        selected = positions <= ends
+        if not selected.any():
+            break
+        deltas[selected] |= (data[positions[selected]] & 0x7f).astype(np.uint32) << (7 * k)
+    return np.cumsum(deltas, dtype=np.uint32)
+
+
+def _sigma(x):
+    """ sigma function of Ertl's estimator, element-wise over an array """
+    x = np.array(x, dtype=np.float64)
+    result = np.full(x.shape, np.inf)
+    converging = x < 1.0
+    x = x[converging]
+    y = 1.0
+    z = x.copy()
+    while True:
+        x = x * x
+        previous = z
+        z = z + x * y
+        y += y
+        if np.array_equal(z, previous):
+            break
+    result[converging] = z
+    return result
+
+
+def _tau(x):
+    """ tau function of Ertl's estimator, element-wise over an array """
+    x = np.array(x, dtype=np.float64)
+    result = np.zeros(x.shape)
+    converging = (x > 0.0) & (x < 1.0)
+    x = x[converging]
+    y = 1.0
+    z = 1.0 - x
+    while True:
+        x = np.sqrt(x)
+        previous = z
+        y *= 0.5
+        z = z - (1.0 - x) ** 2 * y
+        if np.array_equal(z, previous):
+            break
+    result[converging] = z / 3.0
+    return result
 
 
 if __name__ == "__main__":
@@ -3,36 +3,73 @@ Cython module for fast maintenance process
 '''
 
 import cython
-from libc.stdlib cimport malloc, free
-from libc.math cimport sqrt, pow
-from six.moves import range
-cimport numpy as np
+from libc.stdint cimport uint8_t, uint32_t
+
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-@cython.cdivision(True)
-cdef tuple maintenance_cyt(np.ndarray[np.uint8_t, ndim=1, mode="c"] cells,
-                           long int cells_size,
-                           long int num_iterations,
-                           long int head):
+cdef long long decrement_range(uint8_t *cells, Py_ssize_t start, Py_ssize_t stop,
+                               uint32_t k) noexcept nogil:
     '''
-    Maintenance process for the Countdown Bloom Filter
+    Saturating decrement by k of cells[start:stop]. Returns the number of
+    single decrements that left their cell nonzero, i.e. the sum over the
+    range of min(k, cell - 1) for the nonzero cells. Branch-free so that the
+    compiler can vectorize it.
     '''
-    cdef long int refresh_head = head
-    cdef long int itr
-    cdef long int nonzero = 0
+    cdef Py_ssize_t i
+    cdef uint32_t value, step
+    cdef long long nonzero = 0
+    for i in range(start, stop):
+        value = cells[i]
+        step = value if value < k else k
+        cells[i] = <uint8_t> (value - step)
+        nonzero += step - (value != 0 and value <= k)
+    return nonzero
 
-    for itr in range(num_iterations):
-        if cells[refresh_head] != 0:
-            cells[refresh_head] -= 1
-            if cells[refresh_head] != 0:
-                nonzero += 1
-        refresh_head = (refresh_head + 1) % cells_size
-    return refresh_head, nonzero
 
+@cython.cdivision(True)
+cdef long long maintenance_nogil(uint8_t *cells, Py_ssize_t cells_size,
+                                 long long num_iterations, Py_ssize_t head,
+                                 Py_ssize_t *new_head) noexcept nogil:
+    '''
+    Maintenance process for the Countdown Bloom Filter
 
-def maintenance(np.ndarray[np.uint8_t, ndim=1, mode="c"] cells,
-                long int cells_size, long int num_iterations, head):
-    return maintenance_cyt(cells, cells_size, num_iterations, head)
+    Same result as num_iterations steps of "decrement the cell under the
+    refresh head if it is nonzero, then move the head", but each cell is
+    visited once: the cells of the wrapped range [head, head + remainder)
+    are decremented by laps + 1 and the others by laps (zero on the first lap).
+    '''
+    cdef long long laps = num_iterations // cells_size
+    cdef Py_ssize_t remainder = num_iterations % cells_size
+    cdef Py_ssize_t stop = head + remainder
+    # Counters are uint8: 256 decrements empty any cell
+    cdef uint32_t k = <uint32_t> (laps if laps < 256 else 256)
+    cdef long long nonzero = 0
+    if stop <= cells_size:
+        if k:
+            nonzero += decrement_range(cells, 0, head, k)
+            nonzero += decrement_range(cells, stop, cells_size, k)
+        nonzero += decrement_range(cells, head, stop, k + 1)
+    else:
+        stop -= cells_size
+        if k:
+            nonzero += decrement_range(cells, stop, head, k)
+        nonzero += decrement_range(cells, head, cells_size, k + 1)
+        nonzero += decrement_range(cells, 0, stop, k + 1)
+    new_head[0] = stop if stop < cells_size else 0
+    return nonzero
 
 
+def maintenance(uint8_t[::1] cells, Py_ssize_t cells_size, long long num_iterations, Py_ssize_t head):
+    '''
+    Run num_iterations maintenance steps from head, with the GIL released.
+    Returns the new refresh head and the number of steps that left a nonzero cell.
+    '''
+    cdef Py_ssize_t new_head = head
+    cdef long long nonzero = 0
+    if cells_size > cells.shape[0] or not 0 <= head < cells_size:
+        raise IndexError("maintenance range out of the cells bounds")
+    if num_iterations > 0:
+        with nogil:
+            nonzero = maintenance_nogil(&cells[0], cells_size, num_iterations, head, &new_head)
+    return new_head, nonzero
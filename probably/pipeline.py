@@ -0,0 +1,106 @@
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import threading
+import time
+
+import numpy as np
+
+from .hashfunctions import DOUBLE, digest_many
+
+
+class IngestionPipeline(object):
+    """ Dedup, unique counting and trends of an event stream, hashing each key once.
+
+        A batch of keys is hashed into 128-bit digests (hashfunctions.digest_many),
+        then added to the CountdownBloomFilter: the keys it had not seen (or seen
+        too long ago) are counted in the HyperLogLog and the CountMinSketch,
+        both optional, through their *_digests methods. The filter and the sketch
+        must use the DOUBLE hash scheme, the only one that can be derived from a
+        digest.
+
+        lock, if given, is held while the filter is updated: share it with the
+        MaintenanceScheduler running its expiration. The filter can also be a
+        Sharded of CountdownBloomFilters, which has locks of its own.
+
+            pipeline = IngestionPipeline(cdbf, hll, cms)
+            for stats in pipeline.ingest_stream(events):
+                ...
+
+        Like CountdownBloomFilter.add_many(), ingesting raises IndexError at the
+        first key that does not fit in the filter: the keys of the batch before
+        it are still counted, the following ones are dropped. With a Sharded
+        filter, the keys the other shards inserted are counted as well.
+    """
+
+    def __init__(self, cdbf, hll=None, cms=None, batch_size=10000, lock=None):
+        if cdbf.hash_scheme != DOUBLE or (cms is not None and cms.hash_scheme != DOUBLE):
+            raise ValueError("IngestionPipeline needs structures using the %r hash scheme" % DOUBLE)
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.cdbf = cdbf
+        self.hll = hll
+        self.cms = cms
+        self.batch_size = batch_size
+        self.lock = lock if lock is not None else threading.Lock()
+        self.nbr_batches = 0
+        self.nbr_keys = 0
+        self.nbr_unseen = 0
+
+    def ingest(self, keys):
+        """ Ingest a batch of keys. Returns the stats of the batch, as a dict:
+            number of keys, of unseen ones, of duplicates, keys evicted from
+            the top-k of the sketch and duration in seconds.
+        """
+        start = time.perf_counter()
+        keys = list(keys)
+        digests = digest_many(keys)
+        processed = np.zeros(len(keys), dtype=np.bool_)
+        with self.lock:
+            found = self.cdbf.add_digests(digests, stop_at_capacity=True, processed=processed)
+        # Keys past the capacity were not inserted: count the ones that were,
+        # wherever they are in the batch for a Sharded filter
+        unseen = processed.copy()
+        unseen[:found.shape[0]] &= ~found
+        full = not processed.all()
+        new_digests = digests[unseen]
+        new_keys = list(itertools.compress(keys, unseen))
+        if self.hll is not None:
+            self.hll.add_digests(new_digests, keys=new_keys)
+        evicted = []
+        if self.cms is not None:
+            evicted = self.cms.update_digests(new_digests, keys=new_keys)
+        nbr_unseen = len(new_keys)
+        self.nbr_batches += 1
+        nbr_keys = int(np.count_nonzero(processed))
+        self.nbr_keys += nbr_keys
+        self.nbr_unseen += nbr_unseen
+        if full:
+            raise IndexError("BloomFilter is at capacity")
+        return {
+            'keys': nbr_keys,
+            'unseen': nbr_unseen,
+            'duplicates': nbr_keys - nbr_unseen,
+            'evicted': evicted,
+            'duration': time.perf_counter() - start,
+        }
+
+    def ingest_stream(self, keys):
+        """ Ingest an iterable (a generator for instance) of keys by batches
+            of batch_size, yielding the stats of every batch.
+        """
+        keys = iter(keys)
+        while True:
+            batch = list(itertools.islice(keys, self.batch_size))
+            if not batch:
+                return
+            yield self.ingest(batch)
+
+    def metrics(self):
+        return {
+            'batches': self.nbr_batches,
+            'keys': self.nbr_keys,
+            'unseen': self.nbr_unseen,
+            'estimated_count': len(self.cdbf),
+            'cardinality': len(self.hll) if self.hll is not None else None,
+        }
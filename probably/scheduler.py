@@ -0,0 +1,145 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+
+
+class MaintenanceScheduler(object):
+    """ Background thread running the expiration maintenance of a CountdownBloomFilter.
+
+        Every interval seconds, the time elapsed on a monotonic clock is turned
+        into maintenance steps (compute_refresh_time() seconds each); the
+        fractional remainder is carried over to the next pass. A pass runs the
+        steps in chunks sized from the measured throughput and stops once it
+        has spent latency_budget seconds, so that a pass takes about
+        latency_budget at most (the very first chunk, used to measure the
+        throughput, excepted). Steps left over are carried over to the next
+        pass, run right after latency_budget seconds instead of interval while
+        the maintenance is behind. Chunks run at least min_chunk steps, the
+        last one of the pending steps excepted. lock (shared with the threads
+        using the filter, if any) is only held for one chunk at a time.
+
+        The count of the filter is re-estimated from the share of nonzero cells
+        met by the decrements. A few steps make for a noisy estimate, which
+        can trip the hard capacity of the filter: the nonzero cells are summed
+        over passes, and the count re-estimated at the end of the first pass
+        bringing the total to estimate_steps steps (the whole filter at most).
+
+        metrics() reports the lag (seconds of maintenance not run yet), the
+        throughput in cells/sec and the estimated count of the filter.
+
+            scheduler = MaintenanceScheduler(cdbf, interval=0.5)
+            scheduler.start()
+            ...
+            scheduler.stop()
+    """
+
+    def __init__(self, cdbf, interval=1.0, latency_budget=0.005, lock=None, clock=time.monotonic,
+                 min_chunk=64, estimate_steps=4096):
+        if interval <= 0 or latency_budget <= 0:
+            raise ValueError("interval and latency_budget must be positive")
+        if min_chunk < 1 or estimate_steps < 1:
+            raise ValueError("min_chunk and estimate_steps must be positive")
+        self.cdbf = cdbf
+        self.interval = interval
+        self.latency_budget = latency_budget
+        self.min_chunk = min_chunk
+        self.estimate_steps = min(estimate_steps, cdbf.nbr_bits)
+        self.sampled_nonzero = 0
+        self.sampled_steps = 0
+        self.lock = lock if lock is not None else threading.Lock()
+        self.clock = clock
+        self.last_time = None
+        self.pending = 0.0
+        self.cells_per_second = None
+        self.processed = 0
+        self.passes = 0
+        self.last_pass_duration = 0.0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _chunk_size(self, budget):
+        if self.cells_per_second is None:
+            # Small first chunk, only used to measure the throughput
+            return 4096
+        return max(int(self.cells_per_second * budget), self.min_chunk)
+
+    def run_pending(self):
+        """ Run the maintenance due since the last call, in bounded chunks and
+            within the latency budget. Returns the number of maintenance steps run.
+        """
+        now = self.clock()
+        if self.last_time is None:
+            self.last_time = now
+        self.pending += (now - self.last_time) / self.cdbf.compute_refresh_time()
+        self.last_time = now
+        start = self.clock()
+        done = 0
+        # The epsilon absorbs the rounding of the accumulated clock deltas
+        while self.pending + 1e-9 >= 1 and not self.stopping.is_set():
+            budget = self.latency_budget - (self.clock() - start)
+            # Stop once not even a chunk of min_chunk steps fits in what is left of the budget
+            if done and budget * (self.cells_per_second or 0.0) < self.min_chunk:
+                break
+            chunk = min(int(self.pending + 1e-9), self._chunk_size(budget))
+            chunk_start = self.clock()
+            with self.lock:
+                self.sampled_nonzero += self.cdbf.decrement(chunk)
+            duration = self.clock() - chunk_start
+            if duration > 0:
+                rate = chunk / duration
+                self.cells_per_second = rate if self.cells_per_second is None else \
+                    0.8 * self.cells_per_second + 0.2 * rate
+            self.pending -= chunk
+            self.sampled_steps += chunk
+            done += chunk
+        if self.sampled_steps >= self.estimate_steps:
+            with self.lock:
+                self.cdbf.update_estimate(self.sampled_nonzero, self.sampled_steps)
+            self.sampled_nonzero = self.sampled_steps = 0
+        self.processed += done
+        self.passes += 1
+        self.last_pass_duration = self.clock() - start
+        return done
+
+    def metrics(self):
+        return {
+            'lag': self.pending * self.cdbf.compute_refresh_time(),
+            'cells_per_second': self.cells_per_second or 0.0,
+            'estimated_count': self.cdbf.count,
+            'processed': self.processed,
+            'passes': self.passes,
+            'last_pass_duration': self.last_pass_duration,
+        }
+
+    def _wait(self):
+        """ Sleep for interval, or just latency_budget while behind. Returns True when stopping. """
+        return self.stopping.wait(self.latency_budget if self.pending + 1e-9 >= 1 else self.interval)
+
+    def _run(self):
+        self.run_pending()
+        while not self._wait():
+            self.run_pending()
+
+    def start(self):
+        if self.thread is not None:
+            raise RuntimeError("MaintenanceScheduler already started")
+        self.stopping.clear()
+        self.last_time = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the thread and wait for the running chunk to finish """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, division, print_function
+
+import struct
+import zlib
+
+import numpy as np
+
+# Every serialized structure starts with PREFIX (magic, format version, kind,
+# flags), followed by the kind-specific parameters struct, zero padded to a
+# multiple of 8 bytes (version 2 on), then the payload: the raw NumPy buffers
+# of the structure, zlib compressed when flagged. The padding keeps the
+# counters aligned when they are used in place.
+MAGIC = b'PRBL'
+VERSION = 2
+VERSIONS = (1, 2)
+PREFIX = struct.Struct('<4sHHH2x')
+COMPRESSED = 0x1
+
+BLOOM_FILTER = 1
+COUNTDOWN_BLOOM_FILTER = 2
+COUNT_MIN_SKETCH = 3
+HYPERLOGLOG = 4
+CUCKOO_FILTER = 5
+WINDOWED_COUNT_MIN_SKETCH = 6
+
+
+def pack(kind, params_struct, params, payload, compress=False):
+    """Serialize a structure: header, parameters and payload (a list of buffers)."""
+    payload = b''.join(memoryview(part).cast('B') for part in payload)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= COMPRESSED
+    header = PREFIX.pack(MAGIC, VERSION, kind, flags) + params_struct.pack(*params)
+    return b''.join([header, b'\0' * (-len(header) % 8), payload])
+
+
+def unpack(data, kind, params_struct):
+    """Parse what pack() wrote. Returns the parameters tuple and the payload.
+
+    The payload is a memoryview over data when it is not compressed, so arrays
+    built on it with np.frombuffer share the memory of data (and are writable
+    if data is).
+    """
+    data = memoryview(data).cast('B')
+    magic, version, data_kind, flags = PREFIX.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a serialized probably structure")
+    if version not in VERSIONS:
+        raise ValueError("Unsupported serialization version %d" % version)
+    if data_kind != kind:
+        raise ValueError("Serialized structure kind %d, expected %d" % (data_kind, kind))
+    params = params_struct.unpack_from(data, PREFIX.size)
+    offset = PREFIX.size + params_struct.size
+    if version >= 2:
+        offset += -offset % 8
+    payload = data[offset:]
+    if flags & COMPRESSED:
+        payload = memoryview(bytearray(zlib.decompress(payload)))
+    return params, payload
+
+
+def array_from(payload, dtype, count, offset=0):
+    """np.frombuffer over payload, copied if payload is read-only so the structure stays updatable."""
+    array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+    if not array.flags.writeable:
+        array = array.copy()
+    return array
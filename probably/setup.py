@@ -5,5 +5,6 @@ import numpy
 
 setup(
     cmdclass = {'build_ext': build_ext},
-    ext_modules = [Extension("maintenance", ["maintenance.pyx"], include_dirs=[numpy.get_include()]),]
+    ext_modules = [Extension("maintenance", ["maintenance.pyx"], include_dirs=[numpy.get_include()]),
+                   Extension("bulk", ["bulk.pyx"], include_dirs=[numpy.get_include()]),]
 )
@@ -0,0 +1,186 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+import numpy as np
+
+from .bulk import shard_digests, shard_many, shard_one
+from .hashfunctions import digests_array
+
+
+class Sharded(object):
+    """ Thread-safe, lock-striped container of independent shards.
+
+        Keys are routed to one of nbr_shards structures built by factory() (a
+        BloomFilter, CountdownBloomFilter, CountMinSketch, HyperLogLog...) with
+        their 128-bit digest (see hashfunctions.digest), remixed apart from the
+        structure hashes, so that the *_digests methods route pre-hashed keys to
+        the same shards as the keys themselves. Each shard has its
+        own lock, so threads working on different shards do not wait on each
+        other, and the compiled bulk paths run with the GIL released. Size each
+        shard for its part of the keys, e.g.:
+
+            Sharded(lambda: BloomFilter(capacity // 16, 0.001), 16)
+
+        Bulk calls can be spread over an executor (concurrent.futures) to use
+        several cores for one batch.
+    """
+
+    def __init__(self, factory, nbr_shards=16, executor=None):
+        self.nbr_shards = nbr_shards
+        self.shards = [factory() for i in range(nbr_shards)]
+        self.locks = [threading.Lock() for i in range(nbr_shards)]
+        self.executor = executor
+
+    @property
+    def hash_scheme(self):
+        return self.shards[0].hash_scheme
+
+    def shard_for(self, key):
+        return shard_one(key, self.nbr_shards)
+
+    def _call(self, key, method, *args):
+        shard = self.shard_for(key)
+        with self.locks[shard]:
+            return getattr(self.shards[shard], method)(key, *args)
+
+    def _call_many(self, keys, method, values=None, **kwargs):
+        """ Split keys by shard, call method on each shard with its keys (and
+            its part of values) and return the per-shard results.
+        """
+        keys = list(keys)
+        return self._dispatch(shard_many(keys, self.nbr_shards), method, [keys], values, kwargs)
+
+    def _call_digests(self, digests, method, values=None, keys=None, **kwargs):
+        """ _call_many() for pre-hashed keys, with their keys if given """
+        digests = digests_array(digests)
+        if keys is not None:
+            keys = list(keys)
+            if len(keys) != len(digests):
+                raise ValueError("Got %d keys for %d digests" % (len(keys), len(digests)))
+        args = [digests] if keys is None else [digests, keys]
+        return self._dispatch(shard_digests(digests, self.nbr_shards), method, args, values, kwargs)
+
+    def _dispatch(self, shards, method, args, values=None, kwargs=None):
+        order = np.argsort(shards, kind='stable')
+        bounds = np.searchsorted(shards[order], np.arange(self.nbr_shards + 1))
+        if values is not None:
+            values = np.broadcast_to(np.asarray(values), shards.shape)
+
+        def take(arg, positions):
+            if isinstance(arg, list):
+                return [arg[i] for i in positions]
+            return arg[positions]
+
+        def call(shard):
+            positions = order[bounds[shard]:bounds[shard + 1]]
+            shard_args = [take(arg, positions) for arg in args]
+            if values is not None:
+                shard_args.insert(1, values[positions])
+            with self.locks[shard]:
+                return positions, getattr(self.shards[shard], method)(*shard_args, **(kwargs or {}))
+
+        # An empty batch still goes to a shard, for a result of the structure's own type
+        busy = [shard for shard in range(self.nbr_shards) if bounds[shard + 1] > bounds[shard]] or [0]
+        if self.executor is None:
+            return len(shards), [call(shard) for shard in busy]
+        return len(shards), list(self.executor.map(call, busy))
+
+    def _gather(self, nbr_keys, results):
+        gathered = np.zeros(nbr_keys, dtype=np.bool_)
+        for positions, result in results:
+            gathered[positions] = result
+        return gathered
+
+    def apply(self, func):
+        """ Call func(shard) on every shard, under its lock, and return the results """
+        results = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                results.append(func(shard))
+        return results
+
+    def __contains__(self, key):
+        return self._call(key, '__contains__')
+
+    def add(self, key, *args):
+        return self._call(key, 'add', *args)
+
+    def contains_many(self, keys):
+        return self._gather(*self._call_many(keys, 'contains_many'))
+
+    def add_many(self, keys, processed=None, **kwargs):
+        """ Bulk add; returns the per-key results for filters, None for HyperLogLog.
+
+            Keyword arguments go to the add_many() of the shards. When a shard
+            stops early (CountdownBloomFilter stop_at_capacity), the results
+            stop at its first key left out: keys further on may still have been
+            added to other shards. To account for those, pass processed, a
+            boolean array of one item per key: it is set to True for the keys
+            the shards added or touched, and the results then cover every key
+            (False for the ones left out).
+        """
+        return self._gather_added(processed, *self._call_many(keys, 'add_many', **kwargs))
+
+    def _gather_added(self, processed, nbr_keys, results):
+        if all(result is None for positions, result in results):
+            return None
+        gathered = np.zeros(nbr_keys, dtype=np.bool_)
+        stop = nbr_keys
+        for positions, result in results:
+            gathered[positions[:len(result)]] = result
+            if processed is not None:
+                processed[positions[:len(result)]] = True
+            if len(result) < len(positions):
+                stop = min(stop, positions[len(result)])
+        return gathered if processed is not None else gathered[:stop]
+
+    def contains_digests(self, digests):
+        """ contains_many() for pre-hashed keys (see hashfunctions.digests_array) """
+        return self._gather(*self._call_digests(digests, 'contains_digests'))
+
+    def add_digests(self, digests, processed=None, **kwargs):
+        """ add_many() for pre-hashed keys (see hashfunctions.digests_array) """
+        return self._gather_added(processed, *self._call_digests(digests, 'add_digests', **kwargs))
+
+    def update(self, key, increment):
+        return self._call(key, 'update', increment)
+
+    def get(self, key):
+        return self._call(key, 'get')
+
+    def update_many(self, keys, increments=1):
+        """ Bulk CountMinSketch update; returns the keys evicted from the shards' top-k """
+        nbr_keys, results = self._call_many(keys, 'update_many', increments)
+        return [key for positions, evicted in results for key in evicted]
+
+    def update_digests(self, digests, increments=1, keys=None):
+        """ update_many() for pre-hashed keys (see CountMinSketch.update_digests) """
+        nbr_keys, results = self._call_digests(digests, 'update_digests', increments, keys)
+        return [key for positions, evicted in results for key in evicted]
+
+    def get_digests(self, digests):
+        """ Estimates of pre-hashed keys, as an array (see CountMinSketch.get_digests) """
+        nbr_keys, results = self._call_digests(digests, 'get_digests')
+        estimates = np.zeros(nbr_keys, dtype=np.int64)
+        for positions, result in results:
+            estimates[positions] = result
+        return estimates
+
+    def top(self, k=None):
+        """ Top-k [estimate, key] pairs of sharded CountMinSketches, largest first.
+
+            Keys live in a single shard, so the global top-k is among the shards' top-k.
+        """
+        pairs = [pair for heap in self.apply(lambda shard: [list(pair) for pair in shard.heap])
+                 for pair in heap]
+        pairs.sort(key=lambda pair: pair[0], reverse=True)
+        return pairs[:k if k is not None else self.shards[0].k]
+
+    def batched_expiration_maintenance(self, elapsed_time):
+        """ Run the CountdownBloomFilter maintenance of every shard """
+        return self.apply(lambda shard: shard.batched_expiration_maintenance(elapsed_time))[0]
+
+    def __len__(self):
+        """ Total count (or cardinality estimate): shards hold disjoint sets of keys """
+        return int(sum(self.apply(len)))
@@ -0,0 +1,153 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import struct
+import threading
+
+import numpy as np
+
+from .bloomfilter import BloomFilter
+from .cdbf import CountdownBloomFilter
+
+# Layout of a shared buffer: SHARED_HEADER, padded to 64 bytes, then the raw
+# storage of the structure (bitarray bytes or countdown cells).
+# magic, version, kind, nbr_bits, count, estimate_z
+SHARED_MAGIC = b'PBSM'
+SHARED_VERSION = 2
+SHARED_HEADER = struct.Struct('<4sHHQqd32x')
+SHARED_COUNT_OFFSET = 16
+SHARED_STATE_OFFSET = 24
+
+# Concurrency: processes can add to a shared filter without a lock.
+# BloomFilter bits are set with an atomic fetch-or and the counts are updated
+# with atomic adds, so no key is lost. Countdown cells are written one byte at
+# a time; the expiration maintenance should run in a single process, and is
+# the only writer of estimate_z. Counts stay approximate: two processes adding
+# the same key at once may both count it, the capacity check of a
+# CountdownBloomFilter can be passed by concurrent adds, and the maintenance
+# resets the count to its estimate from the cell occupancy. Use a lock shared
+# by the writers (e.g. multiprocessing.Lock) when exact counts matter.
+SHARED_KINDS = {BloomFilter: 1, CountdownBloomFilter: 2}
+
+_REGISTER_LOCK = threading.Lock()
+
+
+def _kind(structure):
+    try:
+        return SHARED_KINDS[type(structure)]
+    except KeyError:
+        raise TypeError("%s cannot be backed by shared memory" % type(structure).__name__)
+
+
+def shared_size(structure):
+    """Number of bytes of the shared buffer backing this structure."""
+    _kind(structure)
+    return SHARED_HEADER.size + structure._storage().nbytes
+
+
+def _bind(structure, buffer, create):
+    """Point the structure storage at buffer, copying the current content in if create."""
+    kind = _kind(structure)
+    storage = structure._storage()
+    if create:
+        SHARED_HEADER.pack_into(buffer, 0, SHARED_MAGIC, SHARED_VERSION, kind, structure.nbr_bits,
+                                structure.count, getattr(structure, 'estimate_z', 0))
+        np.frombuffer(buffer, dtype=np.uint8, count=storage.nbytes, offset=SHARED_HEADER.size)[:] = storage
+    else:
+        magic, version, shared_kind, nbr_bits, _, _ = SHARED_HEADER.unpack_from(buffer)
+        if magic != SHARED_MAGIC or version != SHARED_VERSION:
+            raise ValueError("Not a shared buffer of this version")
+        if (shared_kind, nbr_bits) != (kind, structure.nbr_bits):
+            raise ValueError("Shared buffer does not match the structure type or geometry")
+    structure._bind_storage(memoryview(buffer)[SHARED_HEADER.size:SHARED_HEADER.size + storage.nbytes])
+    structure.shared_count = np.frombuffer(buffer, dtype=np.int64, count=1, offset=SHARED_COUNT_OFFSET)
+    if isinstance(structure, CountdownBloomFilter):
+        structure.shared_state = np.frombuffer(buffer, dtype=np.float64, count=1, offset=SHARED_STATE_OFFSET)
+    structure._pull_shared_state()
+    return structure
+
+
+def _open_shared_memory(name, create, size=0):
+    from multiprocessing import shared_memory
+    if create:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    try:
+        # Attaching processes must not unlink the segment when they exit
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13, attaching registers the segment with the resource
+    # tracker of the process, which unlinks it (and warns) when the process
+    # exits. Unregistering it afterwards is no better: child processes share
+    # the tracker of their parent, which would forget the segment of its owner.
+    # So the registration is skipped instead.
+    from multiprocessing import resource_tracker
+    with _REGISTER_LOCK:
+        register = resource_tracker.register
+
+        def register_others(resource, rtype):
+            if rtype != 'shared_memory' or resource.lstrip('/') != name.lstrip('/'):
+                register(resource, rtype)
+        resource_tracker.register = register_others
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def create_shared(structure, name):
+    """Move the storage of a BloomFilter or CountdownBloomFilter into a new
+    multiprocessing.shared_memory segment called name.
+
+    Other processes build the same structure (same parameters) and call
+    attach_shared(structure, name) to work on the same bits or cells.
+    """
+    shm = _open_shared_memory(name, True, shared_size(structure))
+    structure.shared_memory = shm
+    return _bind(structure, shm.buf, create=True)
+
+
+def attach_shared(structure, name):
+    """Point a freshly built structure at the shared memory segment called name."""
+    shm = _open_shared_memory(name, False)
+    structure.shared_memory = shm
+    return _bind(structure, shm.buf, create=False)
+
+
+def create_memmap(structure, path):
+    """Like create_shared, backed by a file mapped with np.memmap."""
+    memmap = np.memmap(path, dtype=np.uint8, mode='w+', shape=(shared_size(structure),))
+    structure.shared_memory = memmap
+    return _bind(structure, memmap, create=True)
+
+
+def attach_memmap(structure, path):
+    """Like attach_shared, for a file created by create_memmap."""
+    if os.path.getsize(path) != shared_size(structure):
+        raise ValueError("%s does not match the structure geometry" % path)
+    memmap = np.memmap(path, dtype=np.uint8, mode='r+')
+    structure.shared_memory = memmap
+    return _bind(structure, memmap, create=False)
+
+
+def detach(structure, unlink=False):
+    """Copy the storage back into private memory and release the shared buffer.
+
+    With unlink, a shared memory segment is also destroyed (do it from one process).
+    """
+    backing = structure.shared_memory
+    if backing is None:
+        return structure
+    structure._bind_storage(bytearray(structure._storage().tobytes()))
+    structure._pull_shared_state()
+    structure.shared_count = None
+    if isinstance(structure, CountdownBloomFilter):
+        structure.shared_state = None
+    structure.shared_memory = None
+    if isinstance(backing, np.memmap):
+        backing.flush()
+    else:
+        backing.close()
+        if unlink:
+            backing.unlink()
+    return structure
@@ -3,9 +3,13 @@ from __future__ import absolute_import, division, print_function
 import datetime as dt
 import glob
 import math
+import mmap
 import os
+import struct
+import threading
 import time
 import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import bitarray
 import numpy as np
@@ -13,7 +17,43 @@ from six.moves import cPickle as pickle
 from six.moves import range
 
 from .bloomfilter import BloomFilter
-from .hashfunctions import generate_hashfunctions
+from .bulk import bloom_add, bloom_contains
+from .hashfunctions import (CHAINED, HASH_SCHEMES, check_hash_scheme, generate_digest_hashfunctions,
+                            generate_hashfunctions)
+
+# Snapshot formats: PICKLE is a zlib compressed pickle of the bitarray, RAW is a
+# fixed-size header followed by the bitarray bytes, which can be mmap-ed and
+# ORed in place.
+SNAPSHOT_PICKLE = 'pickle'
+SNAPSHOT_RAW = 'raw'
+SNAPSHOT_FORMATS = (SNAPSHOT_PICKLE, SNAPSHOT_RAW)
+
+# magic, version, hash scheme, nbr_slices, bits_per_slice, nbr_bits, date (YYYY-MM-DD)
+RAW_SNAPSHOT_MAGIC = b'PBDT'
+RAW_SNAPSHOT_VERSION = 1
+RAW_SNAPSHOT_HEADER = struct.Struct('<4sHHIQQ10s6x')
+
+
+def _or_raw_snapshot(target, filename, nbr_slices, bits_per_slice, hash_scheme):
+    """OR a raw snapshot into the target bitarray, in place, through a read-only mmap."""
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = bits = None
+        try:
+            header = RAW_SNAPSHOT_HEADER.unpack_from(mm)
+            _, version, scheme, snapshot_slices, snapshot_bits_per_slice, _, _ = header
+            if version != RAW_SNAPSHOT_VERSION:
+                raise ValueError("Unsupported snapshot version %d in %s" % (version, filename))
+            if (snapshot_slices, snapshot_bits_per_slice, HASH_SCHEMES[scheme]) != \
+                    (nbr_slices, bits_per_slice, hash_scheme):
+                raise ValueError("Snapshot %s does not match the filter geometry or hash scheme" % filename)
+            data = np.frombuffer(mm, dtype=np.uint8, offset=RAW_SNAPSHOT_HEADER.size)
+            bits = np.frombuffer(target, dtype=np.uint8)
+            np.bitwise_or(bits, data, out=bits)
+        finally:
+            # The mmap can only be closed once no array views it anymore
+            data = bits = None
+            mm.close()
 
 
 class DailyTemporalBloomFilter(object):
@@ -27,9 +67,16 @@ class DailyTemporalBloomFilter(object):
 
     The upper bound of the temporal_error can be theoricaly quite high. However, if the
     items of the set are uniformly distributed over time, the avg error will be something like 1.0 / expiration
+
+    With ring=True, the bitarray of each live day is kept in memory (day_planes) and
+    bitarray is the union of those planes. A per-bit count of the past planes setting
+    each bit (plane_counts) lets the daily maintenance subtract the expired planes and
+    add the closed one, instead of reloading every snapshot from disk or ORing every
+    live plane again. This costs expiration * nbr_bits bits plus nbr_bits bytes of memory.
     """
 
-    def __init__(self, capacity, error_rate, expiration, name, snapshot_path):
+    def __init__(self, capacity, error_rate, expiration, name, snapshot_path, hash_scheme=CHAINED,
+                 snapshot_format=SNAPSHOT_PICKLE, ring=False):
         self.error_rate = error_rate
         self.capacity = capacity
         self.nbr_slices = int(np.ceil(np.log2(1.0 / error_rate)))
@@ -37,16 +84,28 @@ class DailyTemporalBloomFilter(object):
         self.nbr_bits = self.nbr_slices * self.bits_per_slice
         self.initialize_bitarray()
         self.count = 0
-        self.hashes = generate_hashfunctions(self.bits_per_slice, self.nbr_slices)
+        self.hash_scheme = check_hash_scheme(hash_scheme)
+        self.hashes = generate_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
+        self.digest_hashes = generate_digest_hashfunctions(self.bits_per_slice, self.nbr_slices, hash_scheme)
         self.hashed_values = []
         self.name = name
         self.snapshot_path = snapshot_path
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError("snapshot format %r should be one of %r" % (snapshot_format, SNAPSHOT_FORMATS))
+        self.snapshot_format = snapshot_format
         self.expiration = expiration
         self.initialize_period()
+        self.ring = ring
+        self.day_planes = {self.current_period: self.current_day_bitarray} if ring else None
+        self.plane_counts = np.zeros(self.nbr_bits, dtype=np.uint8 if expiration < 256 else np.uint16) \
+            if ring else None
+        self.counted_planes = set()
         self.snapshot_to_load = None
         self.ready = False
         self.warm_period = None
         self.next_snapshot_load = time.time()
+        self.warm_loaded = 0
+        self.warm_total = 0
 
     def initialize_bitarray(self):
         """Initialize both bitarray.
@@ -56,10 +115,13 @@ class DailyTemporalBloomFilter(object):
         used for the membership query. The second one, current_day_bitarray is the one
         used for creating the daily snapshot.
         """
-        self.bitarray = bitarray.bitarray(self.nbr_bits)
-        self.current_day_bitarray = bitarray.bitarray(self.nbr_bits)
-        self.bitarray.setall(False)
-        self.current_day_bitarray.setall(False)
+        self.bitarray = self._empty_bitarray()
+        self.current_day_bitarray = self._empty_bitarray()
+
+    def _empty_bitarray(self):
+        empty = bitarray.bitarray(self.nbr_bits, endian='big')
+        empty.setall(False)
+        return empty
 
     def __contains__(self, key):
         """Check membership."""
@@ -84,6 +146,27 @@ class DailyTemporalBloomFilter(object):
         self.count += 1
         return False
 
+    def contains_digests(self, digests):
+        """Check the membership of pre-hashed keys (see hashfunctions.digests_array).
+
+        Needs the DOUBLE hash scheme. Returns a NumPy boolean array.
+        """
+        return bloom_contains(np.frombuffer(self.bitarray, dtype=np.uint8), self.digest_hashes(digests),
+                              self.bits_per_slice)
+
+    def add_digests(self, digests):
+        """Add pre-hashed keys (see hashfunctions.digests_array).
+
+        Needs the DOUBLE hash scheme. Returns a NumPy boolean array, True where the
+        key was already present: like add(), those are not added to the current day.
+        """
+        hashes = self.digest_hashes(digests)
+        found = bloom_add(np.frombuffer(self.bitarray, dtype=np.uint8), hashes, self.bits_per_slice)
+        bloom_add(np.frombuffer(self.current_day_bitarray, dtype=np.uint8), hashes[~found],
+                  self.bits_per_slice)
+        self.count += int(found.size - np.count_nonzero(found))
+        return found
+
     def initialize_period(self, period=None):
         """Initialize the period of BF.
 
@@ -100,12 +183,60 @@ class DailyTemporalBloomFilter(object):
         """Expire the old element of the set.
 
         Initialize a new bitarray and load the previous snapshot. Execute this guy
-        at the beginining of each day.
+        at the beginining of each day. In ring mode, only rotate the in memory day planes.
         """
         self.initialize_period()
+        if self.ring:
+            self.rotate_day_planes()
+            return
         self.initialize_bitarray()
         self.restore_from_disk()
 
+    def rotate_day_planes(self):
+        """Drop the expired day planes, start the current day one and update the union.
+
+        Only the planes leaving or entering plane_counts are unpacked: the expired ones
+        are subtracted and the past ones not counted yet (usually just yesterday) added.
+        The current plane is kept out of the counts, since add() writes to it directly.
+        """
+        last_period = self.current_period - dt.timedelta(days=self.expiration-1)
+        for period in [period for period in self.day_planes if period < last_period]:
+            self._uncount_day_plane(period)
+            del self.day_planes[period]
+        if self.current_period not in self.day_planes:
+            self.day_planes[self.current_period] = self._empty_bitarray()
+        self._uncount_day_plane(self.current_period)
+        for period, plane in self.day_planes.items():
+            if period != self.current_period and period not in self.counted_planes:
+                self.plane_counts += self._plane_bits(plane)
+                self.counted_planes.add(period)
+        self.current_day_bitarray = self.day_planes[self.current_period]
+        union = self._empty_bitarray()
+        np.frombuffer(union, dtype=np.uint8)[:] = np.packbits(self.plane_counts > 0)
+        union |= self.current_day_bitarray
+        self.bitarray = union
+
+    def _plane_bits(self, plane):
+        return np.unpackbits(np.frombuffer(plane, dtype=np.uint8), count=self.nbr_bits)
+
+    def _uncount_day_plane(self, period):
+        if period in self.counted_planes:
+            self.plane_counts -= self._plane_bits(self.day_planes[period])
+            self.counted_planes.discard(period)
+
+    def _store_day_plane(self, period, snapshot):
+        plane = self.day_planes.get(period)
+        if plane is None:
+            self.day_planes[period] = snapshot
+        else:
+            if period in self.counted_planes:
+                self.plane_counts += self._plane_bits(snapshot & ~plane)
+            plane |= snapshot
+
+    @staticmethod
+    def _snapshot_period(filename):
+        return dt.datetime.strptime(filename.split('_')[-1].strip('.dat'), "%Y-%m-%d")
+
     def compute_refresh_period(self):
         self.warm_period =  (60 * 60 * 24) // (self.expiration-2)
 
@@ -127,7 +258,7 @@ class DailyTemporalBloomFilter(object):
             base_filename = "%s/%s_%s_*.dat" % (self.snapshot_path, self.name, self.expiration)
             availables_snapshots = glob.glob(base_filename)
             for filename in availables_snapshots:
-                snapshot_period = dt.datetime.strptime(filename.split('_')[-1].strip('.dat'), "%Y-%m-%d")
+                snapshot_period = self._snapshot_period(filename)
                 if snapshot_period >= last_period:
                     self.snapshot_to_load.append(filename)
                     self.ready = False
@@ -141,12 +272,97 @@ class DailyTemporalBloomFilter(object):
                 self.ready = True
 
 
-    def _union_bf_from_file(self, filename, current=False):
-        snapshot = pickle.loads(zlib.decompress(open(filename,'r').read()))
-        if current:
-            self.current_day_bitarray = self.current_day_bitarray | snapshot
+    def warm_async(self, max_workers=4):
+        """Load all the live snapshots in the background.
+
+        The snapshots are decompressed (zlib releases the GIL) and ORed by a thread
+        pool into a new bitarray, while this BF keeps answering queries with its
+        current one. Once every snapshot is in, the keys added in the meantime are
+        folded in and the new bitarray replaces self.bitarray in one assignment.
+        Progress is reported by warm_progress().
+
+        Returns a concurrent.futures.Future resolved (with None) once the swap is done.
+        """
+        last_period = self.current_period - dt.timedelta(days=self.expiration-1)
+        base_filename = "%s/%s_%s_*.dat" % (self.snapshot_path, self.name, self.expiration)
+        snapshots = []
+        for filename in glob.glob(base_filename):
+            snapshot_period = self._snapshot_period(filename)
+            if snapshot_period >= last_period:
+                snapshots.append((filename, snapshot_period))
+        self.ready = False
+        self.warm_loaded = 0
+        self.warm_total = len(snapshots)
+        done = Future()
+        thread = threading.Thread(target=self._warm_all, args=(snapshots, max_workers, done))
+        thread.daemon = True
+        thread.start()
+        return done
+
+    def _warm_all(self, snapshots, max_workers, done):
+        try:
+            staging = self._empty_bitarray()
+            lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(self._warm_one, filename, period, staging, lock)
+                               for filename, period in snapshots]:
+                    future.result()
+            staging |= self.bitarray
+            previous, self.bitarray = self.bitarray, staging
+            # Catch the keys added to the previous bitarray during the swap
+            staging |= previous
+            self.ready = True
+            done.set_result(None)
+        except Exception as e:
+            done.set_exception(e)
+
+    def _warm_one(self, filename, period, staging, lock):
+        snapshot = self._read_snapshot(filename)
+        with lock:
+            staging |= snapshot
+            if self.ring:
+                self._store_day_plane(period, snapshot)
+            elif period == self.current_period:
+                self.current_day_bitarray |= snapshot
+            self.warm_loaded += 1
+
+    def warm_progress(self):
+        """Fraction of the snapshots loaded by the running (or last) warm_async()."""
+        if not self.warm_total:
+            return 1.0 if self.ready else 0.0
+        return self.warm_loaded / self.warm_total
+
+    def _read_snapshot(self, filename):
+        """Load a snapshot file into a new bitarray."""
+        snapshot = self._empty_bitarray()
+        self._or_snapshot(snapshot, filename)
+        return snapshot
+
+    def _or_snapshot(self, target, filename):
+        """OR a snapshot file into target, in place.
+
+        The format is detected from the first bytes of the file.
+        """
+        with open(filename, 'rb') as f:
+            raw = f.read(len(RAW_SNAPSHOT_MAGIC)) == RAW_SNAPSHOT_MAGIC
+        if raw:
+            _or_raw_snapshot(target, filename, self.nbr_slices, self.bits_per_slice, self.hash_scheme)
         else:
-            self.bitarray = self.bitarray | snapshot
+            with open(filename, 'rb') as f:
+                target |= pickle.loads(zlib.decompress(f.read()))
+
+    def _union_bf_from_file(self, filename, current=False):
+        """OR a snapshot into the main (or current day) bitarray, in place.
+
+        In ring mode, the snapshot is also kept as the plane of its day.
+        """
+        if self.ring:
+            snapshot = self._read_snapshot(filename)
+            self._store_day_plane(self._snapshot_period(filename), snapshot)
+            if not current:
+                self.bitarray |= snapshot
+            return
+        self._or_snapshot(self.current_day_bitarray if current else self.bitarray, filename)
 
     def restore_from_disk(self, clean_old_snapshot=False):
         """Restore the state of the BF using previous snapshots.
@@ -157,7 +373,7 @@ class DailyTemporalBloomFilter(object):
         availables_snapshots = glob.glob(base_filename)
         last_period = self.current_period - dt.timedelta(days=self.expiration-1)
         for filename in availables_snapshots:
-            snapshot_period = dt.datetime.strptime(filename.split('_')[-1].strip('.dat'), "%Y-%m-%d")
+            snapshot_period = self._snapshot_period(filename)
             if snapshot_period <  last_period and not clean_old_snapshot:
                 continue
             else:
@@ -174,10 +390,18 @@ class DailyTemporalBloomFilter(object):
 
         Save the internal representation (bitarray) into a binary file using this format:
             filename : name_expiration_2013-01-01.dat
+        The content is either a compressed pickle or, with the RAW snapshot format,
+        a RAW_SNAPSHOT_HEADER followed by the raw bytes of the bitarray.
         """
         filename = "%s/%s_%s_%s.dat" % (self.snapshot_path, self.name, self.expiration, self.date)
-        with open(filename, 'w') as f:
-            f.write(zlib.compress(pickle.dumps(self.current_day_bitarray, protocol=pickle.HIGHEST_PROTOCOL)))
+        with open(filename, 'wb') as f:
+            if self.snapshot_format == SNAPSHOT_RAW:
+                f.write(RAW_SNAPSHOT_HEADER.pack(RAW_SNAPSHOT_MAGIC, RAW_SNAPSHOT_VERSION,
+                                                 HASH_SCHEMES.index(self.hash_scheme), self.nbr_slices,
+                                                 self.bits_per_slice, self.nbr_bits, self.date.encode('ascii')))
+                f.write(self.current_day_bitarray.tobytes())
+            else:
+                f.write(zlib.compress(pickle.dumps(self.current_day_bitarray, protocol=pickle.HIGHEST_PROTOCOL)))
 
     def union_current_day(self, bf):
         """Union only the current_day of an other BF."""
@@ -13,6 +13,11 @@ extensions = [
         [join("probably", "maintenance.pyx")],
         include_dirs=[np.get_include()],
     ),
+    Extension(
+        "probably.bulk",
+        [join("probably", "bulk.pyx")],
+        include_dirs=[np.get_include()],
+    ),
 ]
 
 setup(
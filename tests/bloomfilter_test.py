@@ -0,0 +1,212 @@
+from __future__ import absolute_import, print_function
+
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably import BlockedBloomFilter, BloomFilter, ScalableBloomFilter
+from probably.bloomfilter import BLOOM_FILTER_PARAMS
+from probably.hashfunctions import DOUBLE, digest_many
+from probably.serialization import BLOOM_FILTER, MAGIC, PREFIX
+
+
+class BloomFilterTests(unittest.TestCase):
+    '''
+    Tests for BloomFilter
+    '''
+    def setUp(self):
+        self.bf = BloomFilter(1000, 0.02)
+        self.keys = [str(i) for i in range(500)]
+
+    def test_add(self):
+        assert not self.bf.add('random_uuid')
+        assert self.bf.add('random_uuid')
+        assert 'random_uuid' in self.bf
+        assert len(self.bf.bitarray) == self.bf.nbr_bits
+        # Membership checks leave the shared state alone
+        hashed_values = self.bf.hashed_values
+        assert 'other_uuid' not in self.bf
+        assert self.bf.hashed_values is hashed_values
+
+    def test_add_many(self):
+        found = self.bf.add_many(self.keys + self.keys[:10])
+        assert found.dtype == np.bool_
+        assert not found[:500].any()
+        assert found[500:].all()
+        assert self.bf.count == 500
+
+    def test_add_many_matches_add(self):
+        other = BloomFilter(1000, 0.02)
+        for key in self.keys:
+            other.add(key)
+        self.bf.add_many(self.keys)
+        assert self.bf.bitarray == other.bitarray
+
+    def test_contains_many(self):
+        for key in self.keys:
+            self.bf.add(key)
+        assert self.bf.contains_many(self.keys).all()
+        others = [str(i) for i in range(1000, 2000)]
+        found = self.bf.contains_many(others)
+        np.testing.assert_array_equal(found, [key in self.bf for key in others])
+        assert found.mean() < 0.05
+
+    def test_double_hashing(self):
+        bf = BloomFilter(1000, 0.02, hash_scheme=DOUBLE)
+        assert bf.hash_scheme == DOUBLE
+        assert not bf.add_many(self.keys).any()
+        assert all(key in bf for key in self.keys)
+        assert bf.bitarray != self.bf.bitarray
+
+    def test_digests(self):
+        bf = BloomFilter(1000, 0.02, hash_scheme=DOUBLE)
+        bf.add_many(self.keys[:250])
+        found = bf.add_digests(digest_many(self.keys))
+        assert found[:250].all() and not found[250:].any()
+        assert bf.count == 500
+        other = BloomFilter(1000, 0.02, hash_scheme=DOUBLE)
+        other.add_many(self.keys)
+        assert bf.bitarray == other.bitarray
+        others = [str(i) for i in range(1000, 2000)]
+        np.testing.assert_array_equal(bf.contains_digests(digest_many(others)), bf.contains_many(others))
+        self.assertRaises(ValueError, self.bf.add_digests, digest_many(self.keys))
+
+    def test_serialization(self):
+        self.bf.add_many(self.keys)
+        for compress in (False, True):
+            bf = BloomFilter.from_bytes(self.bf.to_bytes(compress))
+            assert (bf.capacity, bf.error_rate, bf.count) == (1000, 0.02, 500)
+            assert bf.contains_many(self.keys).all()
+            assert bf._bit_buffer().tobytes() == self.bf._bit_buffer().tobytes()
+            assert not bf.add('random_uuid')
+
+    def test_serialization_zero_copy(self):
+        # 8160 bits: whole bytes, which a bitarray over the data can hold
+        data = bytearray(BloomFilter(1002, 0.02).to_bytes())
+        bf = BloomFilter.from_bytes(data)
+        bf.add('random_uuid')
+        assert 'random_uuid' in BloomFilter.from_bytes(data)
+        self.assertRaises(ValueError, BloomFilter.from_bytes, b'PRBX' + bytes(data[4:]))
+
+    def test_serialization_partial_byte(self):
+        bf = BloomFilter(1000, 0.01)
+        assert bf.nbr_slices * bf.bits_per_slice % 8
+        bf.add_many(self.keys)
+        for data in (bf.to_bytes(), bytearray(bf.to_bytes())):
+            loaded = BloomFilter.from_bytes(data)
+            assert len(loaded.bitarray) == loaded.nbr_bits
+            assert loaded.bitarray == bf.bitarray
+            fresh = BloomFilter(1000, 0.01)
+            fresh.add('random_uuid')
+            loaded.bitarray |= fresh.bitarray
+            assert loaded.contains_many(self.keys + ['random_uuid']).all()
+            assert loaded.bitarray == bf.bitarray | fresh.bitarray
+        # Shared with the data however many bits the slices take
+        data = bytearray(bf.to_bytes())
+        BloomFilter.from_bytes(data).add('random_uuid')
+        assert 'random_uuid' in BloomFilter.from_bytes(data)
+
+    def test_serialization_version_1(self):
+        # Unpadded header, nbr_bits not rounded up to whole bytes
+        self.bf.add_many(self.keys)
+        data = (PREFIX.pack(MAGIC, 1, BLOOM_FILTER, 0) +
+                BLOOM_FILTER_PARAMS.pack(1000, 0.02, self.bf.nbr_slices * self.bf.bits_per_slice, 500, 0) +
+                self.bf.bitarray.tobytes())
+        bf = BloomFilter.from_bytes(data)
+        assert bf.bitarray == self.bf.bitarray and bf.count == 500
+        # Version 2 pads the header to a multiple of 8 bytes
+        assert (len(self.bf.to_bytes()) - len(self.bf.bitarray.tobytes())) % 8 == 0
+
+
+class ScalableBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for ScalableBloomFilter
+    '''
+    def setUp(self):
+        self.sbf = ScalableBloomFilter(100, 0.01)
+        self.keys = [str(i) for i in range(1000)]
+
+    def test_add(self):
+        false_positives = sum(self.sbf.add(key) for key in self.keys)
+        assert false_positives < 10
+        assert all(key in self.sbf for key in self.keys)
+        assert len(self.sbf.stages) == 4
+        assert [stage.capacity for stage in self.sbf.stages] == [100, 200, 400, 800]
+        assert all(stage.count <= stage.capacity for stage in self.sbf.stages)
+        assert self.sbf.count == 1000 - false_positives
+        assert self.sbf.add('0')
+
+    def test_add_many(self):
+        found = self.sbf.add_many(self.keys + self.keys[:10])
+        assert found[:1000].sum() < 10 and found[1000:].all()
+        assert [stage.count for stage in self.sbf.stages][:3] == [100, 200, 400]
+        assert self.sbf.count == 1000 - found[:1000].sum()
+        assert self.sbf.contains_many(self.keys).all()
+
+    def test_digests(self):
+        sbf = ScalableBloomFilter(100, 0.01, hash_scheme=DOUBLE)
+        found = sbf.add_digests(digest_many(self.keys + self.keys[:10]))
+        assert found[1000:].all()
+        assert sbf.count == 1000 - found[:1000].sum()
+        other = ScalableBloomFilter(100, 0.01, hash_scheme=DOUBLE)
+        np.testing.assert_array_equal(other.add_many(self.keys + self.keys[:10]), found)
+        others = [str(i) for i in range(10000, 12000)]
+        np.testing.assert_array_equal(sbf.contains_digests(digest_many(others)), other.contains_many(others))
+
+    def test_error_rate(self):
+        self.sbf.add_many(self.keys)
+        others = [str(i) for i in range(10000, 30000)]
+        found = self.sbf.contains_many(others)
+        np.testing.assert_array_equal(found, [key in self.sbf for key in others])
+        assert found.mean() < 0.01
+
+
+class BlockedBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for BlockedBloomFilter
+    '''
+    def setUp(self):
+        self.bf = BlockedBloomFilter(10000, 0.01)
+        self.keys = [str(i) for i in range(10000)]
+
+    def test_geometry(self):
+        assert self.bf.words.ctypes.data % 64 == 0
+        assert self.bf.words.size == self.bf.nbr_blocks * 8
+        plain = BloomFilter(10000, 0.01)
+        assert plain.nbr_bits < self.bf.nbr_bits < 1.2 * plain.nbr_bits
+        assert self.bf.estimated_error_rate(10000) <= 0.01
+
+    def test_add(self):
+        assert not self.bf.add('random_uuid')
+        assert self.bf.add('random_uuid')
+        assert 'random_uuid' in self.bf
+        assert len(self.bf) == 1
+
+    def test_add_many(self):
+        found = self.bf.add_many(self.keys + self.keys[:10])
+        assert found[:10000].sum() < 100 and found[10000:].all()
+        assert len(self.bf) == 10000 - found[:10000].sum()
+        other = BlockedBloomFilter(10000, 0.01)
+        for key in self.keys:
+            other.add(key)
+        np.testing.assert_array_equal(self.bf.words, other.words)
+
+    def test_error_rate(self):
+        self.bf.add_many(self.keys)
+        assert self.bf.contains_many(self.keys).all()
+        others = [str(i) for i in range(100000, 200000)]
+        found = self.bf.contains_many(others)
+        np.testing.assert_array_equal(found[:1000], [key in self.bf for key in others[:1000]])
+        assert abs(found.mean() - self.bf.estimated_error_rate()) < 0.002
+
+    def test_digests(self):
+        found = self.bf.add_digests(digest_many(self.keys))
+        other = BlockedBloomFilter(10000, 0.01)
+        np.testing.assert_array_equal(other.add_many(self.keys), found)
+        np.testing.assert_array_equal(self.bf.words, other.words)
+        others = [str(i) for i in range(100000, 110000)]
+        np.testing.assert_array_equal(self.bf.contains_digests(digest_many(others)), other.contains_many(others))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ import numpy as np
 from six.moves import range
 
 from probably import CountdownBloomFilter
+from probably.hashfunctions import DOUBLE, digest_many
 
 
 class CountdownBloomFilterTests(unittest.TestCase):
@@ -78,20 +79,34 @@ class CountdownBloomFilterTests(unittest.TestCase):
         assert not self.bf.add('random_uuid')
         uuid_exists = self.bf.add('random_uuid')
         assert uuid_exists
-        elapsed = 0
         start = time.time()
+        last = start
+        pending = 0.0
         while uuid_exists:
-            t1 = time.time()
-            if elapsed:
-                self.bf.batched_expiration_maintenance(elapsed)
+            now = time.time()
+            # Carry over the fraction of a maintenance step not run yet
+            pending += now - last
+            last = now
+            pending -= self.bf.batched_expiration_maintenance(pending)
             uuid_exists = 'random_uuid' in self.bf
-            t2 = time.time()
-            elapsed = t2 - t1
         experimental_expiration = time.time() - start
         print(experimental_expiration)
         # See if we finished in roughly the right amount of time
         assert (experimental_expiration - self.expiration) < 0.40
 
+    def test_expiration_small_steps(self):
+        assert not self.bf.add('random_uuid')
+        assert self.bf.add('random_uuid')
+        # Simulated clock ticking by a fraction of a millisecond, the interval
+        # not processed yet being carried over to the next call
+        step = 1e-4
+        now = pending = 0.0
+        while 'random_uuid' in self.bf:
+            now += step
+            pending += step
+            pending -= self.bf.batched_expiration_maintenance(pending)
+        assert abs(now - self.expiration) < 0.40
+
     def test_expiration(self):
         assert not self.bf.add('random_uuid')
         assert self.bf.add('random_uuid')
@@ -121,6 +136,82 @@ class CountdownBloomFilterTests(unittest.TestCase):
                                0.304,
                                places=3)
 
+    def test_add_many(self):
+        keys = [str(i) for i in range(300)]
+        found = self.bf.add_many(keys + keys[:5])
+        assert not found[:300].any()
+        assert found[300:].all()
+        assert self.bf.count == 300
+        other = CountdownBloomFilter(1000, 0.02, self.expiration)
+        for key in keys:
+            other.add(key)
+        np.testing.assert_array_equal(self.bf.cellarray, other.cellarray)
+
+    def test_contains_many(self):
+        keys = [str(i) for i in range(300)]
+        self.bf.add_many(keys)
+        assert self.bf.contains_many(keys).all()
+        others = [str(i) for i in range(1000, 1300)]
+        np.testing.assert_array_equal(self.bf.contains_many(others),
+                                      [key in self.bf for key in others])
+
+    def test_digests(self):
+        keys = [str(i) for i in range(300)]
+        bf = CountdownBloomFilter(1000, 0.02, self.expiration, hash_scheme=DOUBLE)
+        found = bf.add_digests(digest_many(keys + keys[:5]))
+        assert not found[:300].any() and found[300:].all()
+        other = CountdownBloomFilter(1000, 0.02, self.expiration, hash_scheme=DOUBLE)
+        other.add_many(keys)
+        np.testing.assert_array_equal(bf.cellarray, other.cellarray)
+        assert bf.contains_digests(digest_many(keys)).all()
+        self.assertRaises(ValueError, self.bf.contains_digests, digest_many(keys))
+
+    def test_add_many_capacity(self):
+        keys = [str(i) for i in range(20)]
+        bf = CountdownBloomFilter(10, 0.02, self.expiration)
+        with self.assertRaises(IndexError):
+            bf.add_many(keys)
+        other = CountdownBloomFilter(10, 0.02, self.expiration)
+        with self.assertRaises(IndexError):
+            for key in keys:
+                other.add(key)
+        assert bf.count == other.count == 11
+        np.testing.assert_array_equal(bf.cellarray, other.cellarray)
+        other = CountdownBloomFilter(10, 0.02, self.expiration)
+        found = other.add_many(keys + keys, stop_at_capacity=True)
+        assert found.shape[0] < 20 and other.count == np.count_nonzero(~found) == 11
+        np.testing.assert_array_equal(bf.cellarray, other.cellarray)
+        bf = CountdownBloomFilter(10, 0.02, self.expiration, disable_hard_capacity=True)
+        assert bf.add_many(keys).shape == (20,)
+        assert bf.count > 11
+
+    def test_serialization(self):
+        self.bf.add_many([str(i) for i in range(100)])
+        self.bf.batched_expiration_maintenance(self.batch_refresh_period)
+        for compress in (False, True):
+            bf = CountdownBloomFilter.from_bytes(self.bf.to_bytes(compress))
+            np.testing.assert_array_equal(bf.cellarray, self.bf.cellarray)
+            for attribute in ('count', 'refresh_head', 'estimate_z', 'z', 'expiration', 'counter_init'):
+                assert getattr(bf, attribute) == getattr(self.bf, attribute)
+            assert bf.cellarray.flags.writeable
+
+    def test_serialization_kind(self):
+        from probably import BloomFilter
+        self.assertRaises(ValueError, CountdownBloomFilter.from_bytes, BloomFilter(1000, 0.02).to_bytes())
+
+    def test_batched_maintenance_matches_dev(self):
+        self.bf.add_many([str(i) for i in range(500)])
+        self.bf.cellarray[::7] = np.arange(self.bf.cellarray[::7].size) % 256
+        other = CountdownBloomFilter(1000, 0.02, self.expiration)
+        other.cellarray[:] = self.bf.cellarray
+        refresh_time = self.bf.compute_refresh_time()
+        # Partial range, wrapping range, then several laps over the whole array
+        for iterations in (1000, self.bf.nbr_bits - 500, 3 * self.bf.nbr_bits + 17):
+            self.bf.batched_expiration_maintenance((iterations + 0.5) * refresh_time)
+            other.batched_expiration_maintenance_dev((iterations + 0.5) * refresh_time)
+            np.testing.assert_array_equal(self.bf.cellarray, other.cellarray)
+            assert self.bf.refresh_head == other.refresh_head
+
 
 if __name__ == '__main__':
     unittest.main()
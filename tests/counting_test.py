@@ -0,0 +1,81 @@
+from __future__ import absolute_import, print_function
+
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably import CountdownBloomFilter, CountingBloomFilter
+from probably.hashfunctions import DOUBLE, digest_many
+
+
+class CountingBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for CountingBloomFilter
+    '''
+    def setUp(self):
+        self.bf = CountingBloomFilter(1000, 0.02)
+        self.keys = [str(i) for i in range(500)]
+
+    def test_memory(self):
+        cdbf = CountdownBloomFilter(1000, 0.02)
+        assert self.bf.nbr_bits == cdbf.nbr_bits
+        assert self.bf.cellarray.nbytes == (cdbf.cellarray.nbytes + 1) // 2
+
+    def test_add_remove(self):
+        assert not self.bf.add('random_uuid')
+        assert self.bf.add('random_uuid')
+        assert 'random_uuid' in self.bf
+        assert self.bf.remove('random_uuid')
+        assert 'random_uuid' in self.bf
+        assert self.bf.remove('random_uuid')
+        assert 'random_uuid' not in self.bf
+        assert not self.bf.remove('random_uuid')
+        assert len(self.bf) == 0
+        assert not self.bf.cellarray.any()
+
+    def test_counters(self):
+        hashes = self.bf.make_hashes('random_uuid')
+        indexes = np.arange(self.bf.nbr_slices) * self.bf.bits_per_slice + hashes
+        for i in range(20):
+            self.bf.add('random_uuid')
+        counters = self.bf.counters()
+        assert counters.shape == (self.bf.nbr_bits,)
+        assert (counters[indexes] == 15).all()
+        assert counters.sum() == 15 * self.bf.nbr_slices
+        # Saturated counters stick
+        for i in range(20):
+            self.bf.remove('random_uuid')
+        assert 'random_uuid' in self.bf
+
+    def test_many(self):
+        found = self.bf.add_many(self.keys + self.keys[:10])
+        assert found[:500].sum() < 10 and found[500:].all()
+        assert len(self.bf) == 510
+        other = CountingBloomFilter(1000, 0.02)
+        for key in self.keys + self.keys[:10]:
+            other.add(key)
+        np.testing.assert_array_equal(self.bf.cellarray, other.cellarray)
+        assert self.bf.contains_many(self.keys).all()
+        removed = self.bf.remove_many(self.keys[:10] * 2)
+        assert removed.all()
+        assert len(self.bf) == 490
+        assert self.bf.contains_many(self.keys[10:]).all()
+        assert self.bf.contains_many(self.keys[:10]).sum() < 3
+        self.bf.remove_many(self.keys)
+        assert not self.bf.cellarray.any()
+
+    def test_digests(self):
+        bf = CountingBloomFilter(1000, 0.02, hash_scheme=DOUBLE)
+        digests = digest_many(self.keys)
+        assert not bf.add_digests(digests).any()
+        other = CountingBloomFilter(1000, 0.02, hash_scheme=DOUBLE)
+        other.add_many(self.keys)
+        np.testing.assert_array_equal(bf.cellarray, other.cellarray)
+        assert bf.contains_digests(digests).all()
+        assert bf.remove_digests(digests).all()
+        assert not bf.cellarray.any() and len(bf) == 0
+        self.assertRaises(ValueError, self.bf.add_digests, digests)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+from __future__ import absolute_import, print_function
+
+import copy
+import random
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably import CountMinSketch, WindowedCountMinSketch
+from probably.hashfunctions import DOUBLE, digest_many
+
+
+class CountMinSketchTests(unittest.TestCase):
+    '''
+    Tests for CountMinSketch
+    '''
+    def setUp(self):
+        self.cms = CountMinSketch(10 ** -3, 0.01, 10)
+        self.stream = []
+        for i in range(100):
+            self.stream += [str(i)] * i
+        random.Random(42).shuffle(self.stream)
+
+    def check_heap(self, cms):
+        assert len(cms.heap) == len(cms.top_k) == len(cms.heap_positions)
+        for pos, pair in enumerate(cms.heap):
+            assert cms.heap_positions[pair[1]] == pos
+            assert cms.top_k[pair[1]] is pair
+            assert pair[0] <= cms.get(pair[1])
+            if pos:
+                assert not pair < cms.heap[(pos - 1) // 2]
+
+    def test_update(self):
+        for key in self.stream:
+            self.cms.update(key, 1)
+        assert self.cms.get('99') >= 99
+        assert self.cms.get('1') >= 1
+        self.check_heap(self.cms)
+        assert set(self.cms.top_k) == set(str(i) for i in range(90, 100))
+
+    def test_update_many(self):
+        for key in self.stream:
+            self.cms.update(key, 1)
+        other = CountMinSketch(10 ** -3, 0.01, 10)
+        other.update_many(self.stream[:1000])
+        other.update_many(self.stream[1000:], np.ones(len(self.stream) - 1000, dtype=np.int32))
+        np.testing.assert_array_equal(self.cms.count, other.count)
+        self.check_heap(other)
+        assert set(other.top_k) == set(self.cms.top_k)
+
+    def test_update_many_increments(self):
+        self.cms.update_many(['a', 'b', 'a'], [1, 2, 3])
+        assert self.cms.get('a') == 4
+        assert self.cms.get('b') == 2
+        assert self.cms.heap[0] == [2, 'b']
+
+    def test_update_many_evicted(self):
+        cms = CountMinSketch(10 ** -3, 0.01, 2)
+        cms.update_many(['a', 'b'], [1, 2])
+        assert cms.update_many(['c'], [5]) == ['a']
+        assert set(cms.top_k) == set(['b', 'c'])
+        self.check_heap(cms)
+
+    def test_digests(self):
+        cms = CountMinSketch(10 ** -3, 0.01, 10, hash_scheme=DOUBLE)
+        cms.update_digests(digest_many(self.stream), keys=self.stream)
+        for keys in (self.stream[1:], self.stream + ['extra']):
+            self.assertRaises(ValueError, cms.update_digests, digest_many(self.stream), keys=keys)
+        other = CountMinSketch(10 ** -3, 0.01, 10, hash_scheme=DOUBLE)
+        other.update_many(self.stream)
+        np.testing.assert_array_equal(cms.count, other.count)
+        assert sorted(cms.heap) == sorted(other.heap)
+        keys = [str(i) for i in range(100)]
+        np.testing.assert_array_equal(cms.get_digests(digest_many(keys)), [other.get(key) for key in keys])
+        np.testing.assert_array_equal(cms.get_many(keys), [other.get(key) for key in keys])
+        # Without the keys, only the counters are updated
+        cms = CountMinSketch(10 ** -3, 0.01, 10, hash_scheme=DOUBLE)
+        assert cms.update_digests(digest_many(self.stream), 2) == []
+        np.testing.assert_array_equal(cms.count, 2 * other.count)
+        assert cms.heap == []
+        self.assertRaises(ValueError, self.cms.get_digests, digest_many(keys))
+
+    def test_conservative(self):
+        cms = CountMinSketch(10 ** -2, 0.1, 10, conservative=True)
+        plain = CountMinSketch(10 ** -2, 0.1, 10)
+        for key in self.stream:
+            cms.update(key, 1)
+            plain.update(key, 1)
+        self.check_heap(cms)
+        for i in range(100):
+            assert i <= cms.get(str(i)) <= plain.get(str(i))
+        assert cms.count.sum() < plain.count.sum()
+        self.assertRaises(ValueError, cms.update, 'a', -1)
+
+    def test_conservative_update_many(self):
+        cms = CountMinSketch(10 ** -2, 0.1, 10, conservative=True)
+        plain = CountMinSketch(10 ** -2, 0.1, 10)
+        for start in range(0, len(self.stream), 500):
+            cms.update_many(self.stream[start:start + 500])
+            plain.update_many(self.stream[start:start + 500])
+        self.check_heap(cms)
+        for i in range(100):
+            assert i <= cms.get(str(i)) <= plain.get(str(i))
+        self.assertRaises(ValueError, cms.update_many, ['a'], [-1])
+
+    def test_serialization(self):
+        self.cms.update_many(self.stream)
+        for compress in (False, True):
+            cms = CountMinSketch.from_bytes(self.cms.to_bytes(compress))
+            np.testing.assert_array_equal(cms.count, self.cms.count)
+            assert cms.heap == self.cms.heap
+            self.check_heap(cms)
+            cms.update('99', 10)
+            assert cms.get('99') == self.cms.get('99') + 10
+
+    def test_serialization_aligned(self):
+        self.cms.update_many(self.stream)
+        self.cms.merge(copy.deepcopy(self.cms), widen=True)
+        data = bytearray(self.cms.to_bytes())
+        cms = CountMinSketch.from_bytes(data)
+        assert cms.count.dtype == np.int64 and cms.count.flags.aligned
+        cms.update('99', 10)
+        assert CountMinSketch.from_bytes(data).get('99') == self.cms.get('99') + 10
+
+    def test_serialization_key_types(self):
+        self.cms.update_many([b'\x00\xff%d' % i for i in range(1, 20) for j in range(i)])
+        for compress in (False, True):
+            cms = CountMinSketch.from_bytes(self.cms.to_bytes(compress))
+            assert cms.heap == self.cms.heap
+            assert sorted(cms.top_k) == [b'\x00\xff%d' % i for i in range(10, 20)]
+            self.check_heap(cms)
+            assert cms.update_many([b'\x00\xff19'] * 100) == []
+        self.cms.update(('a', 1), 1000)
+        self.assertRaises(TypeError, self.cms.to_bytes)
+
+    def test_merge(self):
+        half = len(self.stream) // 2
+        other = CountMinSketch(10 ** -3, 0.01, 10)
+        self.cms.update_many(self.stream[:half])
+        other.update_many(self.stream[half:])
+        whole = CountMinSketch(10 ** -3, 0.01, 10)
+        whole.update_many(self.stream)
+        self.cms.merge(other)
+        np.testing.assert_array_equal(self.cms.count, whole.count)
+        self.check_heap(self.cms)
+        assert sorted(self.cms.top_k) == sorted(str(i) for i in range(90, 100))
+        self.assertRaises(ValueError, self.cms.merge, CountMinSketch(10 ** -3, 0.02, 10))
+        self.assertRaises(ValueError, self.cms.merge, CountMinSketch(10 ** -3, 0.01, 10, hash_scheme=DOUBLE))
+        self.assertRaises(ValueError, self.cms.merge, CountMinSketch(10 ** -3, 0.01, 10, conservative=True))
+        self.assertRaises(ValueError, CountMinSketch.merge_many,
+                          [CountMinSketch(10 ** -3, 0.01, 10, conservative=True), self.cms])
+
+    def test_merge_many(self):
+        sketches = []
+        for start in range(0, len(self.stream), 1000):
+            cms = CountMinSketch(10 ** -3, 0.01, 10)
+            cms.update_many(self.stream[start:start + 1000])
+            sketches.append(cms)
+        self.cms.update_many(self.stream)
+        merged = CountMinSketch.merge_many(sketches)
+        np.testing.assert_array_equal(merged.count, self.cms.count)
+        assert merged is not sketches[0] and sketches[0].count.sum() < merged.count.sum()
+        self.check_heap(merged)
+        assert sorted(merged.top_k) == sorted(self.cms.top_k)
+        self.assertRaises(ValueError, CountMinSketch.merge_many, [])
+
+    def test_merge_overflow(self):
+        self.cms.update('a', np.iinfo(np.int32).max - 1)
+        other = copy.deepcopy(self.cms)
+        self.assertRaises(OverflowError, self.cms.merge, other)
+        self.cms.merge(other, widen=True)
+        assert self.cms.count.dtype == np.int64
+        assert self.cms.get('a') == 2 * (np.iinfo(np.int32).max - 1)
+        assert self.cms.top_k['a'][0] == self.cms.get('a')
+
+
+class WindowedCountMinSketchTests(unittest.TestCase):
+    '''
+    Tests for WindowedCountMinSketch
+    '''
+    def setUp(self):
+        self.cms = WindowedCountMinSketch(10 ** -3, 0.01, 5, window=60, nbr_panes=4)
+
+    def test_update(self):
+        plain = CountMinSketch(10 ** -3, 0.01, 5)
+        for i in range(20):
+            self.cms.update(str(i), i)
+            plain.update(str(i), i)
+        self.cms.update_many([str(i) for i in range(20)], 2)
+        plain.update_many([str(i) for i in range(20)], 2)
+        np.testing.assert_array_equal(self.cms.count, plain.count)
+        np.testing.assert_array_equal(self.cms.panes.sum(axis=0), self.cms.count)
+        assert sorted(self.cms.top_k) == sorted(plain.top_k)
+
+    def test_expiration(self):
+        self.cms.update_many(['old'] * 10)
+        assert self.cms.batched_expiration_maintenance(14.9) == 0
+        assert self.cms.batched_expiration_maintenance(20) == 15
+        self.cms.update_many(['new'] * 5 + ['old'])
+        assert self.cms.batched_expiration_maintenance(30) == 30
+        assert (self.cms.get('old'), self.cms.get('new')) == (11, 5)
+        self.cms.batched_expiration_maintenance(15)
+        assert (self.cms.get('old'), self.cms.get('new')) == (1, 5)
+        assert self.cms.top_k['old'][0] == 1
+        np.testing.assert_array_equal(self.cms.panes.sum(axis=0), self.cms.count)
+        self.cms.batched_expiration_maintenance(600)
+        assert not self.cms.count.any() and not self.cms.panes.any()
+
+    def test_merge(self):
+        other = CountMinSketch(10 ** -3, 0.01, 5)
+        other.update_many(['a'] * 3)
+        self.cms.update_many(['a'])
+        self.cms.merge(other)
+        assert self.cms.get('a') == 4
+        self.cms.batched_expiration_maintenance(60)
+        assert self.cms.get('a') == 0
+        self.assertRaises(ValueError, self.cms.merge, CountMinSketch(10 ** -3, 0.01, 5, conservative=True))
+
+    def test_merge_windowed(self):
+        other = WindowedCountMinSketch(10 ** -3, 0.01, 5, window=60, nbr_panes=4)
+        other.update_many(['old'] * 3)
+        other.batched_expiration_maintenance(30)
+        other.update_many(['new'] * 2)
+        self.cms.update_many(['new'])
+        merged = WindowedCountMinSketch.merge_many([self.cms, other])
+        assert (merged.get('old'), merged.get('new')) == (3, 3)
+        np.testing.assert_array_equal(merged.panes.sum(axis=0), merged.count)
+        # 'old' is two panes older than 'new', and expires first
+        merged.batched_expiration_maintenance(30)
+        assert (merged.get('old'), merged.get('new')) == (0, 3)
+        for window, nbr_panes in ((60, 6), (120, 4)):
+            self.assertRaises(ValueError, self.cms.merge,
+                              WindowedCountMinSketch(10 ** -3, 0.01, 5, window=window, nbr_panes=nbr_panes))
+
+    def test_serialization(self):
+        self.cms.update_many(['old'] * 10)
+        self.cms.batched_expiration_maintenance(20)
+        self.cms.update_many(['new'] * 5)
+        for compress in (False, True):
+            cms = WindowedCountMinSketch.from_bytes(self.cms.to_bytes(compress))
+            assert (cms.window, cms.nbr_panes, cms.head) == (60, 4, 1)
+            np.testing.assert_array_equal(cms.panes, self.cms.panes)
+            np.testing.assert_array_equal(cms.count, self.cms.count)
+            assert cms.heap == self.cms.heap
+            cms.batched_expiration_maintenance(45)
+            assert (cms.get('old'), cms.get('new')) == (0, 5)
+        self.assertRaises(ValueError, CountMinSketch.from_bytes, self.cms.to_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+from __future__ import absolute_import, print_function
+
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably import CuckooFilter
+from probably.hashfunctions import digest_many, digests64
+
+
+class CuckooFilterTests(unittest.TestCase):
+    '''
+    Tests for CuckooFilter
+    '''
+    def setUp(self):
+        self.cf = CuckooFilter(1000, 0.01)
+        self.keys = [str(i) for i in range(900)]
+
+    def test_geometry(self):
+        assert self.cf.fingerprints().shape == (264, 4)
+        assert self.cf.fingerprint_bits == 10
+        assert self.cf.table.nbytes == 264 * 4 * 10 // 8 + 7
+        assert CuckooFilter(1000, 0.05).fingerprint_bits == 8
+        assert self.cf.estimated_error_rate < 0.01
+
+    def test_add_remove(self):
+        assert not self.cf.add('random_uuid')
+        assert self.cf.add('random_uuid')
+        assert 'random_uuid' in self.cf
+        assert len(self.cf) == 1
+        assert self.cf.remove('random_uuid')
+        assert 'random_uuid' not in self.cf
+        assert not self.cf.remove('random_uuid')
+        assert not self.cf.table.any()
+        assert len(self.cf) == 0
+
+    def test_add_idempotent(self):
+        cf = CuckooFilter(10000, 0.001)
+        for i in range(100):
+            cf.add('x')
+        assert len(cf) == 1
+        found = cf.add_many(['x', 'y', 'y'])
+        np.testing.assert_array_equal(found, [True, False, True])
+        assert len(cf) == 2
+        assert np.count_nonzero(cf.fingerprints()) == 2
+
+    def test_duplicates(self):
+        cf = CuckooFilter(1000, 0.01, allow_duplicates=True)
+        assert not cf.add('random_uuid')
+        assert cf.add('random_uuid')
+        assert len(cf) == 2
+        # Added twice, removed twice
+        assert cf.remove('random_uuid')
+        assert 'random_uuid' in cf
+        assert cf.remove('random_uuid')
+        assert 'random_uuid' not in cf
+        assert not cf.table.any()
+
+    def test_many(self):
+        found = self.cf.add_many(self.keys)
+        assert found.sum() < 10
+        assert len(self.cf) == 900 - found.sum()
+        other = CuckooFilter(1000, 0.01)
+        for key in self.keys:
+            other.add(key)
+        np.testing.assert_array_equal(self.cf.table, other.table)
+        assert self.cf.contains_many(self.keys).all()
+        others = [str(i) for i in range(10000, 30000)]
+        assert self.cf.contains_many(others).mean() < 0.01
+        removed = self.cf.remove_many(self.keys[:100])
+        assert removed.sum() > 95
+        assert len(self.cf) == 900 - found.sum() - removed.sum()
+        assert self.cf.contains_many(self.keys[100:]).sum() > 795
+        assert self.cf.contains_many(self.keys[:100]).sum() < 5
+
+    def test_shared_fingerprints(self):
+        # Tiny fingerprints: many keys share one with another key of their buckets
+        cf = CuckooFilter(2000, 0.5, allow_duplicates=True)
+        keys = [str(i) for i in range(2000)]
+        found = cf.add_many(keys)
+        assert found.sum() > 100
+        assert len(cf) == 2000
+        assert cf.remove_many(keys[::2]).all()
+        assert cf.contains_many(keys[1::2]).all()
+        assert cf.remove_many(keys[1::2]).all()
+        assert not cf.table.any()
+        for i in range(8):
+            cf.add('random_uuid')
+        self.assertRaises(IndexError, cf.add, 'random_uuid')
+        assert len(cf) == 8
+
+    def test_capacity(self):
+        cf = CuckooFilter(100, 0.01, max_kicks=50)
+        keys = [str(i) for i in range(1000)]
+        self.assertRaises(IndexError, cf.add_many, keys)
+        assert cf.count >= 100
+        assert cf.contains_many(keys[:cf.count]).all()
+        table = cf.table.copy()
+        self.assertRaises(IndexError, cf.add_many, keys[cf.count:])
+        np.testing.assert_array_equal(cf.table, table)
+
+    def test_digests(self):
+        digests = digest_many(self.keys)
+        self.cf.add_digests(digests)
+        other = CuckooFilter(1000, 0.01)
+        other.add_many(self.keys)
+        np.testing.assert_array_equal(self.cf.table, other.table)
+        assert self.cf.contains_digests(digests).all()
+        assert self.cf.remove_digests(digests[:100]).all()
+        np.testing.assert_array_equal(self.cf.contains_digests(digests), self.cf.contains_many(self.keys))
+        # 64-bit digests from another hash function
+        cf = CuckooFilter(1000, 0.01)
+        cf.add_digests(digests64(np.arange(900, dtype=np.uint64)))
+        assert cf.contains_digests(digests64(np.arange(900))).all()
+        assert cf.contains_digests(digests64(np.arange(10000, 20000))).mean() < 0.01
+
+    def test_serialization(self):
+        self.cf.add_many(self.keys)
+        for compress in (False, True):
+            cf = CuckooFilter.from_bytes(self.cf.to_bytes(compress))
+            np.testing.assert_array_equal(cf.table, self.cf.table)
+            assert len(cf) == len(self.cf)
+            assert cf.remove('0') and '0' not in cf
+            assert not cf.allow_duplicates
+        cf = CuckooFilter.from_bytes(CuckooFilter(1000, 0.01, allow_duplicates=True).to_bytes())
+        assert cf.allow_duplicates
+        data = bytearray(self.cf.to_bytes())
+        CuckooFilter.from_bytes(data).remove('0')
+        assert '0' not in CuckooFilter.from_bytes(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
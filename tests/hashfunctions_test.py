@@ -0,0 +1,103 @@
+from __future__ import absolute_import, print_function
+
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably.hashfunctions import (CHAINED, DOUBLE, MASK64, digest, digest_many, digests64,
+                                    digests_array,
+                                    generate_bulk_hashfunctions, generate_digest_hashfunctions,
+                                    generate_hashfunctions, hash64, hash128)
+
+
+def reference_hashes(key, nbr_bits, nbr_slices, scheme):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    if scheme == DOUBLE:
+        h1, h2 = hash128(key)
+        return [((h1 + i * h2) & MASK64) % nbr_bits for i in range(nbr_slices)]
+    rval = []
+    current_hash = 0
+    for i in range(nbr_slices):
+        current_hash = hash64(key, current_hash)
+        rval.append(current_hash % nbr_bits)
+    return rval
+
+
+class HashFunctionsTests(unittest.TestCase):
+    '''
+    Tests for the hash schemes
+    '''
+    def setUp(self):
+        self.keys = [u'random_uuid', u'\xe9t\xe9', b'\xff\x00raw', 42, 3.5] + [str(i) for i in range(200)]
+
+    def test_chained(self):
+        hashes = generate_hashfunctions(1358, 6)
+        assert hashes('random_uuid') == [1039, 18, 486, 1154, 863, 740]
+        assert hashes('random_uuid')[0] == hash64(b'random_uuid', 0) % 1358
+
+    def test_double(self):
+        hashes = generate_hashfunctions(1358, 6, DOUBLE)
+        values = hashes('random_uuid')
+        assert len(values) == 6
+        assert all(0 <= v < 1358 for v in values)
+        assert values != generate_hashfunctions(1358, 6, CHAINED)('random_uuid')
+
+    def test_matches_reference(self):
+        for scheme in (CHAINED, DOUBLE):
+            hashes = generate_hashfunctions(1000003, 10, scheme)
+            for key in self.keys:
+                assert hashes(key) == reference_hashes(key, 1000003, 10, scheme)
+
+    def test_bulk_matches_single(self):
+        for scheme in (CHAINED, DOUBLE):
+            hashes = generate_hashfunctions(1000003, 10, scheme)
+            bulk_hashes = generate_bulk_hashfunctions(1000003, 10, scheme)
+            expected = np.array([hashes(key) for key in self.keys], dtype=np.uint64)
+            np.testing.assert_array_equal(bulk_hashes(self.keys), expected)
+
+    def test_bytes_keys(self):
+        hashes = generate_hashfunctions(1000003, 10)
+        assert hashes(b'random_uuid') == hashes(u'random_uuid')
+        assert hashes(bytearray(b'random_uuid')) == hashes(b'random_uuid')
+        bulk_hashes = generate_bulk_hashfunctions(1000003, 10)
+        np.testing.assert_array_equal(bulk_hashes([b'\xff', memoryview(b'\xff')])[1], hashes(b'\xff'))
+
+    def test_digests(self):
+        digests = digest_many(self.keys)
+        assert digests.shape == (len(self.keys), 2) and digests.dtype == np.uint64
+        assert [tuple(row) for row in digests.tolist()] == [digest(key) for key in self.keys]
+        np.testing.assert_array_equal(digests_array(digest('42')), digests[3:4])
+        digest_hashes = generate_digest_hashfunctions(1000003, 10, DOUBLE)
+        np.testing.assert_array_equal(digest_hashes(digests),
+                                      generate_bulk_hashfunctions(1000003, 10, DOUBLE)(self.keys))
+        self.assertRaises(ValueError, generate_digest_hashfunctions(1000003, 10, CHAINED), digests)
+
+    def test_digests64(self):
+        values = np.arange(-5, 5, dtype=np.int64)
+        expanded = digests64(values)
+        assert expanded.shape == (10, 2)
+        assert len(set(expanded.ravel().tolist())) == 20
+        np.testing.assert_array_equal(digests64(values.astype(np.uint64)), expanded)
+        np.testing.assert_array_equal(digests64(-5), expanded[:1])
+        self.assertRaises(ValueError, digests64, np.zeros((4, 2), dtype=np.uint64))
+
+    def test_ambiguous_digests(self):
+        h1, h2 = digest('42')
+        np.testing.assert_array_equal(digests_array([(h1, h2)]), digests_array((h1, h2)))
+        np.testing.assert_array_equal(digests_array([[-1, 1]]), [[MASK64, 1]])
+        # 64-bit digests are not silently remixed
+        self.assertRaises(ValueError, digests_array, [h1, h2, h1])
+        self.assertRaises(ValueError, digests_array, np.arange(4, dtype=np.uint64))
+        self.assertRaises(ValueError, digests_array, h1)
+        self.assertRaises(ValueError, digests_array, np.zeros((4, 3), dtype=np.uint64))
+
+    def test_unknown_scheme(self):
+        self.assertRaises(ValueError, generate_hashfunctions, 1000, 4, 'md5')
+
+
+if __name__ == '__main__':
+    unittest.main()
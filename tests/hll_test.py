@@ -0,0 +1,191 @@
+from __future__ import absolute_import, print_function
+
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably import HyperLogLog
+from probably.hll import ERTL, _decode_sparse, _encode_sparse
+from probably.hashfunctions import digest_many, hash64
+
+
+class HyperLogLogTests(unittest.TestCase):
+    '''
+    Tests for HyperLogLog
+    '''
+    def setUp(self):
+        self.hll = HyperLogLog(0.01)
+        self.keys = [str(i) for i in range(20000)]
+
+    def test_empty(self):
+        assert len(self.hll) == 0
+        assert self.hll.M.dtype == np.uint8
+
+    def test_add(self):
+        self.hll.add('random_uuid')
+        x = hash64(b'random_uuid', 0)
+        j = x & ((1 << self.hll.b) - 1)
+        w = x >> self.hll.b
+        # Position of the lowest set bit
+        rho = (w & -w).bit_length()
+        assert self.hll.M[j] == rho
+        assert np.count_nonzero(self.hll.M) == 1
+
+    def test_estimate(self):
+        for key in self.keys:
+            self.hll.add(key)
+        assert abs(len(self.hll) - 20000) < 20000 * 0.03
+
+    def test_add_many(self):
+        for key in self.keys:
+            self.hll.add(key)
+        other = HyperLogLog(0.01)
+        other.add_many(iter(self.keys + ['']))
+        np.testing.assert_array_equal(self.hll.M, other.M)
+        assert other.M.dtype == np.uint8
+
+    def test_estimate_large(self):
+        keys = [str(i) for i in range(300000)]
+        self.hll.add_many(keys)
+        assert self.hll.M.min() > 0
+        assert abs(len(self.hll) - 300000) < 300000 * 0.03
+
+    def test_sparse(self):
+        hll = HyperLogLog(0.01, sparse=True)
+        assert hll.is_sparse
+        hll.add_many(self.keys[:100])
+        for key in self.keys[100:200]:
+            hll.add(key)
+        assert hll.is_sparse
+        assert abs(len(hll) - 200) <= 4
+        hll.add_many(self.keys[200:])
+        assert not hll.is_sparse
+        for key in self.keys:
+            self.hll.add(key)
+        np.testing.assert_array_equal(hll.M, self.hll.M)
+        assert len(hll) == len(self.hll)
+
+    def test_sparse_registers(self):
+        hll = HyperLogLog(0.01, sparse=True)
+        for key in self.keys[:300]:
+            hll.add(key)
+            self.hll.add(key)
+        np.testing.assert_array_equal(hll.registers(), self.hll.M)
+        assert hll.sparse_data.nbytes < hll.m // 16
+
+    def test_sparse_encoding(self):
+        entries = np.unique(np.random.RandomState(0).randint(0, 1 << 22, 1000).astype(np.uint32))
+        entries = np.concatenate([[0, 1, 127, 128], entries[entries > 128], [(1 << 32) - 1]]).astype(np.uint32)
+        data = _encode_sparse(entries)
+        assert data.dtype == np.uint8 and data.nbytes < 3 * entries.size
+        np.testing.assert_array_equal(_decode_sparse(data), entries)
+        assert _decode_sparse(_encode_sparse(np.zeros(0, dtype=np.uint32))).size == 0
+
+    def test_sparse_threshold(self):
+        hll = HyperLogLog(0.01, sparse=True)
+        hll.add_many(self.keys[:50])
+        assert hll.sparse_data.nbytes + hll.sparse_buffer.nbytes < hll.m // 50
+        hll.add_many(self.keys[50:1500])
+        assert hll.is_sparse and hll.sparse_data.nbytes <= hll.sparse_threshold
+        hll.add_many(self.keys[1500:3000])
+        assert not hll.is_sparse
+
+    def test_digests(self):
+        self.hll.add_digests(digest_many(self.keys))
+        hll = HyperLogLog(0.01)
+        hll.add_many(self.keys)
+        np.testing.assert_array_equal(self.hll.M, hll.M)
+        sparse = HyperLogLog(0.01, sparse=True)
+        sparse.add_digests(digest_many(self.keys[:300]))
+        hll = HyperLogLog(0.01)
+        hll.add_many(self.keys[:300])
+        np.testing.assert_array_equal(sparse.registers(), hll.M)
+        # Empty keys are ignored when the keys are passed along
+        keys = ['', 'a', '', 'b']
+        hll = HyperLogLog(0.01)
+        hll.add_digests(digest_many(keys), keys=keys)
+        other = HyperLogLog(0.01)
+        other.add_many(keys)
+        np.testing.assert_array_equal(hll.registers(), other.registers())
+
+    def test_ertl_estimator(self):
+        self.assertRaises(ValueError, HyperLogLog, 0.01, estimator='loglog')
+        hll = HyperLogLog(0.01, estimator=ERTL)
+        assert len(hll) == 0
+        hll.add_many(self.keys)
+        assert abs(len(hll) - 20000) < 20000 * 0.03
+
+    def test_merge(self):
+        parts = [HyperLogLog(0.01) for i in range(4)]
+        for i, key in enumerate(self.keys):
+            parts[i % 4].add(key)
+        self.hll.add_many(self.keys)
+        union = HyperLogLog(0.01)
+        assert union.merge(*parts) is union
+        assert union.M.dtype == np.uint8
+        np.testing.assert_array_equal(union.M, self.hll.M)
+        np.testing.assert_array_equal((parts[0] | parts[1] | parts[2] | parts[3]).M, self.hll.M)
+        assert parts[0].M.dtype == np.uint8
+        self.assertRaises(ValueError, union.merge, HyperLogLog(0.1))
+
+    def test_merge_sparse(self):
+        first = HyperLogLog(0.01, sparse=True)
+        second = HyperLogLog(0.01, sparse=True)
+        first.add_many(self.keys[:50])
+        second.add_many(self.keys[50:100])
+        first.merge(second)
+        assert first.is_sparse
+        self.hll.add_many(self.keys[:100])
+        np.testing.assert_array_equal(first.registers(), self.hll.M)
+        first.merge(self.hll)
+        assert not first.is_sparse
+
+    def test_merge_leaves_others(self):
+        sparse = HyperLogLog(0.01, sparse=True)
+        for key in self.keys[:10]:
+            sparse.add(key)
+        data, buffered = sparse.sparse_data.copy(), sparse.sparse_buffered
+        self.hll.add_many(self.keys[10:20])
+        self.hll.merge(sparse)
+        assert sparse.is_sparse and sparse.sparse_buffered == buffered == 10
+        np.testing.assert_array_equal(sparse.sparse_data, data)
+        assert abs(len(self.hll) - 20) <= 1
+
+    def test_union_many(self):
+        parts = [HyperLogLog(0.01) for i in range(10)]
+        for i, key in enumerate(self.keys):
+            parts[i % 10].add(key)
+        union = HyperLogLog.union_many(parts)
+        self.hll.add_many(self.keys)
+        np.testing.assert_array_equal(union.M, self.hll.M)
+        assert not np.array_equal(parts[0].M, union.M)
+        self.assertRaises(ValueError, HyperLogLog.union_many, [])
+
+    def test_estimate_many(self):
+        hlls = [HyperLogLog(0.01, estimator=ERTL) for i in range(5)]
+        for i, hll in enumerate(hlls):
+            hll.add_many(self.keys[:4000 * i])
+        estimates = HyperLogLog.estimate_many(hlls)
+        np.testing.assert_array_equal(estimates, [len(hll) for hll in hlls])
+        stacked = HyperLogLog.stack(hlls).reshape(1, 5, -1)
+        union = hlls[0].estimate_registers(np.maximum.reduce(stacked, axis=1))
+        assert union[0] == estimates[-1]
+
+    def test_serialization(self):
+        self.hll.add_many(self.keys)
+        for compress in (False, True):
+            hll = HyperLogLog.from_bytes(self.hll.to_bytes(compress))
+            np.testing.assert_array_equal(hll.M, self.hll.M)
+            assert len(hll) == len(self.hll)
+
+    def test_serialization_sparse(self):
+        hll = HyperLogLog(0.01, sparse=True, estimator=ERTL)
+        hll.add_many(self.keys[:100])
+        other = HyperLogLog.from_bytes(hll.to_bytes())
+        assert other.is_sparse and other.estimator == ERTL
+        np.testing.assert_array_equal(other.registers(), hll.registers())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+from __future__ import absolute_import, print_function
+
+import unittest
+
+import numpy as np
+from six.moves import range
+
+from probably import CountdownBloomFilter, CountMinSketch, HyperLogLog, IngestionPipeline, Sharded
+from probably.hashfunctions import DOUBLE
+
+
+class IngestionPipelineTests(unittest.TestCase):
+    '''
+    Tests for IngestionPipeline
+    '''
+    def setUp(self):
+        self.stream = []
+        for i in range(100):
+            self.stream += [str(i)] * i
+        np.random.RandomState(0).shuffle(self.stream)
+        self.pipeline = IngestionPipeline(*self.structures(), batch_size=1000)
+
+    def structures(self):
+        return (CountdownBloomFilter(1000, 0.001, 5.0, hash_scheme=DOUBLE), HyperLogLog(0.01),
+                CountMinSketch(10 ** -3, 0.01, 10, hash_scheme=DOUBLE))
+
+    def test_ingest(self):
+        stats = self.pipeline.ingest(self.stream)
+        assert (stats['keys'], stats['unseen'], stats['duplicates']) == (len(self.stream), 99, len(self.stream) - 99)
+        assert stats['duration'] >= 0
+        # Same result as the structures updated one after the other
+        cdbf, hll, cms = self.structures()
+        unseen = ~cdbf.add_many(self.stream)
+        new_keys = [key for key, new in zip(self.stream, unseen) if new]
+        hll.add_many(new_keys)
+        cms.update_many(new_keys)
+        np.testing.assert_array_equal(self.pipeline.cdbf.cellarray, cdbf.cellarray)
+        np.testing.assert_array_equal(self.pipeline.hll.M, hll.M)
+        np.testing.assert_array_equal(self.pipeline.cms.count, cms.count)
+        assert sorted(self.pipeline.cms.heap) == sorted(cms.heap)
+
+    def test_ingest_stream(self):
+        all_stats = list(self.pipeline.ingest_stream(iter(self.stream)))
+        assert [stats['keys'] for stats in all_stats] == [1000] * 4 + [len(self.stream) - 4000]
+        assert sum(stats['unseen'] for stats in all_stats) == 99
+        metrics = self.pipeline.metrics()
+        assert (metrics['batches'], metrics['keys'], metrics['unseen']) == (5, len(self.stream), 99)
+        assert abs(metrics['cardinality'] - 99) < 3
+        # Seen keys are only counted again once expired
+        assert self.pipeline.ingest([str(i) for i in range(100)])['unseen'] == 1
+        self.pipeline.cdbf.batched_expiration_maintenance(6.0)
+        assert self.pipeline.ingest([str(i) for i in range(100)])['unseen'] == 100
+
+    def test_optional_structures(self):
+        pipeline = IngestionPipeline(CountdownBloomFilter(1000, 0.001, 5.0, hash_scheme=DOUBLE))
+        assert pipeline.ingest(self.stream)['unseen'] == 99
+        assert pipeline.metrics()['cardinality'] is None
+
+    def test_capacity(self):
+        pipeline = IngestionPipeline(CountdownBloomFilter(100, 0.001, 5.0, hash_scheme=DOUBLE), HyperLogLog(0.01),
+                                     CountMinSketch(10 ** -3, 0.01, 10, hash_scheme=DOUBLE))
+        keys = [str(i) for i in range(200)]
+        self.assertRaises(IndexError, pipeline.ingest, keys)
+        # The keys inserted before the filter got full are counted
+        inserted = pipeline.cdbf.count
+        assert pipeline.metrics()['keys'] == pipeline.nbr_unseen == inserted
+        assert pipeline.cdbf.contains_many(keys[:inserted]).all()
+        assert abs(len(pipeline.hll) - inserted) < 3
+        assert (pipeline.cms.get_many(keys[:inserted]) >= 1).all()
+        assert all(key in keys[:inserted] for estimate, key in pipeline.cms.heap)
+
+    def test_sharded(self):
+        sharded = Sharded(lambda: CountdownBloomFilter(250, 0.001, 5.0, hash_scheme=DOUBLE), 4)
+        pipeline = IngestionPipeline(sharded, HyperLogLog(0.01))
+        assert pipeline.ingest(self.stream)['unseen'] == 99
+        assert pipeline.metrics()['estimated_count'] == 99
+        sharded = Sharded(lambda: CountdownBloomFilter(25, 0.001, 5.0, hash_scheme=DOUBLE), 4)
+        pipeline = IngestionPipeline(sharded, HyperLogLog(0.01))
+        keys = [str(i) for i in range(200)]
+        self.assertRaises(IndexError, pipeline.ingest, keys)
+        counted = pipeline.metrics()['keys']
+        assert counted < 200
+        # Every key a shard inserted is counted, including the ones past the
+        # first key left out by a full shard (false positives aside)
+        assert len(sharded) == pipeline.nbr_unseen > counted - 3
+        assert abs(len(pipeline.hll) - pipeline.nbr_unseen) < 3
+
+    def test_empty_keys(self):
+        stats = self.pipeline.ingest(['', 'a', 'b', ''])
+        assert stats['unseen'] == 3
+        hll = HyperLogLog(0.01)
+        hll.add_many(['', 'a', 'b'])
+        np.testing.assert_array_equal(self.pipeline.hll.registers(), hll.registers())
+
+    def test_hash_scheme(self):
+        self.assertRaises(ValueError, IngestionPipeline, CountdownBloomFilter(1000, 0.001, 5.0))
+        self.assertRaises(ValueError, IngestionPipeline, CountdownBloomFilter(1000, 0.001, 5.0, hash_scheme=DOUBLE),
+                          cms=CountMinSketch(10 ** -3, 0.01, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+from __future__ import absolute_import, print_function
+
+import time
+import unittest
+
+import numpy as np
+
+from probably import CountdownBloomFilter, MaintenanceScheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class MaintenanceSchedulerTests(unittest.TestCase):
+    '''
+    Tests for MaintenanceScheduler
+    '''
+    def setUp(self):
+        self.bf = CountdownBloomFilter(1000, 0.02, 5.0)
+        self.bf.add_many([str(i) for i in range(500)])
+        self.clock = FakeClock()
+        self.scheduler = MaintenanceScheduler(self.bf, clock=self.clock)
+
+    def test_carry_remainder(self):
+        refresh_time = self.bf.compute_refresh_time()
+        other = CountdownBloomFilter(1000, 0.02, 5.0)
+        other.cellarray[:] = self.bf.cellarray
+        assert self.scheduler.run_pending() == 0
+        steps = 0
+        for i in range(10):
+            self.clock.now += 2.5 * refresh_time
+            steps += self.scheduler.run_pending()
+        assert steps == 25
+        other.run_maintenance(25)
+        np.testing.assert_array_equal(self.bf.cellarray, other.cellarray)
+        assert self.bf.refresh_head == 25
+
+    def test_chunks(self):
+        self.scheduler.run_pending()
+        self.clock.now += 2 * self.bf.expiration
+        calls = []
+        decrement = self.bf.decrement
+
+        def record(num_iterations):
+            calls.append(num_iterations)
+            # 10M cells/sec: 50000 cells fit the default 5ms budget
+            self.clock.now += num_iterations * 1e-7
+            return decrement(num_iterations)
+        self.bf.decrement = record
+        due = self.bf.num_batched_maintenance(2 * self.bf.expiration)
+        self.scheduler.run_pending()
+        # The pass stops when the budget is spent, the rest is carried over
+        assert calls == [4096, 45904]
+        assert self.scheduler.last_pass_duration <= self.scheduler.latency_budget * (1 + 1e-9)
+        assert self.scheduler.metrics()['lag'] > 0
+        while self.scheduler.pending >= 1:
+            self.scheduler.run_pending()
+            assert self.scheduler.last_pass_duration <= self.scheduler.latency_budget * (1 + 1e-9)
+            assert calls[-1] <= 50000
+        # Passes also account for the time spent in the previous ones
+        assert sum(calls) > due
+        assert self.scheduler.metrics()['cells_per_second'] > 0
+        assert self.scheduler.metrics()['lag'] < 1
+        assert len(self.bf) == 0
+
+    def test_small_chunks_estimate(self):
+        bf = CountdownBloomFilter(10000, 0.01, 60)
+        bf.add_many([str(i) for i in range(5000)])
+        scheduler = MaintenanceScheduler(bf, clock=self.clock)
+        scheduler.run_pending()
+        counts = []
+        for i in range(5000):
+            # About 3.3 steps per pass
+            self.clock.now += 3.3 * bf.compute_refresh_time()
+            scheduler.run_pending()
+            counts.append(bf.count)
+        assert scheduler.processed > 4 * scheduler.estimate_steps
+        assert all(abs(count - 5000) < 500 for count in counts)
+        assert bf.estimate_z < 0.5
+        assert not bf.add('random_uuid')
+
+    def test_thread(self):
+        scheduler = MaintenanceScheduler(self.bf, interval=0.01)
+        with scheduler:
+            time.sleep(0.1)
+        metrics = scheduler.metrics()
+        assert metrics['passes'] >= 2
+        assert metrics['processed'] > 0
+        assert metrics['estimated_count'] == self.bf.count
+        assert scheduler.thread is None
@@ -0,0 +1,123 @@
+from __future__ import absolute_import, print_function
+
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from six.moves import range
+
+from probably import BloomFilter, CountdownBloomFilter, CountMinSketch, HyperLogLog, Sharded
+from probably.bulk import shard_digests, shard_many
+from probably.hashfunctions import DOUBLE, digest, digest_many
+
+
+class ShardedTests(unittest.TestCase):
+    '''
+    Tests for Sharded
+    '''
+    def setUp(self):
+        self.keys = [str(i) for i in range(4000)]
+
+    def test_bloomfilter(self):
+        sharded = Sharded(lambda: BloomFilter(1000, 0.01), 8)
+        assert not sharded.add('random_uuid')
+        assert sharded.add('random_uuid')
+        assert 'random_uuid' in sharded
+        found = sharded.add_many(self.keys + self.keys[:10])
+        assert found[:4000].mean() < 0.01
+        assert found[4000:].all()
+        assert sharded.contains_many(self.keys).all()
+        assert all(key in sharded for key in self.keys)
+        assert 4000 <= len(sharded) <= 4001
+        counts = [shard.count for shard in sharded.shards]
+        assert min(counts) > 300
+
+    def test_empty_batches(self):
+        sharded = Sharded(lambda: BloomFilter(1000, 0.01, hash_scheme=DOUBLE), 8)
+        for found in (sharded.add_many([]), sharded.add_digests(digest_many([])), sharded.contains_many([])):
+            assert found.dtype == np.bool_ and found.size == 0
+        assert len(sharded) == 0
+        hll = Sharded(lambda: HyperLogLog(0.05), 4)
+        assert hll.add_many([]) is None
+        assert hll.add_digests(digest_many([])) is None
+
+    def test_digests(self):
+        digests = digest_many(self.keys)
+        np.testing.assert_array_equal(shard_digests(digests, 8), shard_many(self.keys, 8))
+        sharded = Sharded(lambda: BloomFilter(1000, 0.01, hash_scheme=DOUBLE), 8)
+        found = sharded.add_digests(digests)
+        assert found.mean() < 0.01
+        assert sharded.contains_many(self.keys).all()
+        assert sharded.contains_digests(digests).all()
+        sharded.add_many(['random_uuid'])
+        assert sharded.contains_digests(digest('random_uuid')).all()
+
+    def test_countmin_digests(self):
+        sharded = Sharded(lambda: CountMinSketch(10 ** -3, 0.01, 5, hash_scheme=DOUBLE), 4)
+        stream = [str(i) for i in range(50) for j in range(i)]
+        sharded.update_digests(digest_many(stream), keys=stream)
+        sharded.update_digests(digest_many(['49']), 2)
+        assert sharded.get('49') >= 51
+        assert sharded.get_digests(digest_many(['49', '1']))[0] >= 51
+        assert [key for estimate, key in sharded.top()] == ['49', '48', '47', '46', '45']
+        self.assertRaises(ValueError, sharded.update_digests, digest_many(stream), keys=stream + ['extra'])
+
+    def test_hll_digests(self):
+        sharded = Sharded(lambda: HyperLogLog(0.05), 4)
+        assert sharded.add_digests(digest_many(self.keys)) is None
+        assert abs(len(sharded) - 4000) < 4000 * 0.1
+
+    def test_threads(self):
+        sharded = Sharded(lambda: BloomFilter(1000, 0.01), 8)
+
+        def worker(start):
+            for key in self.keys[start::4]:
+                sharded.add(key)
+            sharded.add_many(self.keys[start::4])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sharded.contains_many(self.keys).all()
+
+    def test_executor(self):
+        with ThreadPoolExecutor(4) as executor:
+            sharded = Sharded(lambda: CountdownBloomFilter(1000, 0.01, 5), 8, executor)
+            assert not sharded.add_many(self.keys).any()
+            assert sharded.contains_many(self.keys).all()
+            sharded.batched_expiration_maintenance(6)
+            assert not sharded.contains_many(self.keys).any()
+
+    def test_stop_at_capacity(self):
+        sharded = Sharded(lambda: CountdownBloomFilter(25, 0.001, 5), 4)
+        found = sharded.add_many(self.keys, stop_at_capacity=True)
+        assert found.shape[0] < len(self.keys)
+        sharded = Sharded(lambda: CountdownBloomFilter(25, 0.001, 5), 4)
+        processed = np.zeros(len(self.keys), dtype=np.bool_)
+        found = sharded.add_many(self.keys, stop_at_capacity=True, processed=processed)
+        assert found.shape == processed.shape
+        assert not processed.all()
+        assert np.count_nonzero(processed & ~found) == len(sharded)
+        assert sharded.contains_many(self.keys)[processed].all()
+
+    def test_countmin(self):
+        sharded = Sharded(lambda: CountMinSketch(10 ** -3, 0.01, 5), 4)
+        stream = [str(i) for i in range(50) for j in range(i)]
+        sharded.update_many(stream)
+        sharded.update('49', 1)
+        assert sharded.get('49') >= 50
+        top = sharded.top()
+        assert [key for estimate, key in top] == ['49', '48', '47', '46', '45']
+
+    def test_hll(self):
+        sharded = Sharded(lambda: HyperLogLog(0.05), 4)
+        assert sharded.add_many(self.keys) is None
+        sharded.add('random_uuid')
+        assert abs(len(sharded) - 4001) < 4001 * 0.1
+
+
+if __name__ == '__main__':
+    unittest.main()
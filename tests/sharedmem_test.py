@@ -0,0 +1,172 @@
+from __future__ import absolute_import, print_function
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import uuid
+
+import numpy as np
+from six.moves import range
+
+from probably import BloomFilter, CountdownBloomFilter
+from probably.sharedmem import (attach_memmap, attach_shared, create_memmap, create_shared,
+                                detach)
+
+ATTACH_AND_EXIT = '''
+import sys
+from multiprocessing import shared_memory
+
+from probably import BloomFilter
+from probably.sharedmem import attach_shared
+
+
+class SharedMemory(shared_memory.SharedMemory):
+    def __init__(self, name=None, create=False, size=0):
+        super(SharedMemory, self).__init__(name, create, size)
+
+
+shared_memory.SharedMemory = SharedMemory
+assert 'random_uuid' in attach_shared(BloomFilter(1000, 0.01), sys.argv[1])
+'''
+
+
+def add_keys(factory, name, keys):
+    structure = attach_shared(factory(), name)
+    structure.add_many(keys)
+    detach(structure)
+
+
+def add_keys_one_by_one(factory, name, keys):
+    structure = attach_shared(factory(), name)
+    for key in keys:
+        structure.add(key)
+    detach(structure)
+
+
+class SharedMemoryTests(unittest.TestCase):
+    '''
+    Tests for sharedmem
+    '''
+    def setUp(self):
+        self.name = 'probably-%s' % uuid.uuid4().hex[:12]
+        self.keys = [str(i) for i in range(500)]
+
+    def test_bloomfilter(self):
+        bf = create_shared(BloomFilter(1000, 0.01), self.name)
+        try:
+            other = attach_shared(BloomFilter(1000, 0.01), self.name)
+            assert not bf.add('random_uuid')
+            assert 'random_uuid' in other
+            other.add_many(self.keys)
+            assert bf.contains_many(self.keys).all()
+            detach(other)
+            assert 'random_uuid' in other
+        finally:
+            detach(bf, unlink=True)
+        assert bf.contains_many(self.keys).all()
+
+    def test_bloomfilter_partial_byte(self):
+        # The slices end in the middle of a byte
+        fresh = BloomFilter(1000, 0.01)
+        assert fresh.nbr_slices * fresh.bits_per_slice % 8
+        fresh.add('random_uuid')
+        bf = create_shared(BloomFilter(1000, 0.01), self.name)
+        try:
+            bf.add_many(self.keys)
+            other = attach_shared(BloomFilter(1000, 0.01), self.name)
+            for structure in (bf, other):
+                assert len(structure.bitarray) == fresh.nbr_bits
+                assert (structure.bitarray | fresh.bitarray).count() > structure.bitarray.count()
+            detach(other)
+        finally:
+            detach(bf, unlink=True)
+        for structure in (bf, other):
+            union = structure.bitarray | fresh.bitarray
+            assert union.count() > structure.bitarray.count()
+
+    def test_attaching_process_exit(self):
+        bf = create_shared(BloomFilter(1000, 0.01), self.name)
+        try:
+            bf.add('random_uuid')
+            # A separate interpreter, with a resource tracker of its own, attaching
+            # like Python < 3.13 (no SharedMemory(track=...)) then exiting
+            subprocess.check_call([sys.executable, '-c', ATTACH_AND_EXIT, self.name])
+            # The segment outlives the attaching process
+            other = attach_shared(BloomFilter(1000, 0.01), self.name)
+            assert 'random_uuid' in other
+            detach(other)
+        finally:
+            detach(bf, unlink=True)
+
+    def test_countdown_state(self):
+        cdbf = create_shared(CountdownBloomFilter(1000, 0.01, 5), self.name)
+        try:
+            other = attach_shared(CountdownBloomFilter(1000, 0.01, 5), self.name)
+            cdbf.add_many(self.keys)
+            assert other.contains_many(self.keys).all()
+            other.add('random_uuid')
+            cdbf.batched_expiration_maintenance(1)
+            other.add('other_uuid')
+            assert other.estimate_z == cdbf.estimate_z
+            assert other.count == cdbf.count + 1
+            self.assertRaises(ValueError, attach_shared, CountdownBloomFilter(2000, 0.01, 5), self.name)
+            detach(other)
+        finally:
+            detach(cdbf, unlink=True)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_processes(self):
+        bf = create_shared(BloomFilter(1000, 0.01), self.name)
+        try:
+            context = multiprocessing.get_context('fork')
+            processes = [context.Process(target=add_keys, args=(lambda: BloomFilter(1000, 0.01),
+                                                                self.name, self.keys[i::4]))
+                         for i in range(4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            assert bf.contains_many(self.keys).all()
+        finally:
+            detach(bf, unlink=True)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_processes_concurrent(self):
+        # Processes setting bits of the same bytes at the same time must not drop any
+        keys = [str(i) for i in range(80000)]
+        bf = create_shared(BloomFilter(80000, 0.01), self.name)
+        try:
+            context = multiprocessing.get_context('fork')
+            targets = [add_keys, add_keys_one_by_one] * 2
+            processes = [context.Process(target=target, args=(lambda: BloomFilter(80000, 0.01),
+                                                              self.name, keys[i::4]))
+                         for i, target in enumerate(targets)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            assert bf.contains_many(keys).all()
+            assert 0.98 * len(keys) < len(bf) <= len(keys)
+        finally:
+            detach(bf, unlink=True)
+
+    def test_memmap(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cdbf.mm')
+        try:
+            cdbf = create_memmap(CountdownBloomFilter(1000, 0.01, 5), path)
+            cdbf.add_many(self.keys)
+            other = attach_memmap(CountdownBloomFilter(1000, 0.01, 5), path)
+            np.testing.assert_array_equal(other.cellarray, cdbf.cellarray)
+            assert other.count == 500
+            detach(cdbf)
+            detach(other)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
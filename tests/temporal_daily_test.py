@@ -0,0 +1,186 @@
+from __future__ import absolute_import, print_function
+
+import datetime as dt
+import glob
+import shutil
+import tempfile
+import unittest
+
+from six.moves import range
+
+from probably import DailyTemporalBloomFilter
+from probably.hashfunctions import DOUBLE, digest_many
+from probably.temporal_daily import SNAPSHOT_RAW, RAW_SNAPSHOT_HEADER
+
+
+class DailyTemporalBloomFilterTests(unittest.TestCase):
+    '''
+    Tests for DailyTemporalBloomFilter
+    '''
+    def setUp(self):
+        self.snapshot_path = tempfile.mkdtemp()
+        self.keys = [str(i) for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_path)
+
+    def make_bf(self, **kwargs):
+        return DailyTemporalBloomFilter(1000, 0.02, 10, 'test', self.snapshot_path, **kwargs)
+
+    def save_days(self, nbr_days, **kwargs):
+        today = dt.datetime.now()
+        for day in range(nbr_days):
+            bf = self.make_bf(**kwargs)
+            bf.initialize_period(today - dt.timedelta(days=day))
+            for key in self.keys[day::nbr_days]:
+                bf.add(key)
+            bf.save_snaphot()
+
+    def test_add(self):
+        bf = self.make_bf()
+        assert not bf.add('random_uuid')
+        assert bf.add('random_uuid')
+        assert 'random_uuid' in bf
+        assert bf.current_day_bitarray == bf.bitarray
+
+    def test_digests(self):
+        bf = self.make_bf(hash_scheme=DOUBLE)
+        bf.add(self.keys[0])
+        digests = digest_many(self.keys + self.keys[:10])
+        found = bf.add_digests(digests)
+        assert found[0] and found[200:].all()
+        assert found[1:200].mean() < 0.05
+        assert bf.count == 1 + 199 - found[1:200].sum()
+        assert bf.contains_digests(digests).all()
+        assert all(key in bf for key in self.keys)
+        assert bf.current_day_bitarray == bf.bitarray
+        other = self.make_bf(hash_scheme=DOUBLE)
+        for key in self.keys:
+            other.add(key)
+        assert other.bitarray == bf.bitarray
+        assert not self.make_bf(hash_scheme=DOUBLE).contains_digests(digests).any()
+        self.assertRaises(ValueError, self.make_bf().add_digests, digests)
+
+    def test_restore_pickle(self):
+        self.save_days(3)
+        bf = self.make_bf()
+        bf.restore_from_disk()
+        assert bf.ready
+        assert all(key in bf for key in self.keys)
+
+    def test_restore_raw(self):
+        self.save_days(3, snapshot_format=SNAPSHOT_RAW)
+        filename = glob.glob('%s/*.dat' % self.snapshot_path)[0]
+        with open(filename, 'rb') as f:
+            assert f.read(4) == b'PBDT'
+            f.seek(0, 2)
+            assert f.tell() == RAW_SNAPSHOT_HEADER.size + 8148 // 8 + 1
+        bf = self.make_bf()
+        bf.restore_from_disk()
+        assert all(key in bf for key in self.keys)
+        pickled = self.make_bf()
+        self.save_days(3)
+        pickled.restore_from_disk()
+        assert pickled.bitarray == bf.bitarray
+
+    def test_restore_raw_mismatch(self):
+        self.save_days(1, snapshot_format=SNAPSHOT_RAW)
+        bf = DailyTemporalBloomFilter(2000, 0.02, 10, 'test', self.snapshot_path)
+        self.assertRaises(ValueError, bf.restore_from_disk)
+
+    def test_warm_async(self):
+        self.save_days(5)
+        self.save_days(2, snapshot_format=SNAPSHOT_RAW)
+        bf = self.make_bf()
+        bf.add('random_uuid')
+        done = bf.warm_async(max_workers=3)
+        assert 'random_uuid' in bf
+        done.result(timeout=10)
+        assert bf.ready
+        assert bf.warm_progress() == 1.0
+        assert bf.warm_total == 5
+        assert 'random_uuid' in bf
+        assert all(key in bf for key in self.keys)
+        restored = self.make_bf()
+        restored.restore_from_disk()
+        restored.add('random_uuid')
+        assert restored.bitarray == bf.bitarray
+        assert restored.current_day_bitarray == bf.current_day_bitarray
+
+    def test_ring_rotation(self):
+        bf = self.make_bf(ring=True)
+        start = dt.datetime.now()
+        for day in range(12):
+            bf.initialize_period(start + dt.timedelta(days=day))
+            bf.rotate_day_planes()
+            bf.add('day-%d' % day)
+        assert len(bf.day_planes) == 10
+        assert bf.current_day_bitarray is bf.day_planes[bf.current_period]
+        assert 'day-11' in bf and 'day-2' in bf
+        assert 'day-0' not in bf and 'day-1' not in bf
+
+    def test_ring_rotation_incremental(self):
+        bf = self.make_bf(ring=True)
+        plane_bits = bf._plane_bits
+        unpacked = []
+
+        def record(plane):
+            unpacked.append(plane)
+            return plane_bits(plane)
+        bf._plane_bits = record
+        start = dt.datetime.now()
+        for day in range(25):
+            bf.initialize_period(start + dt.timedelta(days=day))
+            del unpacked[:]
+            bf.rotate_day_planes()
+            # Yesterday comes in, the day past the expiration goes out
+            assert len(unpacked) == min(day, 1) + (day >= 10)
+            for i in range(20):
+                bf.add('day-%d-%d' % (day, i))
+            union = bf._empty_bitarray()
+            for plane in bf.day_planes.values():
+                union |= plane
+            assert bf.bitarray == union
+        assert all('day-24-%d' % i in bf for i in range(20))
+        assert all('day-15-%d' % i in bf for i in range(20))
+        assert sum('day-14-%d' % i in bf for i in range(20)) < 2
+        # A snapshot loaded into a counted plane updates its counts
+        other = self.make_bf()
+        other.add('late')
+        bf._store_day_plane(start + dt.timedelta(days=20), other.current_day_bitarray)
+        bf.initialize_period(start + dt.timedelta(days=29))
+        bf.rotate_day_planes()
+        assert 'late' in bf
+        bf.initialize_period(start + dt.timedelta(days=40))
+        bf.rotate_day_planes()
+        assert 'late' not in bf
+        assert not bf.plane_counts.any() and not bf.bitarray.any()
+
+    def test_ring_restore(self):
+        self.save_days(3)
+        bf = self.make_bf(ring=True)
+        bf.restore_from_disk()
+        assert len(bf.day_planes) == 3
+        assert all(key in bf for key in self.keys)
+        # Expire the oldest day without touching the disk
+        bf.initialize_period(dt.datetime.now() + dt.timedelta(days=8))
+        bf.rotate_day_planes()
+        assert len(bf.day_planes) == 3
+        assert not any(key in bf for key in self.keys[2::3])
+        assert all(key in bf for key in self.keys[0::3] + self.keys[1::3])
+
+    def test_ring_warm_async(self):
+        self.save_days(4)
+        bf = self.make_bf(ring=True)
+        bf.warm_async().result(timeout=10)
+        restored = self.make_bf(ring=True)
+        restored.restore_from_disk()
+        assert bf.bitarray == restored.bitarray
+        assert sorted(bf.day_planes) == sorted(restored.day_planes)
+
+    def test_snapshot_format(self):
+        self.assertRaises(ValueError, self.make_bf, snapshot_format='json')
+
+
+if __name__ == '__main__':
+    unittest.main()